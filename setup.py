@@ -26,6 +26,7 @@ setuptools.setup(
     author_email="yaz@frayja.com",
     url="https://github.com/yaz/yaz_scripting_plugin",
     license="MIT",
+    python_requires=">=3.7",
     install_requires=["yaz", "yaz_templating_plugin"],
     scripts=["bin/yaz-scripting", "bin/yaz-screen-wrapper"],
     zip_safe=False,
@@ -35,6 +36,9 @@ setuptools.setup(
         "Development Status :: 4 - Beta",
         "Environment :: Console",
         "License :: OSI Approved :: MIT License",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6"
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11"
     ])
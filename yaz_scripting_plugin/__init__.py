@@ -1,3 +1,8 @@
-__all__ = ["Shell"]
+__all__ = ["Shell", "SyncShell", "Dag", "HedgePolicy", "Limits", "RetryPolicy", "TemplateInput"]
 
+from .dag import Dag
+from .hedge import HedgePolicy, RetryPolicy
+from .limits import Limits
 from .shell import Shell
+from .source import TemplateInput
+from .sync import SyncShell
@@ -0,0 +1,161 @@
+"""Bounded memory capture of process output."""
+
+import asyncio
+import codecs
+import mmap
+import tempfile
+import typing
+
+__all__ = ["Capture", "SpilledOutput", "read_into", "TEXT", "BYTES", "DISCARD", "MERGE"]
+
+# ways to capture stdout and stderr: decoded into a str, as bytes, or not at all,
+# stderr may also be merged into stdout
+TEXT = "text"
+BYTES = "bytes"
+DISCARD = "discard"
+MERGE = "merge"
+
+
+class SpilledOutput:
+    """Output that was written to a temporary file, accessed through a read-only mmap
+
+    Supports len(), indexing, slicing and bytes().  The temporary file is
+    removed when the SpilledOutput is closed or garbage collected.
+    """
+
+    def __init__(self, file: typing.BinaryIO, size: int):
+        self.file = file
+        self.size = size
+        self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.mmap[index]
+
+    def __bytes__(self):
+        return self.mmap[:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<SpilledOutput {} bytes>".format(self.size)
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return self.mmap[:].decode(encoding, errors)
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+class Capture:
+    """Collects output while keeping memory use bounded
+
+    When MAX_BYTES is given, only the first and the last MAX_BYTES // 2 bytes
+    are kept and the omitted middle is replaced by a marker.
+
+    When SPILL_BYTES is given, output is kept in memory until it exceeds
+    SPILL_BYTES, after which all of it is written to a temporary file and
+    getvalue() returns a SpilledOutput.
+
+    When ENCODING is given and neither policy is used, output is decoded as it
+    arrives and getvalue() returns a str.  Should the output turn out not to
+    be valid in ENCODING, it is collected as bytes instead.
+    """
+
+    marker = b"\n[... %d bytes omitted ...]\n"
+
+    def __init__(self, max_bytes: typing.Optional[int] = None, spill_bytes: typing.Optional[int] = None, encoding: typing.Optional[str] = None):
+        assert max_bytes is None or (isinstance(max_bytes, int) and max_bytes > 0), max_bytes
+        assert spill_bytes is None or (isinstance(spill_bytes, int) and spill_bytes >= 0), spill_bytes
+        assert max_bytes is None or spill_bytes is None, "MAX_BYTES and SPILL_BYTES are mutually exclusive"
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.size = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._file = None
+        self._text = None
+        self._decoder = None
+        if encoding is not None and max_bytes is None and spill_bytes is None:
+            self._text = []
+            self._decoder = codecs.getincrementaldecoder(encoding)()
+            self._encoding = encoding
+
+    @property
+    def truncated(self) -> bool:
+        return self.max_bytes is not None and self.size > self.max_bytes
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+
+        if self._decoder is not None:
+            try:
+                self._text.append(self._decoder.decode(chunk))
+            except UnicodeDecodeError:
+                self._stop_decoding()
+                self._head += chunk
+
+        elif self._file is not None:
+            self._file.write(chunk)
+
+        elif self.max_bytes is not None:
+            head_room = self.max_bytes // 2 - len(self._head)
+            if head_room > 0:
+                self._head += chunk[:head_room]
+                chunk = chunk[head_room:]
+            if chunk:
+                self._tail += chunk
+                # trimming is amortized, the tail is at most twice its limit
+                tail_limit = self.max_bytes - self.max_bytes // 2
+                if len(self._tail) > 2 * tail_limit:
+                    del self._tail[:-tail_limit]
+
+        else:
+            self._head += chunk
+            if self.spill_bytes is not None and len(self._head) > self.spill_bytes:
+                self._file = tempfile.TemporaryFile()
+                self._file.write(self._head)
+                self._head = bytearray()
+
+    def _stop_decoding(self):
+        # everything decoded so far encodes back into the exact same bytes
+        pending, _ = self._decoder.getstate()
+        self._head = bytearray("".join(self._text).encode(self._encoding) + pending)
+        self._text = None
+        self._decoder = None
+
+    def getvalue(self) -> typing.Union[str, bytes, SpilledOutput]:
+        if self._decoder is not None:
+            try:
+                self._text.append(self._decoder.decode(b"", final=True))
+                return "".join(self._text)
+            except UnicodeDecodeError:
+                self._stop_decoding()
+
+        if self._file is not None:
+            self._file.flush()
+            return SpilledOutput(self._file, self.size)
+
+        if self.truncated:
+            tail = self._tail[-(self.max_bytes - self.max_bytes // 2):]
+            return bytes(self._head) + self.marker % (self.size - len(self._head) - len(tail)) + bytes(tail)
+
+        return bytes(self._head + self._tail)
+
+
+async def read_into(reader: typing.Optional[asyncio.StreamReader], capture: Capture, chunk_size: int = 64 * 1024):
+    if reader is None:
+        # the stream is discarded or merged
+        return
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        capture.write(chunk)
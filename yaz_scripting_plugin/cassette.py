@@ -0,0 +1,120 @@
+"""Recording and replaying the results of commands."""
+
+import base64
+import collections
+import hashlib
+import json
+import os
+import typing
+
+from .capture import TEXT, BYTES, DISCARD, MERGE
+
+__all__ = ["Cassette", "CassetteEntry", "CassetteMissError", "RECORD", "REPLAY", "DRY_RUN", "EXECUTION_MODES", "convert_output"]
+
+# see Shell.set_execution_mode(), None executes every command
+RECORD = "record"
+REPLAY = "replay"
+DRY_RUN = "dry-run"
+EXECUTION_MODES = (None, RECORD, REPLAY, DRY_RUN)
+
+CassetteEntry = collections.namedtuple("CassetteEntry", ["kind", "cmd", "input", "return_code", "stdout", "stderr", "duration"])
+
+
+class CassetteMissError(RuntimeError):
+    """A command was replayed that was never recorded"""
+
+    def __init__(self, kind: str, cmd: str, path: str):
+        super().__init__("No recording of {} [{}] in {}".format(kind, cmd, path))
+        self.kind = kind
+        self.cmd = cmd
+        self.path = path
+
+
+def get_input_key(input) -> typing.Optional[str]:
+    """Returns what identifies INPUT in a cassette, streamed input can not be read twice and is only marked as such"""
+    if input is None:
+        return None
+    if isinstance(input, str):
+        input = input.encode()
+    if isinstance(input, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(input).hexdigest()
+    return "streamed"
+
+
+def convert_output(output, capture: str):
+    """Returns recorded OUTPUT as get() would for CAPTURE, i.e. decoded for TEXT"""
+    if output is None or capture in (DISCARD, MERGE):
+        return None
+    if capture == TEXT and not isinstance(output, str):
+        return bytes(output).decode(errors="replace")
+    if capture == BYTES and isinstance(output, str):
+        return output.encode()
+    return output
+
+
+def _dump(output):
+    if output is None or isinstance(output, str):
+        return output
+    # a SpilledOutput is only bytes-like through bytes()
+    return {"base64": base64.b64encode(output if isinstance(output, (bytes, bytearray, memoryview)) else bytes(output)).decode()}
+
+
+def _load(output):
+    if isinstance(output, dict):
+        return base64.b64decode(output["base64"])
+    return output
+
+
+class Cassette:
+    """Results of commands, stored in PATH as a line of JSON per call
+
+    Calls are looked up by their kind, i.e. "get", the rendered command and a
+    digest of their input.  When the same call was recorded more than once,
+    the recordings are replayed in order, and the last one is repeated.  A
+    new recording replaces the contents of PATH.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        self._file = None
+        self._index = None
+        self._positions = collections.Counter()
+
+    def __repr__(self):
+        return "<Cassette {}>".format(self.path)
+
+    def record(self, kind: str, cmd: str, input, return_code: typing.Union[int, typing.List[int]], stdout, stderr, duration: typing.Optional[float]):
+        if self._file is None:
+            self._file = open(self.path, "w")
+        entry = dict(kind=kind, cmd=cmd, input=get_input_key(input), return_code=return_code,
+                     stdout=_dump(stdout), stderr=_dump(stderr), duration=duration)
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        # a crashing test run keeps what was recorded so far
+        self._file.flush()
+
+    def find(self, kind: str, cmd: str, input) -> typing.Optional[CassetteEntry]:
+        """Returns the next recording of the call, or None when it was never recorded"""
+        if self._index is None:
+            self._index = self._load()
+        key = (kind, cmd, get_input_key(input))
+        entries = self._index.get(key)
+        if not entries:
+            return None
+        position = self._positions[key]
+        self._positions[key] += 1
+        return entries[min(position, len(entries) - 1)]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _load(self) -> typing.Dict[tuple, typing.List[CassetteEntry]]:
+        index = collections.defaultdict(list)
+        with open(self.path) as file:
+            for line in file:
+                entry = json.loads(line)
+                entry = CassetteEntry(entry["kind"], entry["cmd"], entry["input"], entry["return_code"],
+                                      _load(entry["stdout"]), _load(entry["stderr"]), entry["duration"])
+                index[(entry.kind, entry.cmd, entry.input)].append(entry)
+        return dict(index)
@@ -0,0 +1,36 @@
+"""Decide whether a command can be executed without /bin/sh."""
+
+import shlex
+import typing
+
+__all__ = ["MODES", "split_command"]
+
+# get(), stream() and run() accept these values for their MODE parameter
+MODES = ("auto", "shell", "exec")
+
+# characters that have a meaning to /bin/sh beyond splitting words and quoting
+SHELL_METACHARACTERS = frozenset("|&;<>()$`\\*?[]{}#~!\n")
+
+# reserved words and builtins that either have no executable or behave differently as one
+SHELL_WORDS = frozenset([
+    "!", ".", ":", "alias", "break", "case", "cd", "command", "continue", "do", "done", "elif", "else",
+    "esac", "eval", "exec", "exit", "export", "fi", "for", "getopts", "hash", "if", "in", "local",
+    "read", "readonly", "return", "set", "shift", "source", "then", "times", "trap", "type", "ulimit",
+    "umask", "unalias", "unset", "until", "wait", "while"])
+
+
+def split_command(cmd: str) -> typing.Optional[typing.List[str]]:
+    """Returns the argument list for CMD, or None when CMD needs /bin/sh to be interpreted"""
+    if not cmd or any(character in SHELL_METACHARACTERS for character in cmd):
+        return None
+
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        # unbalanced quotes, leave the error message to /bin/sh
+        return None
+
+    if not argv or "=" in argv[0] or argv[0] in SHELL_WORDS:
+        return None
+
+    return argv
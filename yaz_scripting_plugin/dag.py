@@ -0,0 +1,202 @@
+"""Commands with dependencies, executed as parallel as the graph allows."""
+
+import asyncio
+import collections
+import time
+import typing
+
+from .log import logger
+
+__all__ = ["Dag", "DagNode", "DagResult", "NodeResult", "execute_dag", "DONE", "FAILED", "SKIPPED", "CANCELLED"]
+
+# the status of a NodeResult
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+CANCELLED = "cancelled"
+
+DagNode = collections.namedtuple("DagNode", ["name", "cmd", "input", "depends", "output", "kwargs"])
+
+NodeResult = collections.namedtuple("NodeResult", ["name", "status", "stdout", "stderr", "error", "ready", "start", "end"])
+
+
+class Dag:
+    """Commands, each named, that only start once the commands they depend on succeeded
+
+    For example:
+    - dag = Dag()
+      dag.add("build", "make -C {{ path|quote }}")
+      dag.add("version", "git -C {{ path|quote }} describe", output="version")
+      dag.add("upload", "scp build.tar.gz host:{{ version }}.tar.gz", depends=["build", "version"])
+      result = await shell.execute_dag(dag, dict(path=path))
+    """
+
+    def __init__(self):
+        self.nodes = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self,
+            name: str,
+            cmd: str,
+            input: typing.Optional[str] = None,
+            *,
+            depends: typing.Iterable[str] = (),
+            output: typing.Optional[str] = None,
+            **kwargs) -> str:
+        """Add the command CMD as NAME and return NAME
+
+        The command starts once every node in DEPENDS succeeded.  When OUTPUT
+        is given, the stdout of the command, without trailing newlines like
+        $(...) in a shell, is available under that name in the context of
+        every node that depends on it, directly or indirectly.  KWARGS are
+        passed to Shell.get().
+        """
+        assert isinstance(name, str) and name not in self.nodes, name
+        depends = tuple(depends)
+        for dependency in depends:
+            # nodes are added after their dependencies, which also rules out cycles
+            assert dependency in self.nodes, "{} depends on unknown node {}".format(name, dependency)
+        self.nodes[name] = DagNode(name, cmd, input, depends, output, kwargs)
+        return name
+
+    def get_ancestors(self, name: str) -> typing.List[str]:
+        """Returns the nodes NAME depends on, directly or indirectly, in the order they were added"""
+        ancestors, pending = set(), list(self.nodes[name].depends)
+        while pending:
+            dependency = pending.pop()
+            if dependency not in ancestors:
+                ancestors.add(dependency)
+                pending.extend(self.nodes[dependency].depends)
+        return [node for node in self.nodes if node in ancestors]
+
+
+class DagResult:
+    """The NodeResult of every node of a Dag, by name, and the path of nodes that determined the duration"""
+
+    def __init__(self, dag: Dag, results: typing.Dict[str, NodeResult], start: float, end: float):
+        self.dag = dag
+        self.results = results
+        self.duration = end - start
+        self._start = start
+
+    def __repr__(self):
+        return "<DagResult {} nodes {:.3f}s>".format(len(self.results), self.duration)
+
+    def get_failed(self) -> typing.List[str]:
+        return [name for name, result in self.results.items() if result.status == FAILED]
+
+    def get_critical_path(self) -> typing.List[str]:
+        """Returns the chain of dependencies that ended last, the work that a shorter total duration must shorten"""
+        finished = [result for result in self.results.values() if result.end is not None]
+        if not finished:
+            return []
+        path = [max(finished, key=lambda result: result.end).name]
+        while True:
+            depends = [self.results[dependency] for dependency in self.dag.nodes[path[-1]].depends]
+            if not depends:
+                break
+            path.append(max(depends, key=lambda result: result.end).name)
+        return path[::-1]
+
+    def get_timings(self) -> typing.List[typing.Tuple[str, float, float, float]]:
+        """Returns (name, wait, start, duration) of every node that ran, relative to the start of the dag, in seconds
+
+        WAIT is the time a node was ready, its dependencies done, before it started.
+        """
+        return [(result.name, result.start - result.ready, result.start - self._start, result.end - result.start)
+                for result in sorted(self.results.values(), key=lambda result: result.start or 0.0)
+                if result.start is not None and result.end is not None]
+
+    def report(self) -> str:
+        lines = ["{:<30} {:>9} {:>9} {:>9} {}".format("node", "wait", "start", "duration", "status")]
+        for name, wait, start, duration in self.get_timings():
+            lines.append("{:<30} {:>8.3f}s {:>8.3f}s {:>8.3f}s {}".format(name, wait, start, duration, self.results[name].status))
+        for result in self.results.values():
+            if result.end is None:
+                lines.append("{:<30} {:>9} {:>9} {:>9} {}".format(result.name, "", "", "", result.status))
+        lines.append("critical path: {} ({:.3f}s total)".format(" -> ".join(self.get_critical_path()), self.duration))
+        return "\n".join(lines)
+
+
+async def execute_dag(dag: Dag,
+                      run: typing.Callable[[DagNode, dict], typing.Awaitable[typing.Tuple[str, str]]],
+                      context: typing.Optional[dict] = None,
+                      concurrency: typing.Optional[int] = None,
+                      keep_going: bool = True) -> DagResult:
+    """Execute every node of DAG with RUN(node, context) once its dependencies are done, see Shell.execute_dag()"""
+    assert concurrency is None or (isinstance(concurrency, int) and concurrency > 0), concurrency
+    children = collections.defaultdict(list)
+    remaining = {}
+    for node in dag.nodes.values():
+        remaining[node.name] = len(node.depends)
+        for dependency in node.depends:
+            children[dependency].append(node.name)
+
+    start = time.monotonic()
+    results = {}
+    outputs = {}
+    ready = collections.deque((name, start) for name, count in remaining.items() if not count)
+    running = {}
+
+    def skip(name: str, status: str):
+        # NAME and everything that depends on it will not run
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            if name not in results:
+                results[name] = NodeResult(name, status, None, None, None, None, None, None)
+                pending.extend(children[name])
+
+    async def execute(node: DagNode, ready_time: float):
+        node_context = dict(context or {})
+        for ancestor in dag.get_ancestors(node.name):
+            if ancestor in outputs:
+                node_context[outputs[ancestor][0]] = outputs[ancestor][1]
+        node_start = time.monotonic()
+        try:
+            stdout, stderr = await run(node, node_context)
+        except Exception as error:
+            return NodeResult(node.name, FAILED, None, None, error, ready_time, node_start, time.monotonic())
+        return NodeResult(node.name, DONE, stdout, stderr, None, ready_time, node_start, time.monotonic())
+
+    try:
+        while ready or running:
+            while ready and (concurrency is None or len(running) < concurrency):
+                name, ready_time = ready.popleft()
+                running[asyncio.ensure_future(execute(dag.nodes[name], ready_time))] = name
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            failed = False
+            for task in done:
+                name = running.pop(task)
+                result = results[name] = task.result()
+                logger.debug("Node [%s] %s after %.3fs", name, result.status, result.end - result.start)
+                if result.status == DONE:
+                    node = dag.nodes[name]
+                    if node.output is not None and isinstance(result.stdout, str):
+                        outputs[name] = (node.output, result.stdout.rstrip("\n"))
+                    for child in children[name]:
+                        remaining[child] -= 1
+                        if not remaining[child] and child not in results:
+                            ready.append((child, result.end))
+                else:
+                    failed = True
+                    for child in children[name]:
+                        skip(child, SKIPPED)
+
+            if failed and not keep_going:
+                break
+
+    finally:
+        # cancelling a node terminates its process group
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    # whatever did not run, or was still running after a failure with KEEP_GOING False, was cancelled
+    for name in dag.nodes:
+        skip(name, CANCELLED)
+    return DagResult(dag, collections.OrderedDict((name, results[name]) for name in dag.nodes), start, time.monotonic())
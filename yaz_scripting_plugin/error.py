@@ -1,15 +1,27 @@
-from typing import Optional
+from typing import Any, Dict, List, Optional
+
+
+def _tail(output: Optional[bytes], limit: Optional[int]) -> Optional[bytes]:
+    # the last LIMIT bytes of OUTPUT, None keeps everything
+    if output is None or limit is None or len(output) <= limit:
+        return output
+    return output[-limit:]
 
 
 class InvalidReturnCodeError(RuntimeError):
+    # only the last OUTPUT_LIMIT bytes of stdout and stderr are kept, None keeps everything
+    output_limit = 64 * 1024
+
     def __init__(self, return_code: int, stdout: Optional[bytes] = None, stderr: Optional[bytes] = None):
         assert isinstance(return_code, int), type(return_code)
         assert stdout is None or isinstance(stdout, bytes), type(stdout)
         assert stderr is None or isinstance(stderr, bytes), type(stderr)
         super().__init__("Invalid return code {}".format(return_code))
         self.return_code = return_code
-        self.stdout = stdout
-        self.stderr = stderr
+        self.stdout_size = None if stdout is None else len(stdout)
+        self.stderr_size = None if stderr is None else len(stderr)
+        self.stdout = _tail(stdout, self.output_limit)
+        self.stderr = _tail(stderr, self.output_limit)
 
     def get_return_code(self) -> int:
         return self.return_code
@@ -19,3 +31,90 @@ class InvalidReturnCodeError(RuntimeError):
 
     def get_stderr(self) -> Optional[bytes]:
         return self.stderr
+
+
+class PipelineError(InvalidReturnCodeError):
+    """A stage of a pipeline ended with an invalid return code
+
+    STAGE is the index of the first failing stage, RETURN_CODES those of every stage.
+    """
+
+    def __init__(self, return_codes: List[int], stage: int, stdout: Optional[bytes] = None, stderr: Optional[bytes] = None):
+        assert isinstance(return_codes, list), type(return_codes)
+        assert isinstance(stage, int), type(stage)
+        super().__init__(return_codes[stage], stdout, stderr)
+        self.args = ("Invalid return code {} of stage {}, return codes {}".format(return_codes[stage], stage, return_codes),)
+        self.return_codes = return_codes
+        self.stage = stage
+
+    def get_return_codes(self) -> List[int]:
+        return self.return_codes
+
+    def get_stage(self) -> int:
+        return self.stage
+
+
+class ProcessTimeoutError(RuntimeError):
+    """The process did not finish within TIMEOUT seconds and was terminated
+
+    STDOUT and STDERR contain the output received before the timeout, bounded
+    by InvalidReturnCodeError.OUTPUT_LIMIT.
+    """
+
+    def __init__(self, cmd: str, timeout: float, stdout: Optional[bytes] = None, stderr: Optional[bytes] = None):
+        assert isinstance(cmd, str), type(cmd)
+        assert stdout is None or isinstance(stdout, bytes), type(stdout)
+        assert stderr is None or isinstance(stderr, bytes), type(stderr)
+        super().__init__("Process [{}] did not finish within {}s".format(cmd, timeout))
+        self.cmd = cmd
+        self.timeout = timeout
+        self.stdout = _tail(stdout, InvalidReturnCodeError.output_limit)
+        self.stderr = _tail(stderr, InvalidReturnCodeError.output_limit)
+
+    def get_stdout(self) -> Optional[bytes]:
+        return self.stdout
+
+    def get_stderr(self) -> Optional[bytes]:
+        return self.stderr
+
+
+class BatchError(RuntimeError):
+    """One or more commands of a batch failed
+
+    ERRORS maps the index of every failed command to its exception.  RESULTS
+    contains the result of every command, with None for the failed ones, or is
+    None when the results were already yielded one by one.
+    """
+
+    def __init__(self, results: Optional[List[Any]], errors: Dict[int, Exception]):
+        assert results is None or isinstance(results, list), type(results)
+        assert isinstance(errors, dict) and errors, errors
+        super().__init__("{} command(s) failed: {}".format(len(errors), ", ".join("#{} {}".format(index, error) for index, error in sorted(errors.items())[:10])))
+        self.results = results
+        self.errors = errors
+
+    def get_results(self) -> Optional[List[Any]]:
+        return self.results
+
+    def get_errors(self) -> Dict[int, Exception]:
+        return self.errors
+
+
+class DagError(RuntimeError):
+    """One or more nodes of a Dag failed
+
+    RESULT is the DagResult with the NodeResult of every node, ERRORS maps the
+    name of every failed node to its exception.
+    """
+
+    def __init__(self, result: Any, errors: Dict[str, Exception]):
+        assert isinstance(errors, dict) and errors, errors
+        super().__init__("{} node(s) failed: {}".format(len(errors), ", ".join("{} {}".format(name, error) for name, error in list(errors.items())[:10])))
+        self.result = result
+        self.errors = errors
+
+    def get_result(self) -> Any:
+        return self.result
+
+    def get_errors(self) -> Dict[str, Exception]:
+        return self.errors
@@ -0,0 +1,134 @@
+"""Hedged and retried execution of idempotent calls."""
+
+import asyncio
+import collections
+import itertools
+import random
+import time
+import typing
+
+from .error import InvalidReturnCodeError
+from .log import logger
+
+__all__ = ["HedgePolicy", "RetryPolicy", "Hedger", "HedgeInfo"]
+
+HedgeInfo = collections.namedtuple("HedgeInfo", ["calls", "hedges", "hedge_wins", "retries", "retry_successes"])
+
+
+class HedgePolicy(collections.namedtuple("HedgePolicy", ["delay", "percentile", "min_samples"], defaults=(None, 95, 20))):
+    """Start a duplicate of a call that did not finish within DELAY seconds, and use whichever finishes first
+
+    Without DELAY, the PERCENTILE of the latencies of earlier calls of the
+    same command template is used, once MIN_SAMPLES of them are known.
+    """
+
+    __slots__ = ()
+
+
+class RetryPolicy(collections.namedtuple("RetryPolicy", ["return_codes", "attempts", "backoff", "max_backoff"], defaults=(3, 0.1, 5.0))):
+    """Retry a call that raised InvalidReturnCodeError with one of RETURN_CODES, at most ATTEMPTS times in total
+
+    The delay before the Nth retry is BACKOFF * 2 ** N seconds, at most
+    MAX_BACKOFF, multiplied by a random factor between 0.5 and 1 so that
+    concurrent retries spread out.
+    """
+
+    __slots__ = ()
+
+    def get_backoff(self, retry: int) -> float:
+        return min(self.max_backoff, self.backoff * 2 ** retry) * random.uniform(0.5, 1.0)
+
+
+class Hedger:
+    """Runs calls according to a HedgePolicy and a RetryPolicy, and learns the latency of every key
+
+    At most HISTORY_SIZE latencies are kept per key, see info() for how often
+    hedging and retrying helped.
+    """
+
+    def __init__(self, history_size: int = 100):
+        self.history_size = history_size
+        self._history = {}
+        self._calls = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+        self._retries = 0
+        self._retry_successes = 0
+
+    def info(self) -> HedgeInfo:
+        return HedgeInfo(self._calls, self._hedges, self._hedge_wins, self._retries, self._retry_successes)
+
+    def get_delay(self, key: str, policy: HedgePolicy) -> typing.Optional[float]:
+        """Returns the seconds after which a call for KEY is hedged, or None when too little is known"""
+        if policy.delay is not None:
+            return policy.delay
+        history = self._history.get(key)
+        if history is None or len(history) < policy.min_samples:
+            return None
+        latencies = sorted(history)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * policy.percentile / 100))]
+
+    def record(self, key: str, latency: float):
+        history = self._history.get(key)
+        if history is None:
+            history = self._history[key] = collections.deque(maxlen=self.history_size)
+        history.append(latency)
+
+    async def run(self,
+                  key: str,
+                  call: typing.Callable[[], typing.Awaitable],
+                  hedge: typing.Optional[HedgePolicy] = None,
+                  retry: typing.Optional[RetryPolicy] = None):
+        """Returns the result of CALL(), which may be called more than once, so it must be idempotent"""
+        self._calls += 1
+        for attempt in itertools.count(1):
+            try:
+                result = await self._hedged(key, call, hedge)
+            except InvalidReturnCodeError as error:
+                if retry is None or error.return_code not in retry.return_codes or attempt >= retry.attempts:
+                    raise
+                backoff = retry.get_backoff(attempt - 1)
+                logger.debug("Retry [%s] in %.3fs after exit code %d", key, backoff, error.return_code)
+                self._retries += 1
+                await asyncio.sleep(backoff)
+            else:
+                if attempt > 1:
+                    self._retry_successes += 1
+                return result
+
+    async def _hedged(self, key: str, call: typing.Callable[[], typing.Awaitable], hedge: typing.Optional[HedgePolicy]):
+        delay = None if hedge is None else self.get_delay(key, hedge)
+        tasks = [asyncio.ensure_future(self._timed(key, call))]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    logger.debug("Hedge [%s] after %.3fs", key, delay)
+                    self._hedges += 1
+                    tasks.append(asyncio.ensure_future(self._timed(key, call)))
+
+            # the first call that succeeds wins, an error only counts when every call failed
+            pending, errors = set(tasks), []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self._hedge_wins += 1
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+
+        finally:
+            # cancelling a call terminates the process group of the loser
+            losers = [task for task in tasks if not task.done()]
+            for task in losers:
+                task.cancel()
+            if losers:
+                await asyncio.gather(*losers, return_exceptions=True)
+
+    async def _timed(self, key: str, call: typing.Callable[[], typing.Awaitable]):
+        start = time.monotonic()
+        result = await call()
+        self.record(key, time.monotonic() - start)
+        return result
@@ -0,0 +1,196 @@
+"""Resource limits for processes, and admission of new processes based on the load of the host."""
+
+import asyncio
+import collections
+import functools
+import os
+import platform
+import resource
+import time
+import typing
+
+from .log import logger
+
+__all__ = ["Limits", "AdmissionController", "AdmissionInfo", "get_free_memory", "IONICE_REALTIME", "IONICE_BEST_EFFORT", "IONICE_IDLE"]
+
+# io scheduling classes, see ionice(1)
+IONICE_REALTIME = 1
+IONICE_BEST_EFFORT = 2
+IONICE_IDLE = 3
+
+# there is no libc wrapper for ioprio_set(2), the syscall number depends on the architecture
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314, "ppc64le": 273, "s390x": 282}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+_RLIMITS = (("rlimit_as", "RLIMIT_AS"), ("rlimit_cpu", "RLIMIT_CPU"), ("rlimit_nofile", "RLIMIT_NOFILE"))
+
+AdmissionInfo = collections.namedtuple("AdmissionInfo", ["load", "free_memory", "delayed", "delay_total", "delay_max"])
+
+
+class Limits(collections.namedtuple("Limits", ["nice", "ionice", "cpu_affinity", "rlimit_as", "rlimit_cpu", "rlimit_nofile"],
+                                    defaults=(None, None, None, None, None, None))):
+    """What a process may use, applied in the child after fork() and before exec()
+
+    NICE is added to the niceness of the process.  IONICE is an io scheduling
+    class, i.e. IONICE_IDLE, or a (class, level) tuple.  CPU_AFFINITY is the set
+    of CPUs the process may run on.  RLIMIT_AS (bytes), RLIMIT_CPU (seconds) and
+    RLIMIT_NOFILE set both the soft and the hard limit, but never raise the
+    hard limit of this process.  None leaves a setting as it is.
+
+    For example:
+    - await shell.get("xz -9 dump.sql", limits=Limits(nice=19, ionice=IONICE_IDLE, cpu_affinity={2, 3}))
+    """
+
+    __slots__ = ()
+
+    def merge(self, limits: typing.Optional["Limits"]) -> "Limits":
+        """Returns these limits overridden by the settings of LIMITS that are not None"""
+        if limits is None:
+            return self
+        return Limits(*[value if override is None else override for value, override in zip(self, limits)])
+
+    def is_empty(self) -> bool:
+        return all(value is None for value in self)
+
+    def get_preexec(self) -> typing.Optional[typing.Callable[[], None]]:
+        """Returns the function that applies these limits in the child, or None when there is nothing to apply
+
+        Using preexec_fn prevents the faster posix_spawn() and vfork() paths
+        of subprocess, only processes with limits pay for that.
+        """
+        if self.is_empty():
+            return None
+
+        # everything that may fail or allocate is prepared in the parent
+        ioprio = None
+        if self.ionice is not None:
+            io_class, level = (self.ionice, 0) if isinstance(self.ionice, int) else self.ionice
+            assert io_class in (IONICE_REALTIME, IONICE_BEST_EFFORT, IONICE_IDLE), io_class
+            ioprio = (io_class << _IOPRIO_CLASS_SHIFT) | level
+            ioprio_set, get_errno = _get_ioprio_set()
+        rlimits = []
+        for field, name in _RLIMITS:
+            value = getattr(self, field)
+            if value is not None:
+                limit = getattr(resource, name)
+                _, hard = resource.getrlimit(limit)
+                value = value if hard == resource.RLIM_INFINITY else min(value, hard)
+                rlimits.append((limit, value))
+        nice, cpu_affinity = self.nice, None if self.cpu_affinity is None else set(self.cpu_affinity)
+
+        def preexec():
+            if nice is not None:
+                os.nice(nice)
+            if ioprio is not None and ioprio_set(_IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+                raise OSError(get_errno(), "ioprio_set failed")
+            if cpu_affinity is not None:
+                os.sched_setaffinity(0, cpu_affinity)
+            for limit, value in rlimits:
+                resource.setrlimit(limit, (value, value))
+
+        return preexec
+
+
+def _get_ioprio_set() -> typing.Tuple[typing.Callable[[int, int, int], int], typing.Callable[[], int]]:
+    # returns (ioprio_set, get_errno), ctypes is only imported when ionice is used
+    if platform.machine() not in _IOPRIO_SET:
+        raise NotImplementedError("ionice is not supported on {}".format(platform.machine()))
+    import ctypes
+    import ctypes.util
+    return functools.partial(ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).syscall, _IOPRIO_SET[platform.machine()]), ctypes.get_errno
+
+
+def get_free_memory() -> typing.Optional[int]:
+    """Returns the number of bytes that can be allocated without swapping, or None when unknown"""
+    try:
+        with open("/proc/meminfo", "rb") as file:
+            for line in file:
+                if line.startswith(b"MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+
+class AdmissionController:
+    """Delays the launch of new processes while the host is under pressure
+
+    The host is under pressure while the 1-minute load average per CPU exceeds
+    MAX_LOAD, or while less than MIN_FREE_MEMORY bytes are available.  Either
+    check is skipped when None.  The host is sampled at most once every
+    INTERVAL seconds, waiting launches check again with a backoff of up to
+    MAX_INTERVAL seconds.  After MAX_DELAY seconds a launch is admitted
+    regardless, so that work never stalls completely.
+    """
+
+    def __init__(self,
+                 max_load: typing.Optional[float] = None,
+                 min_free_memory: typing.Optional[int] = None,
+                 interval: float = 0.5,
+                 max_interval: float = 5.0,
+                 max_delay: typing.Optional[float] = 300.0):
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.interval = interval
+        self.max_interval = max_interval
+        self.max_delay = max_delay
+        self._cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        self._sampled = None
+        self._load = None
+        self._free_memory = None
+        self._delayed = 0
+        self._delay_total = 0.0
+        self._delay_max = 0.0
+
+    def is_enabled(self) -> bool:
+        return self.max_load is not None or self.min_free_memory is not None
+
+    def info(self) -> AdmissionInfo:
+        return AdmissionInfo(self._load, self._free_memory, self._delayed, self._delay_total, self._delay_max)
+
+    async def wait(self):
+        """Returns once the host is not under pressure, or after MAX_DELAY seconds"""
+        if not self.is_enabled():
+            return
+        pressure = self._get_pressure()
+        if pressure is None:
+            return
+
+        logger.debug("Delay process launch, %s", pressure)
+        start = time.monotonic()
+        interval = self.interval
+        while pressure is not None:
+            delay = time.monotonic() - start
+            if self.max_delay is not None and delay >= self.max_delay:
+                logger.warning("Launch process after a delay of %.0fs, %s", delay, pressure)
+                break
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.max_interval)
+            pressure = self._get_pressure()
+
+        delay = time.monotonic() - start
+        self._delayed += 1
+        self._delay_total += delay
+        self._delay_max = max(self._delay_max, delay)
+
+    def _sample(self) -> (typing.Optional[float], typing.Optional[int]):
+        # returns the load average per CPU and the free memory
+        load = os.getloadavg()[0] / self._cpus if self.max_load is not None else None
+        free_memory = get_free_memory() if self.min_free_memory is not None else None
+        return load, free_memory
+
+    def _get_pressure(self) -> typing.Optional[str]:
+        now = time.monotonic()
+        if self._sampled is None or now - self._sampled >= self.interval:
+            self._sampled = now
+            self._load, self._free_memory = self._sample()
+
+        if self._load is not None and self._load > self.max_load:
+            return "load {:.2f} per CPU exceeds {}".format(self._load, self.max_load)
+        if self._free_memory is not None and self._free_memory < self.min_free_memory:
+            return "{} bytes of free memory is less than {}".format(self._free_memory, self.min_free_memory)
+        return None
@@ -1,8 +1,102 @@
 """Logging configuration."""
 
+import atexit
+import hashlib
+import json
 import logging
+import logging.handlers
+import queue
+import typing
 
-__all__ = ["logger", "set_verbose"]
+__all__ = ["logger", "set_verbose", "log_command", "StructuredFormatter", "start_queue_logging", "stop_queue_logging"]
 
 # Name the logger after the package.
 logger = logging.getLogger(__package__)
+
+# number of characters of input that are logged, longer input is logged by its size and digest
+input_preview = 64
+
+_listener = None
+
+
+def set_verbose(verbose: bool = True):
+    """Log every process that is started and how it ended, instead of only the commands"""
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+
+def log_command(level: int, message: str, cmd: str, input: typing.Any = None, **fields):
+    """Log MESSAGE, formatted with CMD and FIELDS, and attach them to the record as record.command
+
+    Nothing is built unless LEVEL is enabled.  INPUT is logged by its size,
+    and, when longer than INPUT_PREVIEW, only its start and its sha256 digest.
+    Streamed input, see open_input(), is logged by its type only.
+
+    For example:
+    - log_command(logging.DEBUG, "Process [{cmd}] ended with exit code {return_code}", cmd, return_code=0, duration=0.1)
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    command = dict(cmd=cmd)
+    text = message.format(cmd=cmd, **fields)
+    if input is not None and not isinstance(input, (str, bytes, bytearray, memoryview)):
+        command["input_type"] = type(input).__name__
+        text += " with streamed input"
+    elif input is not None:
+        command["input_size"] = len(input)
+        if len(input) > input_preview:
+            command["input_sha256"] = hashlib.sha256(input.encode() if isinstance(input, str) else input).hexdigest()
+        preview = input[:input_preview]
+        command["input_preview"] = preview if isinstance(preview, str) else bytes(preview).decode(errors="replace")
+        text += " with {} bytes of input".format(len(input))
+    command.update(fields)
+    logger.log(level, text, extra=dict(command=command))
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats a record as a single line of JSON, including the fields of log_command()"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        document = dict(time=record.created, level=record.levelname, logger=record.name, message=record.getMessage())
+        document.update(getattr(record, "command", {}))
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+def start_queue_logging(*handlers: logging.Handler) -> logging.handlers.QueueListener:
+    """Hand the records of the package logger to HANDLERS on a background thread
+
+    HANDLERS default to those of the package logger, or otherwise those of the
+    root logger or logging.lastResort, so that slow handlers, i.e. writing to disk, never block the
+    event loop.  The records no longer propagate to the root logger.
+    """
+    global _listener
+    stop_queue_logging()
+    handlers = handlers or tuple(logger.handlers) or tuple(logging.getLogger().handlers) or (logging.lastResort,)
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.propagate = False
+    _listener.start()
+    return _listener
+
+
+def stop_queue_logging():
+    """Write the queued records and hand them directly to the handlers again"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for handler in _listener.handlers:
+        if handler not in logging.getLogger().handlers:
+            logger.addHandler(handler)
+    logger.propagate = True
+    _listener = None
+
+
+atexit.register(stop_queue_logging)
@@ -0,0 +1,205 @@
+"""Memoization of the results of idempotent commands."""
+
+import asyncio
+import collections
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import typing
+
+from .log import logger
+
+__all__ = ["ResultCache", "DiskBackend", "ResultCacheInfo"]
+
+ResultCacheInfo = collections.namedtuple("ResultCacheInfo", ["hits", "misses", "shared", "evictions", "entries", "bytes"])
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def get_size(result) -> int:
+    """Returns the approximate number of bytes used by RESULT, a tuple of str, bytes or None"""
+    return sum(len(value) for value in result if value is not None)
+
+
+class DiskBackend:
+    """Stores results in PATH, one file per result, grouped in a directory per scope"""
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+
+    def _get_path(self, scope: str, key: str = None) -> str:
+        if key is None:
+            return os.path.join(self.path, _digest(scope))
+        return os.path.join(self.path, _digest(scope), _digest(key))
+
+    def get(self, scope: str, key: str) -> typing.Optional[typing.Tuple[float, typing.Any]]:
+        """Returns (expires, result), or None when there is no readable entry for KEY"""
+        path = self._get_path(scope, key)
+        try:
+            with open(path, "rb") as file:
+                entry = pickle.load(file)
+        except OSError:
+            return None
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError, ValueError) as error:
+            # truncated by a crash, or written by a different version, remove it like an expired entry
+            logger.debug("Remove unreadable cache entry %s: %r", path, error)
+            entry = None
+        if isinstance(entry, tuple) and len(entry) == 2:
+            return entry
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    def put(self, scope: str, key: str, expires: float, result):
+        directory = self._get_path(scope)
+        os.makedirs(directory, exist_ok=True)
+        # write atomically, concurrent yaz invocations may read the same file
+        handle, path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "wb") as file:
+            pickle.dump((expires, result), file)
+        os.replace(path, self._get_path(scope, key))
+
+    def invalidate(self, scope: typing.Optional[str] = None):
+        shutil.rmtree(self.path if scope is None else self._get_path(scope), ignore_errors=True)
+
+
+class ResultCache:
+    """Least recently used cache of command results
+
+    Results are keyed on a caller supplied scope and a key, typically the
+    rendered command and input.  At most MAX_ENTRIES results, and at most
+    MAX_BYTES bytes of output, are kept in memory.  A result expires after
+    TTL seconds, or never when TTL is None.  When BACKEND is given, results
+    are also stored there and survive the current process.
+
+    Concurrent lookups for the same missing key share a single execution.
+    """
+
+    def __init__(self,
+                 max_entries: int = 1024,
+                 max_bytes: int = 16 * 1024 * 1024,
+                 ttl: typing.Optional[float] = None,
+                 backend: typing.Optional[DiskBackend] = None):
+        assert isinstance(max_entries, int) and max_entries > 0, max_entries
+        assert isinstance(max_bytes, int) and max_bytes > 0, max_bytes
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._in_flight = {}
+
+    def info(self) -> ResultCacheInfo:
+        return ResultCacheInfo(self.hits, self.misses, self.shared, self.evictions, len(self._entries), self._bytes)
+
+    async def get_or_run(self,
+                         scope: str,
+                         key: str,
+                         run: typing.Callable[[], typing.Awaitable[typing.Any]],
+                         ttl: typing.Optional[float] = None):
+        """Returns the cached result for (SCOPE, KEY), or awaits RUN() and caches its result"""
+        while True:
+            result = self.get(scope, key)
+            if result is not None:
+                self.hits += 1
+                return result
+
+            future = self._in_flight.get((scope, key))
+            if future is None:
+                break
+
+            self.shared += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the shared execution was cancelled, not this caller, try again
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[(scope, key)] = future
+        try:
+            result = await run()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            # failures are not cached, but every waiting caller receives them
+            future.set_exception(error)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            self.put(scope, key, result, ttl)
+            return result
+        finally:
+            del self._in_flight[(scope, key)]
+
+    def get(self, scope: str, key: str):
+        entry = self._entries.get((scope, key))
+        if entry is None and self.backend is not None:
+            entry = self.backend.get(scope, key)
+            if entry is not None:
+                self._store((scope, key), *entry)
+
+        if entry is None:
+            return None
+
+        expires, result = entry
+        if expires is not None and expires < time.time():
+            self._remove((scope, key))
+            return None
+
+        if (scope, key) in self._entries:
+            self._entries.move_to_end((scope, key))
+        return result
+
+    def put(self, scope: str, key: str, result, ttl: typing.Optional[float] = None):
+        if not all(value is None or isinstance(value, (str, bytes)) for value in result):
+            # i.e. a SpilledOutput, which is too large to cache anyway
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        if self._store((scope, key), expires, result) and self.backend is not None:
+            self.backend.put(scope, key, expires, result)
+
+    def invalidate(self, scope: typing.Optional[str] = None):
+        """Forget every result in SCOPE, or every result when SCOPE is None"""
+        logger.debug("Invalidate cached results for scope %s", "<all>" if scope is None else scope)
+        for entry_key in [entry_key for entry_key in self._entries if scope is None or entry_key[0] == scope]:
+            self._remove(entry_key)
+        if self.backend is not None:
+            self.backend.invalidate(scope)
+
+    def _store(self, entry_key, expires, result) -> bool:
+        size = get_size(result)
+        if size > self.max_bytes:
+            return False
+
+        self._remove(entry_key)
+        self._entries[entry_key] = (expires, result)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            evicted_key = next(iter(self._entries))
+            self._remove(evicted_key)
+            self.evictions += 1
+        return True
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._bytes -= get_size(entry[1])
@@ -0,0 +1,150 @@
+"""Per-command metrics."""
+
+import json
+import os
+import tempfile
+import time
+import typing
+
+from .log import logger
+
+__all__ = ["CommandMetrics", "MetricsRegistry"]
+
+
+def get_program(cmd: str) -> str:
+    """Returns the name of the program CMD starts, used to aggregate metrics without one entry per command line"""
+    words = cmd.split(None, 1)
+    return os.path.basename(words[0]) if words else ""
+
+
+class CommandMetrics:
+    """What a single command cost
+
+    Times are in seconds.  CPU time and memory are not recorded: the resource
+    usage of the children of this process can not be told apart per child
+    while other processes run or end at the same time.
+    """
+
+    __slots__ = ("cmd", "kind", "program", "render_time", "spawn_time", "wall_time", "bytes_in", "bytes_out", "return_code",
+                 "error", "_registry", "_start")
+
+    def __init__(self, registry: "MetricsRegistry", cmd: str, kind: str, render_time: float = 0.0):
+        self.cmd = cmd
+        self.kind = kind
+        self.program = get_program(cmd)
+        self.render_time = render_time
+        self.spawn_time = None
+        self.wall_time = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.return_code = None
+        self.error = None
+        self._registry = registry
+        self._start = None
+
+    def __enter__(self):
+        if self._registry.enabled:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self._registry.enabled:
+            return
+        self.wall_time = time.perf_counter() - self._start
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self._registry._exit(self)
+
+    def __repr__(self):
+        return "<CommandMetrics {} {:.3f}s>".format(self.cmd, self.wall_time or 0.0)
+
+    def spawned(self):
+        """Marks that the process started"""
+        if self._start is not None:
+            self.spawn_time = time.perf_counter() - self._start
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith("_")}
+
+
+class MetricsRegistry:
+    """Aggregates CommandMetrics per program, and passes each of them to the subscribed hooks
+
+    For example:
+    - shell.metrics.subscribe(lambda metrics: print(metrics.as_dict()))
+    - shell.metrics.write_prometheus("/var/lib/node_exporter/yaz.prom")
+    """
+
+    # aggregate field, prometheus metric name, prometheus type, help
+    fields = (
+        ("count", "yaz_shell_commands_total", "counter", "Number of commands"),
+        ("errors", "yaz_shell_command_errors_total", "counter", "Number of commands that raised an error"),
+        ("render_time", "yaz_shell_command_render_seconds_total", "counter", "Time spent rendering command templates"),
+        ("spawn_time", "yaz_shell_command_spawn_seconds_total", "counter", "Time spent starting processes"),
+        ("wall_time", "yaz_shell_command_seconds_total", "counter", "Time spent running commands"),
+        ("bytes_in", "yaz_shell_command_input_bytes_total", "counter", "Bytes written to the processes"),
+        ("bytes_out", "yaz_shell_command_output_bytes_total", "counter", "Bytes read from the processes"),
+    )
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._hooks = []
+        self._aggregates = {}
+
+    def measure(self, cmd: str, kind: str, render_time: float = 0.0) -> CommandMetrics:
+        """Returns a context manager that measures the command CMD, started by KIND, i.e. get"""
+        return CommandMetrics(self, cmd, kind, render_time)
+
+    def subscribe(self, hook: typing.Callable[[CommandMetrics], None]):
+        """Call HOOK with the CommandMetrics of every command that finishes"""
+        self._hooks.append(hook)
+
+    def unsubscribe(self, hook: typing.Callable[[CommandMetrics], None]):
+        self._hooks.remove(hook)
+
+    def clear(self):
+        self._aggregates = {}
+
+    def snapshot(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """Returns the aggregates per program"""
+        return {program: dict(aggregate) for program, aggregate in self._aggregates.items()}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self) -> str:
+        """Returns the aggregates in the Prometheus text exposition format"""
+        lines = []
+        for field, name, kind, description in self.fields:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for program, aggregate in sorted(self._aggregates.items()):
+                label = program.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+                lines.append("{}{{program=\"{}\"}} {}".format(name, label, repr(float(aggregate[field]))))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Write the aggregates to PATH for the textfile collector of the node exporter"""
+        # write atomically, the collector may read the file at any moment
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(handle, "w") as file:
+            file.write(self.to_prometheus())
+        os.replace(temporary_path, path)
+
+    def _exit(self, metrics: CommandMetrics):
+        aggregate = self._aggregates.get(metrics.program)
+        if aggregate is None:
+            aggregate = self._aggregates[metrics.program] = {field: 0 for field, *_ in self.fields}
+        aggregate["count"] += 1
+        aggregate["errors"] += metrics.error is not None
+        aggregate["render_time"] += metrics.render_time
+        aggregate["spawn_time"] += metrics.spawn_time or 0.0
+        aggregate["wall_time"] += metrics.wall_time
+        aggregate["bytes_in"] += metrics.bytes_in
+        aggregate["bytes_out"] += metrics.bytes_out
+
+        for hook in self._hooks:
+            try:
+                hook(metrics)
+            except Exception:
+                logger.exception("Metrics hook %r failed", hook)
@@ -0,0 +1,218 @@
+"""Incremental parsers that turn chunks of process output into records."""
+
+import array
+import codecs
+import csv
+import json
+import re
+import typing
+
+__all__ = ["Parser", "JsonLinesParser", "SplitParser", "CsvParser", "RegexParser", "Columns"]
+
+
+class Parser:
+    """Splits chunks of output on SEPARATOR and parses every complete record
+
+    feed() returns the records completed by a chunk, close() those that
+    remain once the output ended.  Only the incomplete record at the end of
+    a chunk is kept between calls, the output is never held as a whole.
+    """
+
+    separator = b"\n"
+
+    def __init__(self):
+        self.records = 0
+        # the chunks of the incomplete record, only joined once it ends
+        self._rest = []
+
+    def feed(self, chunk: bytes) -> list:
+        if not self._ends_record(chunk):
+            if chunk:
+                self._rest.append(chunk)
+            return []
+        data = b"".join(self._rest + [chunk]) if self._rest else chunk
+        end = data.rfind(self.separator)
+        rest = data[end + len(self.separator):]
+        self._rest = [rest] if rest else []
+        records = self._parse(data[:end].split(self.separator))
+        self.records += len(records)
+        return records
+
+    def close(self) -> list:
+        rest, self._rest = b"".join(self._rest), []
+        records = self._parse([rest]) if rest else []
+        self.records += len(records)
+        return records
+
+    def _ends_record(self, chunk: bytes) -> bool:
+        if self.separator in chunk:
+            return True
+        # a separator of several bytes may start in the chunks before, each of which holds at least a byte
+        overlap = len(self.separator) - 1
+        if not overlap or not self._rest:
+            return False
+        return self.separator in b"".join(self._rest[-overlap:])[-overlap:] + chunk[:overlap]
+
+    def _parse(self, items: typing.List[bytes]) -> list:
+        raise NotImplementedError
+
+
+class JsonLinesParser(Parser):
+    """Parses a JSON document per line, empty lines are skipped"""
+
+    def _parse(self, items: typing.List[bytes]) -> list:
+        return [json.loads(item) for item in items if item.strip()]
+
+
+class SplitParser(Parser):
+    """Splits on SEPARATOR, i.e. b"\\0" for find -print0, and decodes every record, or keeps bytes when ENCODING is None
+
+    Undecodable bytes are kept as surrogates, see "surrogateescape", so that
+    file names round trip.
+    """
+
+    def __init__(self, separator: bytes = b"\0", encoding: typing.Optional[str] = "utf-8"):
+        assert isinstance(separator, bytes) and separator, separator
+        super().__init__()
+        self.separator = separator
+        self.encoding = encoding
+
+    def _parse(self, items: typing.List[bytes]) -> list:
+        if self.encoding is None:
+            return items
+        return [item.decode(self.encoding, "surrogateescape") for item in items]
+
+
+class RegexParser(Parser):
+    """Matches PATTERN against the start of every line
+
+    A record is the dict of the named groups of a match, or the tuple of its
+    groups when there are none.  Lines that do not match are counted in SKIPPED.
+
+    For example:
+    - RegexParser(r"(?P<mode>\\S+) +\\d+ (?P<owner>\\S+)")
+    """
+
+    def __init__(self, pattern: typing.Union[str, typing.Pattern], separator: bytes = b"\n", encoding: str = "utf-8"):
+        super().__init__()
+        self.pattern = re.compile(pattern)
+        self.separator = separator
+        self.encoding = encoding
+        self.skipped = 0
+
+    def _parse(self, items: typing.List[bytes]) -> list:
+        match = self.pattern.match
+        named = bool(self.pattern.groupindex)
+        records = []
+        for item in items:
+            result = match(item.decode(self.encoding, "replace"))
+            if result is None:
+                self.skipped += 1
+            else:
+                records.append(result.groupdict() if named else result.groups())
+        return records
+
+
+class CsvParser:
+    """Parses CSV, or TSV with DELIMITER="\\t", with the csv module
+
+    When HEADER is True, the first row provides the FIELDNAMES and the records
+    are dicts, otherwise they are lists.  Quoted fields may contain line breaks.
+    FMTPARAMS are passed to csv.reader().
+    """
+
+    def __init__(self, header: bool = True, encoding: str = "utf-8", delimiter: str = ",", **fmtparams):
+        self.header = header
+        self.fieldnames = None
+        self.records = 0
+        self._fmtparams = dict(fmtparams, delimiter=delimiter)
+        self._quotechar = fmtparams.get("quotechar", '"')
+        self._decoder = codecs.getincrementaldecoder(encoding)("replace")
+        # the text of the incomplete record, only joined once it ends, and whether it ends inside quotes
+        self._pending = []
+        self._quoted = False
+
+    def feed(self, chunk: bytes) -> list:
+        text = self._decoder.decode(chunk)
+        # a record only ends at a line break outside of quotes, only the new text is scanned for one
+        end, offset = -1, 0
+        for line in text.split("\n")[:-1]:
+            if self._quotechar and line.count(self._quotechar) % 2:
+                self._quoted = not self._quoted
+            offset += len(line) + 1
+            if not self._quoted:
+                end = offset
+        rest = text[offset:]
+        if self._quotechar and rest.count(self._quotechar) % 2:
+            self._quoted = not self._quoted
+        if end < 0:
+            if text:
+                self._pending.append(text)
+            return []
+
+        complete = "".join(self._pending) + text[:end - 1]
+        self._pending = [text[end:]] if end < len(text) else []
+        return self._parse([line + "\n" for line in complete.split("\n")])
+
+    def close(self) -> list:
+        pending = "".join(self._pending) + self._decoder.decode(b"", final=True)
+        self._pending, self._quoted = [], False
+        return self._parse([pending]) if pending else []
+
+    def _parse(self, lines: typing.List[str]) -> list:
+        rows = list(csv.reader(lines, **self._fmtparams))
+        if self.header:
+            if self.fieldnames is None and rows:
+                self.fieldnames = rows.pop(0)
+            fieldnames = self.fieldnames
+            rows = [dict(zip(fieldnames, row)) for row in rows]
+        self.records += len(rows)
+        return rows
+
+
+class Columns:
+    """Collects records in a list per field, instead of an object per record
+
+    Records are dicts, keyed by field name, or sequences, keyed by index.  A
+    field that is missing from a record is None.  getvalue() returns the
+    columns, where a column of only ints or only floats becomes an
+    array.array, when TYPED is True.
+    """
+
+    def __init__(self, typed: bool = True):
+        self.typed = typed
+        self.count = 0
+        self._columns = {}
+
+    def append(self, record):
+        items = record.items() if isinstance(record, dict) else enumerate(record)
+        for name, value in items:
+            column = self._columns.get(name)
+            if column is None:
+                column = self._columns[name] = [None] * self.count
+            column.append(value)
+        self.count += 1
+        if len(record) < len(self._columns):
+            for column in self._columns.values():
+                if len(column) < self.count:
+                    column.append(None)
+
+    def extend(self, records: typing.Iterable):
+        for record in records:
+            self.append(record)
+
+    def getvalue(self) -> typing.Dict[typing.Union[str, int], typing.Union[list, array.array]]:
+        if not self.typed:
+            return dict(self._columns)
+        return {name: self._compact(column) for name, column in self._columns.items()}
+
+    @staticmethod
+    def _compact(column: list) -> typing.Union[list, array.array]:
+        if column and all(type(value) is int for value in column):
+            try:
+                return array.array("q", column)
+            except OverflowError:
+                return column
+        if column and all(type(value) is float for value in column):
+            return array.array("d", column)
+        return column
@@ -0,0 +1,57 @@
+"""Processes whose stdout and stdin are connected by OS pipes."""
+
+import asyncio
+import os
+import signal
+import typing
+
+from .process import terminate
+
+__all__ = ["start_pipeline", "terminate_pipeline", "is_valid"]
+
+
+async def start_pipeline(create: typing.Callable[..., typing.Awaitable[asyncio.subprocess.Process]],
+                         stages: typing.List[str],
+                         stdin,
+                         stdout,
+                         stderr) -> typing.List[asyncio.subprocess.Process]:
+    """Start a process for every command in STAGES, each one reading the stdout of the one before it
+
+    CREATE starts a single process, see Shell._create_process().  STDIN is used
+    for the first stage, STDOUT for the last, and STDERR for every stage.  The
+    stages are connected by OS pipes that are never read by us, the data only
+    passes through the kernel.  Every stage leads a process group of its own,
+    a stage can not join the group of another stage in a different session.
+    """
+    assert stages, stages
+    pipes = [os.pipe() for _ in stages[1:]]
+    processes = []
+    try:
+        for index, cmd in enumerate(stages):
+            processes.append(await create(
+                cmd,
+                stdin=stdin if index == 0 else pipes[index - 1][0],
+                stdout=stdout if index == len(stages) - 1 else pipes[index][1],
+                stderr=stderr))
+    except BaseException:
+        await terminate_pipeline(processes, 0.0)
+        raise
+    finally:
+        # the stages hold their own copies, EOF only arrives once ours are closed
+        for read_fd, write_fd in pipes:
+            os.close(read_fd)
+            os.close(write_fd)
+    return processes
+
+
+async def terminate_pipeline(processes: typing.List[asyncio.subprocess.Process], grace: float = 2.0):
+    """Terminate the process groups of PROCESSES at the same time, see terminate()"""
+    await asyncio.gather(*[terminate(process, grace) for process in processes])
+
+
+def is_valid(return_code: int, valid_codes: typing.Tuple[int, ...], last: bool, shell: bool = False) -> bool:
+    # like a shell, a stage that is killed because a later stage stopped reading is not an error,
+    # /bin/sh reports a command it started that was killed by SIGPIPE as 128 + SIGPIPE
+    if return_code in valid_codes:
+        return True
+    return not last and (return_code == -signal.SIGPIPE or (shell and return_code == 128 + signal.SIGPIPE))
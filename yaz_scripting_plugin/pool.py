@@ -0,0 +1,209 @@
+"""Long lived shell processes that execute commands without a fork/exec per call."""
+
+import asyncio
+import collections
+import os
+import shlex
+import signal
+import typing
+import uuid
+
+from .log import logger
+from .process import terminate
+
+__all__ = ["WorkerPool", "WorkerError", "PoolInfo"]
+
+PoolInfo = collections.namedtuple("PoolInfo", ["workers", "idle", "commands", "started", "recycled"])
+
+
+class WorkerError(RuntimeError):
+    """The worker process stopped or violated the framing protocol"""
+
+
+class Worker:
+    """A single /bin/sh process that reads framed commands from its stdin
+
+    Every command is evaluated in a subshell, with /dev/null as its stdin, so
+    that changes to the working directory, variables or options do not leak
+    into the next command.  The subshell changes to the current directory of
+    this process first, like a new process would start in it.  The end of the command output is marked with a
+    random sentinel on both stdout and stderr, the stdout sentinel is followed
+    by the return code.  Output that precedes the start sentinel was written
+    by a background process that outlived an earlier command.
+    """
+
+    read_size = 64 * 1024
+
+    frame = ("printf '%s<\\n' {sentinel}; printf '%s<\\n' {sentinel} >&2\n"
+             "( cd {cwd} && eval {cmd} ) </dev/null\n"
+             "printf '%s>%d\\n' {sentinel} $?; printf '%s>\\n' {sentinel} >&2\n")
+
+    def __init__(self, shell: str):
+        self.shell = shell
+        self.commands = 0
+        self.leaked = False
+        self.process = None
+        self.environ = None
+
+    async def start(self):
+        # the environment is inherited once, a worker is replaced when it changes, see is_current()
+        self.environ = dict(os.environ)
+        self.process = await asyncio.create_subprocess_exec(
+            self.shell,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def is_clean(self) -> bool:
+        """Returns False when output arrived outside of a command frame, i.e. from a leaked background process"""
+        return not self.leaked
+
+    def is_current(self) -> bool:
+        """Returns False when the environment of this process changed since the worker started"""
+        return self.environ == os.environ
+
+    async def execute(self, cmd: str) -> typing.Tuple[int, bytes, bytes]:
+        sentinel = "yaz-{}".format(uuid.uuid4().hex)
+        self.commands += 1
+        frame = self.frame.format(cwd=shlex.quote(os.getcwd()), cmd=shlex.quote(cmd), sentinel=sentinel)
+        self.process.stdin.write(frame.encode(errors="surrogateescape"))
+        try:
+            await self.process.stdin.drain()
+            (stdout, return_code), (stderr, _) = await asyncio.gather(
+                self._read_frame(self.process.stdout, sentinel.encode()),
+                self._read_frame(self.process.stderr, sentinel.encode()))
+        except (BrokenPipeError, ConnectionResetError) as error:
+            raise WorkerError("Worker stopped while executing [{}]".format(cmd)) from error
+
+        return int(return_code), stdout, stderr
+
+    async def _read_frame(self, reader: asyncio.StreamReader, sentinel: bytes) -> typing.Tuple[bytes, bytes]:
+        buffer = bytearray()
+        leak, buffer = await self._read_until(reader, buffer, sentinel + b"<\n")
+        output, buffer = await self._read_until(reader, buffer, sentinel + b">")
+        trailer, buffer = await self._read_until(reader, buffer, b"\n")
+        if leak or buffer:
+            self.leaked = True
+        return output, trailer
+
+    async def _read_until(self, reader: asyncio.StreamReader, buffer: bytearray, marker: bytes) -> typing.Tuple[bytes, bytearray]:
+        offset = 0
+        while True:
+            index = buffer.find(marker, offset)
+            if index != -1:
+                return bytes(buffer[:index]), buffer[index + len(marker):]
+
+            # the marker may be split over two reads
+            offset = max(0, len(buffer) - len(marker) + 1)
+            chunk = await reader.read(self.read_size)
+            if not chunk:
+                raise WorkerError("Worker closed its output before the sentinel was found")
+            buffer.extend(chunk)
+
+    async def stop(self, force: bool = False):
+        """Stop after the current command, or immediately, with everything it started, when FORCE is True"""
+        if self.is_alive() and not force:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 1.0)
+                return
+            except asyncio.TimeoutError:
+                pass
+        if self.process is not None:
+            await terminate(self.process, 0.0)
+
+
+class WorkerPool:
+    """Pool of at most SIZE long lived shell workers
+
+    A worker is replaced after MAX_COMMANDS commands, when it stops, when it
+    produces output while it is idle, or when os.environ changed since it
+    started.  Commands are evaluated with the
+    same shell semantics as asyncio.create_subprocess_shell, but without a
+    fork and exec of SHELL for every command.
+    """
+
+    def __init__(self, size: int = 4, max_commands: int = 1000, shell: str = "/bin/sh"):
+        assert isinstance(size, int) and size > 0, size
+        assert isinstance(max_commands, int) and max_commands > 0, max_commands
+        self.size = size
+        self.max_commands = max_commands
+        self.shell = shell
+        self._loop = None
+        self._workers = []
+        self._idle = []
+        self._available = None
+        self._recycling = set()
+        self._commands = 0
+        self._started = 0
+        self._recycled = 0
+
+    def info(self) -> PoolInfo:
+        return PoolInfo(len(self._workers), len(self._idle), self._commands, self._started, self._recycled)
+
+    async def execute(self, cmd: str) -> typing.Tuple[int, bytes, bytes]:
+        """Execute CMD on an idle worker and return (return_code, stdout, stderr)"""
+        self._check_loop()
+        await self._available.acquire()
+        worker = None
+        try:
+            worker = await self._get_worker()
+            self._commands += 1
+            result = await worker.execute(cmd)
+            self._put_worker(worker)
+            worker = None
+            return result
+        finally:
+            if worker is not None:
+                # the command failed or was cancelled halfway, the framing can no longer be trusted
+                await asyncio.shield(self._recycle(worker, force=True))
+            self._available.release()
+
+    async def close(self):
+        workers, self._workers, self._idle = self._workers, [], []
+        await asyncio.gather(*[worker.stop() for worker in workers], *self._recycling)
+
+    def _check_loop(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # workers are bound to the loop that started them
+            for worker in self._workers:
+                if worker.is_alive():
+                    os.killpg(worker.process.pid, signal.SIGKILL)
+            self._loop = loop
+            self._recycling = set()
+            self._workers = []
+            self._idle = []
+            self._available = asyncio.Semaphore(self.size)
+
+    async def _get_worker(self) -> Worker:
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.is_alive() and worker.is_clean() and worker.is_current():
+                return worker
+            logger.debug("Recycle worker %s after it stopped, leaked output or the environment changed", worker.process.pid)
+            await self._recycle(worker)
+
+        worker = Worker(self.shell)
+        await worker.start()
+        self._workers.append(worker)
+        self._started += 1
+        return worker
+
+    def _put_worker(self, worker: Worker):
+        if worker.commands >= self.max_commands:
+            task = asyncio.ensure_future(self._recycle(worker))
+            self._recycling.add(task)
+            task.add_done_callback(self._recycling.discard)
+        else:
+            self._idle.append(worker)
+
+    async def _recycle(self, worker: Worker, force: bool = False):
+        self._recycled += 1
+        if worker in self._workers:
+            self._workers.remove(worker)
+        await worker.stop(force)
@@ -0,0 +1,66 @@
+"""Termination of a process together with everything it started."""
+
+import asyncio
+import os
+import signal
+import time
+import typing
+
+from .log import logger
+
+__all__ = ["spawn", "terminate"]
+
+poll_interval = 0.01
+
+
+def _kill_group(process: asyncio.subprocess.Process, sig: int):
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        # the group is empty, or the process was not started in a group of its own
+        pass
+
+
+async def terminate(process: asyncio.subprocess.Process, grace: float = 2.0):
+    """Terminate PROCESS and its process group, then wait for it
+
+    The process must be started with start_new_session=True, making it the
+    leader of its own process group.  The group receives SIGTERM, and SIGKILL
+    after GRACE seconds.  Our end of the pipes is closed afterwards, so that
+    no file descriptors leak and the process is reaped even when a member of
+    the group escaped into a group of its own.
+    """
+    if process.returncode is None:
+        logger.debug("Terminate process group %d", process.pid)
+        _kill_group(process, signal.SIGTERM)
+        # process.wait() would also wait for the pipes, which no one reads anymore
+        deadline = time.monotonic() + grace
+        while process.returncode is None and time.monotonic() < deadline:
+            await asyncio.sleep(poll_interval)
+
+    # stragglers that ignored SIGTERM, or outlived the group leader
+    _kill_group(process, signal.SIGKILL)
+    # closing the transport closes our end of the pipes
+    process._transport.close()
+    await process.wait()
+
+
+async def spawn(create: typing.Awaitable[asyncio.subprocess.Process], grace: float = 2.0) -> asyncio.subprocess.Process:
+    """Await CREATE, a coroutine that starts a process, and return the process
+
+    Should we be cancelled while the process is starting, it is terminated
+    with its group before the cancellation propagates.  Otherwise asyncio
+    cleans up after itself by killing only the group leader and waiting for
+    pipes that may be held open by the rest of the group.
+    """
+    task = asyncio.ensure_future(create)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        try:
+            process = await task
+        except Exception:
+            pass
+        else:
+            await terminate(process, grace)
+        raise
@@ -0,0 +1,107 @@
+"""Copying of process output to a single writer with few event loop round trips."""
+
+import asyncio
+import collections
+
+__all__ = ["Pump", "PumpInfo"]
+
+PumpInfo = collections.namedtuple("PumpInfo", ["bytes", "reads", "writes"])
+
+
+class Pump:
+    """Copies one or more readers, i.e. the stdout and stderr of a process, into WRITER
+
+    Read sizes adapt to the rate at which output arrives: a read that fills
+    its buffer doubles the next read size, up to MAX_READ, and a read that
+    returns little halves it, down to MIN_READ.
+
+    Output is written as it arrives, unless the previous write was less than
+    FLUSH_INTERVAL seconds ago.  Then it is coalesced and written once
+    FLUSH_BYTES are buffered, or when FLUSH_INTERVAL expires.  Every reader
+    shares a single drain of WRITER, which is also awaited whenever the
+    transport of WRITER buffers more than its high-water mark, so that a slow
+    screen slows down the readers instead of filling memory.
+    """
+
+    def __init__(self,
+                 writer: asyncio.StreamWriter,
+                 flush_bytes: int = 64 * 1024,
+                 flush_interval: float = 0.005,
+                 min_read: int = 4 * 1024,
+                 max_read: int = 1024 * 1024):
+        assert isinstance(flush_bytes, int) and flush_bytes > 0, flush_bytes
+        assert flush_interval >= 0, flush_interval
+        assert 0 < min_read <= max_read, (min_read, max_read)
+        self.writer = writer
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.min_read = min_read
+        self.max_read = max_read
+        self.bytes = 0
+        self.reads = 0
+        self.writes = 0
+        self._buffer = bytearray()
+        self._timer = None
+        self._draining = None
+        self._written = float("-inf")
+
+    async def copy(self, reader: asyncio.StreamReader):
+        """Copy READER until it reaches EOF"""
+        size = self.min_read
+        while True:
+            chunk = await reader.read(size)
+            if not chunk:
+                break
+            self.reads += 1
+            self.bytes += len(chunk)
+            if len(chunk) == size:
+                size = min(size * 2, self.max_read)
+            elif len(chunk) < size // 4:
+                size = max(size // 2, self.min_read)
+
+            self._buffer += chunk
+            if len(self._buffer) >= self.flush_bytes:
+                self._write()
+                await self.drain()
+            elif asyncio.get_event_loop().time() - self._written >= self.flush_interval:
+                # output that trickles in, i.e. a prompt, is not delayed
+                self._write()
+            elif self._timer is None:
+                self._timer = asyncio.get_event_loop().call_later(self.flush_interval, self._write)
+
+            if self._is_congested():
+                await self.drain()
+
+    async def flush(self):
+        """Write everything that is buffered and wait until the writer accepted it"""
+        self._write()
+        await self.drain()
+
+    async def drain(self):
+        # StreamWriter.drain() may not be awaited by several tasks at once, they await a single drain instead
+        if self._draining is None or self._draining.done():
+            self._draining = asyncio.ensure_future(self.writer.drain())
+        await asyncio.shield(self._draining)
+
+    def _is_congested(self) -> bool:
+        transport = getattr(self.writer, "transport", None)
+        return transport is not None and transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]
+
+    def _write(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer and not self.writer.is_closing():
+            self.writes += 1
+            self.writer.write(bytes(self._buffer))
+            self._written = asyncio.get_event_loop().time()
+        self._buffer.clear()
+
+    def close(self):
+        """Stop the pending flush, without writing what is buffered"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def info(self) -> PumpInfo:
+        return PumpInfo(self.bytes, self.reads, self.writes)
@@ -0,0 +1,160 @@
+"""Bounded concurrency for process launches."""
+
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+import typing
+
+from .limits import AdmissionController
+from .log import logger
+
+__all__ = ["Scheduler", "SchedulerInfo", "HIGH", "NORMAL", "LOW"]
+
+# lower values are scheduled first
+HIGH = 0
+NORMAL = 10
+LOW = 20
+
+SchedulerInfo = collections.namedtuple("SchedulerInfo", ["in_flight", "queued", "count", "wait_total", "wait_max", "run_total", "run_max"])
+
+
+class Slot:
+    """Asynchronous context manager that holds a Scheduler slot while the block runs"""
+
+    def __init__(self, scheduler: "Scheduler", priority: int, key: typing.Optional[str]):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.key = key
+        self.wait_time = None
+        self.run_time = None
+        self._start = None
+
+    async def __aenter__(self):
+        enqueued = time.monotonic()
+        await self.scheduler._acquire(self.priority, self.key)
+        self._start = time.monotonic()
+        self.wait_time = self._start - enqueued
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.run_time = time.monotonic() - self._start
+        self.scheduler._release(self.key, self.wait_time, self.run_time)
+
+
+class Scheduler:
+    """Limits the number of processes that run at the same time
+
+    At most MAX_IN_FLIGHT slots are handed out, or unlimited when None.  When
+    KEY_LIMIT is given, at most KEY_LIMIT slots are handed out for the same key,
+    KEY_LIMITS may override this limit for specific keys.  Waiting slots are
+    handed out in priority order, and in arrival order for equal priorities.
+
+    Time spent waiting for a slot is accounted separately from time spent
+    holding it, see info().  Slots with a priority of at least ADMISSION_PRIORITY
+    first wait for ADMISSION, see AdmissionController.
+    """
+
+    def __init__(self,
+                 max_in_flight: typing.Optional[int] = None,
+                 key_limit: typing.Optional[int] = None,
+                 key_limits: typing.Optional[typing.Dict[str, int]] = None,
+                 admission: typing.Optional[AdmissionController] = None,
+                 admission_priority: int = NORMAL):
+        assert max_in_flight is None or (isinstance(max_in_flight, int) and max_in_flight > 0), max_in_flight
+        assert key_limit is None or (isinstance(key_limit, int) and key_limit > 0), key_limit
+        self.max_in_flight = max_in_flight
+        self.key_limit = key_limit
+        self.key_limits = {} if key_limits is None else dict(key_limits)
+        self.admission = admission
+        self.admission_priority = admission_priority
+        self._in_flight = 0
+        self._in_flight_per_key = collections.Counter()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    def slot(self, priority: int = NORMAL, key: typing.Optional[str] = None) -> Slot:
+        """Returns an asynchronous context manager that waits for, and holds, a slot"""
+        assert isinstance(priority, int), type(priority)
+        assert key is None or isinstance(key, str), type(key)
+        return Slot(self, priority, key)
+
+    def info(self) -> SchedulerInfo:
+        return SchedulerInfo(self._in_flight, len(self._waiters), self._count, self._wait_total, self._wait_max, self._run_total, self._run_max)
+
+    def _has_capacity(self, key: typing.Optional[str]) -> bool:
+        if self.max_in_flight is not None and self._in_flight >= self.max_in_flight:
+            return False
+        if key is not None:
+            limit = self.key_limits.get(key, self.key_limit)
+            if limit is not None and self._in_flight_per_key[key] >= limit:
+                return False
+        return True
+
+    def _take(self, key: typing.Optional[str]):
+        self._in_flight += 1
+        if key is not None:
+            self._in_flight_per_key[key] += 1
+
+    async def _acquire(self, priority: int, key: typing.Optional[str]):
+        if self.admission is not None and priority >= self.admission_priority:
+            await self.admission.wait()
+
+        if not self._waiters and self._has_capacity(key):
+            self._take(key)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), key, future))
+        self._wake()
+        if not future.done():
+            logger.debug("Queue process launch (priority %d, key %s, %d in flight)", priority, key, self._in_flight)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed out just before the cancellation arrived
+                self._release(key, None, None)
+            else:
+                self._waiters = [waiter for waiter in self._waiters if waiter[3] is not future]
+                heapq.heapify(self._waiters)
+            raise
+
+    def _release(self, key: typing.Optional[str], wait_time: typing.Optional[float], run_time: typing.Optional[float]):
+        self._in_flight -= 1
+        if key is not None:
+            self._in_flight_per_key[key] -= 1
+            if not self._in_flight_per_key[key]:
+                del self._in_flight_per_key[key]
+
+        if run_time is not None:
+            self._count += 1
+            self._wait_total += wait_time
+            self._wait_max = max(self._wait_max, wait_time)
+            self._run_total += run_time
+            self._run_max = max(self._run_max, run_time)
+
+        self._wake()
+
+    def _wake(self):
+        # hand out slots in priority order, skipping waiters whose key is at its limit
+        blocked = []
+        while self._waiters and (self.max_in_flight is None or self._in_flight < self.max_in_flight):
+            waiter = heapq.heappop(self._waiters)
+            _, _, key, future = waiter
+            if future.done():
+                continue
+            if self._has_capacity(key):
+                self._take(key)
+                future.set_result(None)
+            else:
+                blocked.append(waiter)
+
+        for waiter in blocked:
+            heapq.heappush(self._waiters, waiter)
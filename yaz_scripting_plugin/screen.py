@@ -0,0 +1,203 @@
+"""A single listener that connects run() sessions to their external screens."""
+
+import asyncio
+import os
+import re
+import secrets
+import shlex
+import shutil
+import socket
+import tempfile
+import typing
+import weakref
+
+from .log import logger
+
+__all__ = ["ScreenServer", "ScreenError", "supports_unix"]
+
+
+class ScreenError(RuntimeError):
+    """The external screen could not be started or did not connect"""
+
+
+# whether the netcat programs found so far support -U, by name
+_netcat_unix = {}
+
+# the longest token line a screen may send, the tokens of connect() are much shorter
+MAX_TOKEN_LINE = 256
+
+
+async def supports_unix(client: str) -> bool:
+    """Returns False when CLIENT runs a netcat that can not connect to a Unix domain socket"""
+    match = re.search(r"(?:^|[\s|;&(])(netcat|nc)\s", client)
+    if match is None:
+        return True
+    name = match.group(1)
+    if name not in _netcat_unix:
+        try:
+            process = await asyncio.create_subprocess_exec(name, "-h", stdin=asyncio.subprocess.DEVNULL,
+                                                           stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            usage, _ = await process.communicate()
+        except OSError:
+            usage = b""
+        # netcat-openbsd lists "-U" in its usage, netcat-traditional and GNU netcat do not know it
+        _netcat_unix[name] = b"-U" in usage
+        logger.debug("%s %s Unix domain sockets", name, "supports" if _netcat_unix[name] else "does not support")
+    return _netcat_unix[name]
+
+
+class ScreenServer:
+    """Long lived listener that external screens connect back to
+
+    Every session receives a random token.  The screen is started with
+    COMMAND, which is formatted with the quoted TITLE and CLIENT, where CLIENT
+    is formatted with the TOKEN, and the listener ADDRESS as netcat arguments
+    (or its PATH, HOST and PORT).  The client must send the token on a line
+    of its own before anything else, after which the connection belongs to
+    the session that waits for that token.  The token line is read from the
+    socket byte by byte, everything the screen sends after it is left in the
+    socket for the session.
+
+    The listener is a Unix domain socket in a private directory when UNIX is
+    True, and otherwise an ephemeral port on the loopback interface.  When
+    UNIX is None, a Unix domain socket is used unless CLIENT runs a netcat
+    that does not support -U, like netcat-traditional and GNU netcat.
+    """
+
+    def __init__(self, command: str, client: str, timeout: float = 30.0, unix: typing.Optional[bool] = None):
+        self.command = command
+        self.client = client
+        self.timeout = timeout
+        self.unix = unix
+        self.path = None
+        self.host = None
+        self.port = None
+        self._loop = None
+        self._listener = None
+        self._listening = None
+        self._accepting = None
+        self._directory = None
+        self._pending = {}
+
+    async def connect(self, title: str) -> socket.socket:
+        """Start an external screen titled TITLE and return the non-blocking socket of its connection
+
+        For example:
+        - reader, writer = await asyncio.open_connection(sock=await server.connect("title"))
+        """
+        await self._start()
+
+        token = secrets.token_hex(16)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[token] = future
+        try:
+            cmd = self.command.format(title=shlex.quote(title), client=shlex.quote(self.client.format(
+                token=token,
+                address="-U {}".format(shlex.quote(self.path)) if self.unix else "{} {}".format(self.host, self.port),
+                path="" if self.path is None else shlex.quote(self.path),
+                host="" if self.host is None else self.host,
+                port="" if self.port is None else self.port)))
+            logger.debug("Start external screen [%s]", cmd)
+            process = await asyncio.create_subprocess_shell(cmd)
+            return_code = await process.wait()
+            if return_code != 0:
+                raise ScreenError("External screen [{}] ended with exit code {}".format(cmd, return_code))
+
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                raise ScreenError("External screen [{}] did not connect within {}s".format(cmd, self.timeout)) from None
+        finally:
+            del self._pending[token]
+
+    async def close(self):
+        if self._listening is not None and self._loop is asyncio.get_event_loop():
+            await self._listening
+            self._accepting.cancel()
+            await asyncio.gather(self._accepting, return_exceptions=True)
+            self._listener.close()
+        self._forget()
+
+    async def _start(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # the listener is bound to the loop that started it
+            self._forget()
+            self._loop = loop
+            self._listening = asyncio.ensure_future(self._listen())
+        # concurrent sessions share a single start
+        await asyncio.shield(self._listening)
+
+    async def _listen(self):
+        if self.unix is None:
+            self.unix = hasattr(socket, "AF_UNIX") and await supports_unix(self.client)
+        if self.unix:
+            self._directory = tempfile.mkdtemp(prefix="yaz-screen-")
+            weakref.finalize(self, shutil.rmtree, self._directory, True)
+            self.path = os.path.join(self._directory, "socket")
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(self.path)
+            logger.debug("Wait for external screens on %s", self.path)
+        else:
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.bind(("127.0.0.1", 0))
+            self.host, self.port = self._listener.getsockname()[:2]
+            logger.debug("Wait for external screens on %s:%d", self.host, self.port)
+        self._listener.setblocking(False)
+        self._listener.listen(128)
+        self._accepting = asyncio.ensure_future(self._accept())
+
+    async def _accept(self):
+        loop = asyncio.get_event_loop()
+        connections = set()
+        try:
+            while True:
+                connection, _ = await loop.sock_accept(self._listener)
+                connection.setblocking(False)
+                task = asyncio.ensure_future(self._incoming_connection(connection))
+                connections.add(task)
+                task.add_done_callback(connections.discard)
+        finally:
+            for task in connections:
+                task.cancel()
+
+    def _forget(self):
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        self._loop = None
+        self._listener = None
+        self._listening = None
+        self._accepting = None
+        self._directory = None
+        self.path = self.host = self.port = None
+
+    async def _incoming_connection(self, connection: socket.socket):
+        try:
+            token = (await asyncio.wait_for(self._read_token(connection), self.timeout)).decode(errors="replace")
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            token = None
+        except BaseException:
+            connection.close()
+            raise
+
+        future = self._pending.get(token)
+        if future is None or future.done():
+            logger.warning("Reject external screen connection with an unknown token")
+            connection.close()
+            return
+
+        future.set_result(connection)
+
+    @staticmethod
+    async def _read_token(connection: socket.socket) -> bytes:
+        # a byte at a time, whatever the screen sends after the token line stays in the socket
+        loop = asyncio.get_event_loop()
+        line = bytearray()
+        while len(line) <= MAX_TOKEN_LINE:
+            byte = await loop.sock_recv(connection, 1)
+            if not byte:
+                raise ConnectionResetError("External screen closed the connection before it sent a token")
+            if byte == b"\n":
+                return bytes(line).strip()
+            line += byte
+        raise ValueError("Token line longer than {} bytes".format(MAX_TOKEN_LINE))
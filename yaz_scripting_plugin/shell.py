@@ -1,157 +1,987 @@
+import array
 import asyncio
+import functools
+import inspect
+import logging
+import os
 import shlex
+import socket
+import time
 import typing
 import yaz
-import yaz_templating_plugin
 
-from .log import logger
-from .error import InvalidReturnCodeError
+from .capture import Capture, SpilledOutput, read_into, TEXT, BYTES, DISCARD, MERGE
+from .cassette import Cassette, CassetteMissError, EXECUTION_MODES, RECORD, REPLAY, DRY_RUN, convert_output
+from .command import MODES, split_command
+from .dag import Dag, DagNode, DagResult, execute_dag
+from .hedge import Hedger, HedgePolicy, RetryPolicy
+from .limits import AdmissionController, Limits
+from .log import logger, log_command, start_queue_logging
+from .error import BatchError, DagError, InvalidReturnCodeError, PipelineError, ProcessTimeoutError
+from .memo import DiskBackend, ResultCache
+from .metrics import MetricsRegistry
+from .parse import Columns, Parser
+from .pipeline import start_pipeline, terminate_pipeline, is_valid
+from .pool import WorkerPool
+from .process import spawn, terminate
+from .pump import Pump
+from .scheduler import Scheduler, NORMAL
+from .screen import ScreenServer
+from .source import InputSource, TemplateInput, open_input
+from .stream import Stream
+from .template import TemplateCache
+
+if typing.TYPE_CHECKING:
+    import yaz_templating_plugin
 
 
 class Shell(yaz.BasePlugin):
+    # maximum number of compiled cmd and input templates to keep
+    template_cache_size = 256
+
+    # directory where compiled templates are kept between processes, None only keeps them in memory
+    template_bytecode_cache_path = "~/.yaz/template-cache"
+
+    # maximum number of get() and stream() processes running at the same time, None is unlimited
+    max_in_flight = 64
+
+    # maximum number of processes running at the same time for a single key, None is unlimited
+    key_limit = None
+
+    # how get(), stream() and run() start a process when no MODE is given:
+    # "shell" always uses /bin/sh, "exec" never does, and "auto" only uses
+    # /bin/sh when the command contains shell syntax
+    default_mode = "auto"
+
+    # number of long lived shell workers used by get(..., pooled=True)
+    pool_size = 4
+
+    # number of commands a shell worker executes before it is replaced
+    pool_max_commands = 1000
+
+    # seconds after which get() and run() terminate their process, None waits forever
+    default_timeout = None
+
+    # seconds between SIGTERM and SIGKILL when a process is terminated
+    kill_grace = 2.0
+
+    # limits for the results kept by get(..., cache=SCOPE), a TTL of None never expires
+    result_cache_entries = 1024
+    result_cache_bytes = 16 * 1024 * 1024
+    result_cache_ttl = None
+
+    # directory where cached results persist between yaz invocations, None keeps them in memory only
+    result_cache_path = None
+
+    # how run() opens an external screen, see ScreenServer: COMMAND receives the
+    # quoted {title} and {client}, CLIENT the {token} and the listener {address}
+    screen_command = "screen -t {title} /bin/sh -c {client}"
+    screen_client = "stty -icanon && (printf '%s\\n' {token} && cat) | netcat {address}"
+
+    # seconds run() waits for the external screen to connect
+    screen_timeout = 30.0
+
+    # run() writes process output to the screen once this many bytes are buffered, or after this many seconds
+    screen_flush_bytes = 64 * 1024
+    screen_flush_interval = 0.005
+
+    # when run() has no input, hand the screen connection to the process as its stdin, stdout and stderr
+    screen_passthrough = True
+
+    # record the cost of every get() and run() in SELF.METRICS
+    metrics_enabled = True
+
+    # hand log records to their handlers on a background thread, see start_queue_logging()
+    log_queue = False
+
+    # nice, ionice, cpu affinity and rlimits for every process, see Limits, LIMITS of a single call overrides them
+    default_limits = None
+
+    # delay launches with at least ADMISSION_PRIORITY while the 1-minute load average per CPU exceeds
+    # ADMISSION_MAX_LOAD, or fewer than ADMISSION_MIN_FREE_MEMORY bytes are available, see AdmissionController
+    admission_max_load = None
+    admission_min_free_memory = None
+    admission_priority = NORMAL
+
+    # "record" writes the result of every get(), stream(), pipeline() and run() to CASSETTE_PATH, "replay" answers them from
+    # it without starting a process, and "dry-run" only logs them and answers DRY_RUN_RESULT, see set_execution_mode()
+    execution_mode = None
+    cassette_path = None
+
+    # in "replay" mode, execute calls that were not recorded instead of raising CassetteMissError
+    cassette_fall_through = False
+
+    # (return_code, stdout, stderr) of every call in "dry-run" mode
+    dry_run_result = (0, "", "")
+
+    # number of latencies kept per command template to learn when get(..., hedge=HedgePolicy()) hedges
+    hedge_history_size = 100
+
     def __init__(self):
         self._screen_count = 0
+        self.templating = None
+        self.template_cache = TemplateCache(lambda: self.get_templating().environment, self.template_cache_size, self.template_bytecode_cache_path)
+        self.admission = AdmissionController(self.admission_max_load, self.admission_min_free_memory)
+        self.scheduler = Scheduler(self.max_in_flight, self.key_limit, admission=self.admission, admission_priority=self.admission_priority)
+        self.pool = WorkerPool(self.pool_size, self.pool_max_commands)
+        self.result_cache = ResultCache(self.result_cache_entries, self.result_cache_bytes, self.result_cache_ttl,
+                                        None if self.result_cache_path is None else DiskBackend(self.result_cache_path))
+        self.screen_server = ScreenServer(self.screen_command, self.screen_client, self.screen_timeout)
+        self.metrics = MetricsRegistry(self.metrics_enabled)
+        self.hedger = Hedger(self.hedge_history_size)
+        self.cassette = None
+        self.set_execution_mode(self.execution_mode, self.cassette_path, self.cassette_fall_through)
+        if self.log_queue:
+            start_queue_logging()
 
-    @yaz.dependency
-    def set_templating(self, templating: yaz_templating_plugin.Templating):
+    def set_templating(self, templating: "yaz_templating_plugin.Templating"):
         self.templating = templating
+        self.template_cache = TemplateCache(templating.environment, self.template_cache_size, self.template_bytecode_cache_path)
+
+    def get_templating(self) -> "yaz_templating_plugin.Templating":
+        # jinja is imported once the first template is compiled, commands without template syntax never need it
+        if self.templating is None:
+            import yaz_templating_plugin
+            self.templating = yaz.get_plugin_instance(yaz_templating_plugin.Templating)
+        return self.templating
+
+    def set_execution_mode(self, mode: typing.Optional[str], cassette_path: typing.Optional[str] = None, fall_through: bool = False):
+        """
+        Execute commands (None), or record, replay or skip them
+
+        In "record" mode, the rendered command, a digest of the input and the
+        results of every get(), stream(), pipeline() and run() are written to the
+        cassette at CASSETTE_PATH, parse() and get_columns() are recorded as
+        streams.  In "replay" mode, these calls are answered from the cassette
+        without starting a process, and raise CassetteMissError when they were
+        not recorded, or execute when FALL_THROUGH is True.  In "dry-run" mode,
+        they are only logged and answer SELF.DRY_RUN_RESULT.
+
+        For example:
+        - shell.set_execution_mode("record", "tests/deploy.cassette")
+        """
+        assert mode in EXECUTION_MODES, mode
+        assert mode not in (RECORD, REPLAY) or cassette_path is not None, "{} requires a cassette".format(mode)
+        if self.cassette is not None:
+            self.cassette.close()
+        self.execution_mode = mode
+        self.cassette_fall_through = fall_through
+        self.cassette = Cassette(cassette_path) if mode in (RECORD, REPLAY) else None
 
     async def get(self,
                   cmd: str,
-                  input: typing.Optional[str] = None,
+                  input: InputSource = None,
                   context: typing.Optional[dict] = None,
                   *,
-                  valid_codes: typing.Tuple[int, ...] = (0,)
+                  valid_codes: typing.Tuple[int, ...] = (0,),
+                  priority: int = NORMAL,
+                  key: typing.Optional[str] = None,
+                  pooled: bool = False,
+                  mode: typing.Optional[str] = None,
+                  max_bytes: typing.Optional[int] = None,
+                  spill_bytes: typing.Optional[int] = None,
+                  stdout: str = TEXT,
+                  stderr: str = TEXT,
+                  cache: typing.Optional[str] = None,
+                  cache_ttl: typing.Optional[float] = None,
+                  invalidates: typing.Tuple[str, ...] = (),
+                  timeout: typing.Optional[float] = None,
+                  limits: typing.Optional[Limits] = None,
+                  hedge: typing.Optional[HedgePolicy] = None,
+                  retry: typing.Optional[RetryPolicy] = None
                   ) -> (str, str):
         """
         Execute and return (stdout, stderr)
+
+        The process waits for a slot in SELF.SCHEDULER before it is started,
+        slots are handed out by PRIORITY (lower first) and limited per KEY,
+        for example the remote host the command connects to.
+
+        When POOLED is True and there is no INPUT, the command is evaluated by
+        one of the long lived shell workers in SELF.POOL instead of a new
+        /bin/sh process.  Each command runs in its own subshell.
+
+        MODE is one of "auto", "shell" or "exec" and defaults to SELF.DEFAULT_MODE.
+        In "exec" mode, and in "auto" mode for commands without shell syntax, the
+        command is split with shlex and executed without /bin/sh.  When the
+        program can not be executed in "exec" mode, an InvalidReturnCodeError
+        with the return code /bin/sh would use, 127 or 126, is raised.
+
+        MAX_BYTES bounds the memory used for stdout and stderr, each keeps only
+        its first and last MAX_BYTES // 2 bytes.  Alternatively, output larger
+        than SPILL_BYTES is written to a temporary file and returned as a
+        SpilledOutput, an mmap backed bytes-like object, instead of a str.
+        Either policy implies POOLED is ignored.
+
+        STDOUT and STDERR determine how each stream is captured: "text" returns
+        a str that is decoded while the output arrives, "bytes" returns the
+        output undecoded, and "discard" connects the stream to /dev/null and
+        returns None.  STDERR may also be "merge", which sends stderr through
+        the stdout pipe and returns None in its place.
+
+        When CACHE is given, the result is kept in SELF.RESULT_CACHE under the
+        scope CACHE, and later calls with the same rendered command and input
+        return it without starting a process.  Concurrent identical calls share
+        one process.  Only use this for idempotent commands.  CACHE_TTL overrides
+        the time in seconds the result is kept.  After the command runs, every
+        scope in INVALIDATES is forgotten, use this for commands that change what
+        cached commands would return.
+
+        For example:
+        - await shell.get("git rev-parse HEAD", cache="git")
+        - await shell.get("git pull", invalidates=("git",))
+
+        TIMEOUT, defaulting to SELF.DEFAULT_TIMEOUT, is the number of seconds the
+        process may run.  The process is started in a process group of its own.
+        When the timeout expires, or when the call is cancelled, the whole group
+        receives SIGTERM and, SELF.KILL_GRACE seconds later, SIGKILL.  A timeout
+        raises ProcessTimeoutError with the output received up to that moment.
+
+        What the process cost is recorded in SELF.METRICS, see MetricsRegistry.
+
+        HEDGE starts a duplicate of a command that is slower than usual, and
+        uses the result that arrives first, the other process group is
+        terminated.  RETRY executes a command again after it failed with a
+        transient return code.  Both are only for idempotent commands, see
+        HedgePolicy, RetryPolicy and SELF.HEDGER for how often they helped.
+
+        For example:
+        - await shell.get("stat /mnt/nfs/ready", hedge=HedgePolicy(), retry=RetryPolicy((75,)))
+
+        Commands are recorded, replayed or skipped, see set_execution_mode().
+
+        LIMITS, merged over SELF.DEFAULT_LIMITS, restricts the niceness, io
+        priority, cpus and resources of the process, see Limits.  Commands with
+        limits are never POOLED.  While the host is under pressure, launches
+        with a PRIORITY of at least SELF.ADMISSION_PRIORITY are delayed, see
+        SELF.ADMISSION.
+
+        INPUT is written to the stdin of the process.  A str is rendered like
+        CMD, bytes are written as they are.  A path or a file object is given to
+        the process as its stdin, and an iterable or asynchronous iterable of
+        str or bytes chunks is written while it is produced, with backpressure.
+        A TemplateInput is rendered chunk by chunk while it is written, see
+        open_input().  Only str and bytes input can be combined with CACHE.
+        """
+        start = time.perf_counter()
+        template = cmd
+        cmd = self._render(cmd, context)
+        input = self._render_input(input, context)
+        render_time = time.perf_counter() - start
+        log_command(logging.INFO, "Execute [{cmd}]", cmd, input)
+
+        kwargs = dict(valid_codes=valid_codes, priority=priority, key=key, pooled=pooled, mode=mode,
+                      max_bytes=max_bytes, spill_bytes=spill_bytes, stdout=stdout, stderr=stderr,
+                      cache=cache, cache_ttl=cache_ttl, invalidates=invalidates, timeout=timeout, limits=limits, render_time=render_time)
+        return await self._get_hedged(template, cmd, input, hedge, retry, kwargs)
+
+    async def _get_hedged(self, template: str, cmd: str, input: InputSource,
+                          hedge: typing.Optional[HedgePolicy], retry: typing.Optional[RetryPolicy], kwargs: dict) -> (str, str):
+        if hedge is None and retry is None:
+            return await self._get(cmd, input, **kwargs)
+
+        assert input is None or isinstance(input, (str, bytes)), "streamed input can not be hedged or retried"
+        # latencies are learned per template, the rendered commands of a template usually behave alike
+        return await self.hedger.run(template, lambda: self._get(cmd, input, **kwargs), hedge, retry)
+
+    async def get_many(self,
+                       commands: typing.Iterable[typing.Union[str, typing.Tuple[str, typing.Optional[str]]]],
+                       context: typing.Optional[dict] = None,
+                       *,
+                       concurrency: typing.Optional[int] = None,
+                       **kwargs
+                       ) -> typing.List[typing.Tuple[str, str]]:
+        """
+        Execute many commands and return their (stdout, stderr) in the order of COMMANDS
+
+        COMMANDS contains either cmd strings or (cmd, input) tuples, which are all
+        rendered with CONTEXT before the first process starts.  At most CONCURRENCY
+        commands run at the same time, on top of the limits of SELF.SCHEDULER.
+        Other keyword arguments are passed to get().
+
+        Every command runs, even when some fail.  Failures are raised afterwards as
+        a single BatchError that holds both the errors and the successful results.
+
+        For example:
+        - await shell.get_many(["uptime", "uname -r", "df -h"])
+        - await shell.get_many([("sh", script) for script in scripts], dict(host=host), concurrency=8)
+        """
+        results = {}
+        errors = {}
+        async for index, result, error in self._get_many(commands, context, concurrency, kwargs):
+            if error is None:
+                results[index] = result
+            else:
+                errors[index] = error
+
+        results = [results.get(index) for index in range(len(results) + len(errors))]
+        if errors:
+            raise BatchError(results, errors)
+        return results
+
+    async def iter_many(self,
+                        commands: typing.Iterable[typing.Union[str, typing.Tuple[str, typing.Optional[str]]]],
+                        context: typing.Optional[dict] = None,
+                        *,
+                        concurrency: typing.Optional[int] = None,
+                        **kwargs
+                        ) -> typing.AsyncIterator[typing.Tuple[int, typing.Tuple[str, str]]]:
         """
-        cmd = self.templating.render(cmd, context)
-        if input is not None:
-            input = self.templating.render(input, context)
-        logger.info(self.templating.render("{% if input %}echo {{ input|quote }} | {% endif %}{{ cmd }}", dict(input=input, cmd=cmd)))
+        Execute many commands, see get_many(), and yield (index, (stdout, stderr)) as each one completes
+
+        Results are not kept after they are yielded.  When commands failed, a BatchError
+        without results is raised after the last result is yielded.
+        """
+        errors = {}
+        async for index, result, error in self._get_many(commands, context, concurrency, kwargs):
+            if error is None:
+                yield index, result
+            else:
+                errors[index] = error
 
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            stdin=None if input is None else asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate(None if input is None else input.encode())
+        if errors:
+            raise BatchError(None, errors)
 
-        if process.returncode not in valid_codes:
-            logger.warning("Process [%s] ended with invalid exit code %d", cmd, process.returncode)
-            raise InvalidReturnCodeError(process.returncode, stdout, stderr)
+    async def _get_many(self, commands, context: typing.Optional[dict], concurrency: typing.Optional[int], kwargs: dict):
+        assert concurrency is None or (isinstance(concurrency, int) and concurrency > 0), concurrency
+        # a wrong option is a mistake of the caller, not a failure of every command
+        options = [name for name, parameter in inspect.signature(self.get).parameters.items() if parameter.kind is parameter.KEYWORD_ONLY]
+        unknown = sorted(set(kwargs).difference(options))
+        if unknown:
+            raise TypeError("get() got unexpected keyword argument(s) {}".format(", ".join(unknown)))
+        kwargs = dict(kwargs)
+        hedge, retry = kwargs.pop("hedge", None), kwargs.pop("retry", None)
 
-        return stdout.decode(), stderr.decode()
+        batch = []
+        for command in commands:
+            template, input = (command, None) if isinstance(command, str) else command
+            start = time.perf_counter()
+            cmd = self._render(template, context)
+            input = self._render_input(input, context)
+            batch.append((len(batch), template, cmd, input, time.perf_counter() - start))
+
+        if not batch:
+            return
+        logger.info("Execute %d commands, starting with [%s]", len(batch), batch[0][2])
+
+        queue = asyncio.Queue()
+        pending = iter(batch)
+
+        async def worker():
+            for index, template, cmd, input, render_time in pending:
+                log_command(logging.DEBUG, "Execute [{cmd}]", cmd, input)
+                try:
+                    await queue.put((index, await self._get_hedged(template, cmd, input, hedge, retry, dict(kwargs, render_time=render_time)), None))
+                except Exception as error:
+                    await queue.put((index, None, error))
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(len(batch), concurrency or len(batch)))]
+        try:
+            for _ in batch:
+                yield await queue.get()
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def execute_dag(self,
+                          dag: Dag,
+                          context: typing.Optional[dict] = None,
+                          *,
+                          concurrency: typing.Optional[int] = None,
+                          keep_going: bool = True
+                          ) -> DagResult:
+        """
+        Execute the commands of DAG, each once the commands it depends on succeeded, and return a DagResult
+
+        Independent commands run at the same time, at most CONCURRENCY of them,
+        on top of the limits of SELF.SCHEDULER.  Every command is executed with
+        get(), rendered with CONTEXT and the outputs of the commands it depends
+        on, see Dag.add().
+
+        When a command fails, the commands that depend on it are skipped, the
+        others still run unless KEEP_GOING is False, in which case the running
+        commands are cancelled and no new ones are started.  Failures are raised
+        afterwards as a single DagError that holds the DagResult.
+
+        The DagResult reports when every command was ready, started and ended,
+        and the critical path, the chain of commands that determined the total
+        duration, see DagResult.report().
+
+        For example:
+        - dag = Dag()
+          dag.add("fetch", "git -C {{ path|quote }} fetch")
+          dag.add("head", "git -C {{ path|quote }} rev-parse origin/master", depends=["fetch"], output="head")
+          dag.add("deps", "pip download -d {{ path|quote }}/wheels -r {{ path|quote }}/requirements.txt")
+          dag.add("build", "make -C {{ path|quote }} VERSION={{ head }}", depends=["head", "deps"])
+          result = await shell.execute_dag(dag, dict(path=path), concurrency=4)
+        """
+        assert isinstance(dag, Dag), type(dag)
+        logger.info("Execute dag of %d commands", len(dag))
+
+        async def run(node: DagNode, node_context: dict):
+            return await self.get(node.cmd, node.input, node_context, **node.kwargs)
+
+        result = await execute_dag(dag, run, context, concurrency, keep_going)
+        logger.info("Executed dag in %.3fs, critical path %s", result.duration, " -> ".join(result.get_critical_path()))
+        errors = {name: node.error for name, node in result.results.items() if node.error is not None}
+        if errors:
+            raise DagError(result, errors)
+        return result
+
+    async def _get(self,
+                   cmd: str,
+                   input: InputSource,
+                   *,
+                   valid_codes: typing.Tuple[int, ...] = (0,),
+                   priority: int = NORMAL,
+                   key: typing.Optional[str] = None,
+                   pooled: bool = False,
+                   mode: typing.Optional[str] = None,
+                   max_bytes: typing.Optional[int] = None,
+                   spill_bytes: typing.Optional[int] = None,
+                   stdout: str = TEXT,
+                   stderr: str = TEXT,
+                   cache: typing.Optional[str] = None,
+                   cache_ttl: typing.Optional[float] = None,
+                   invalidates: typing.Tuple[str, ...] = (),
+                   timeout: typing.Optional[float] = None,
+                   limits: typing.Optional[Limits] = None,
+                   render_time: float = 0.0
+                   ) -> (str, str):
+        # execute the rendered CMD, see get()
+        assert stdout in (TEXT, BYTES, DISCARD), stdout
+        assert stderr in (TEXT, BYTES, DISCARD, MERGE), stderr
+        kwargs = dict(valid_codes=valid_codes, priority=priority, key=key, pooled=pooled, mode=mode,
+                      max_bytes=max_bytes, spill_bytes=spill_bytes, stdout=stdout, stderr=stderr, timeout=timeout, limits=limits, render_time=render_time)
+
+        if invalidates:
+            try:
+                return await self._get(cmd, input, cache=cache, cache_ttl=cache_ttl, **kwargs)
+            finally:
+                for scope in invalidates:
+                    self.result_cache.invalidate(scope)
+
+        if cache is not None:
+            assert input is None or isinstance(input, (str, bytes)), "streamed input can not be cached"
+            # everything that changes the result is part of the key
+            cache_key = repr((cmd, input, valid_codes, max_bytes, stdout, stderr))
+            return await self.result_cache.get_or_run(cache, cache_key, lambda: self._get(cmd, input, **kwargs), cache_ttl)
+
+        replayed = self._replay("get", cmd, input)
+        if replayed is not None:
+            return_code, stdout_output, stderr_output = replayed
+            if return_code not in valid_codes:
+                raise InvalidReturnCodeError(return_code, self._get_error_output(stdout_output), self._get_error_output(stderr_output))
+            return convert_output(stdout_output, stdout), convert_output(stderr_output, stderr)
+
+        timeout = self.default_timeout if timeout is None else timeout
+        async with self.scheduler.slot(priority, key) as slot:
+            with self.metrics.measure(cmd, "get", render_time) as metrics:
+                # pool workers evaluate commands with /bin/sh, which "exec" mode must never do
+                if (pooled and input is None and max_bytes is None and spill_bytes is None and stderr != MERGE
+                        and limits is None and self.default_limits is None and (mode or self.default_mode) != "exec"):
+                    try:
+                        return_code, stdout_output, stderr_output = await asyncio.wait_for(self.pool.execute(cmd), timeout)
+                    except asyncio.TimeoutError:
+                        raise ProcessTimeoutError(cmd, timeout) from None
+                    stdout_size, stderr_size = len(stdout_output), len(stderr_output)
+                    metrics.bytes_out = stdout_size + stderr_size
+                    stdout_output = None if stdout == DISCARD else stdout_output
+                    stderr_output = None if stderr == DISCARD else stderr_output
+                else:
+                    with open_input(input) as (stdin, feed):
+                        process = await self._create_process(
+                            cmd,
+                            mode=mode,
+                            limits=limits,
+                            stdin=stdin,
+                            stdout=self._get_pipe(stdout),
+                            stderr=self._get_pipe(stderr))
+                    metrics.spawned()
+                    stdout_capture = Capture(max_bytes, spill_bytes, "utf-8" if stdout == TEXT else None)
+                    stderr_capture = Capture(max_bytes, spill_bytes, "utf-8" if stderr == TEXT else None)
+                    try:
+                        metrics.bytes_in = await asyncio.wait_for(self._capture(process, feed, stdout_capture, stderr_capture), timeout)
+                    except asyncio.TimeoutError:
+                        log_command(logging.WARNING, "Process [{cmd}] did not finish within {timeout}s", cmd, timeout=timeout,
+                                    stdout_size=stdout_capture.size, stderr_size=stderr_capture.size)
+                        await terminate(process, self.kill_grace)
+                        raise ProcessTimeoutError(cmd, timeout,
+                                                  self._get_error_output(stdout_capture.getvalue() if process.stdout else None),
+                                                  self._get_error_output(stderr_capture.getvalue() if process.stderr else None)) from None
+                    except asyncio.CancelledError:
+                        # shielded, a second cancellation must not leave the process group behind
+                        await asyncio.shield(terminate(process, self.kill_grace))
+                        raise
+                    finally:
+                        metrics.bytes_out = stdout_capture.size + stderr_capture.size
+                    stdout_output = stdout_capture.getvalue() if process.stdout else None
+                    stderr_output = stderr_capture.getvalue() if process.stderr else None
+                    stdout_size, stderr_size = stdout_capture.size, stderr_capture.size
+                    return_code = process.returncode
+                metrics.return_code = return_code
+        log_command(logging.DEBUG if return_code in valid_codes else logging.WARNING, "Process [{cmd}] ended with exit code {return_code}", cmd,
+                    return_code=return_code, wait_time=slot.wait_time, duration=slot.run_time, stdout_size=stdout_size, stderr_size=stderr_size)
+        try:
+            self._record("get", cmd, input, return_code, stdout_output, stderr_output, slot.run_time)
+        except BaseException:
+            # nobody receives the output, remove its temporary files
+            for output in (stdout_output, stderr_output):
+                if isinstance(output, SpilledOutput):
+                    output.close()
+            raise
+
+        if return_code not in valid_codes:
+            raise InvalidReturnCodeError(return_code, self._get_error_output(stdout_output), self._get_error_output(stderr_output))
+
+        return self._decode(stdout_output, stdout, max_bytes), self._decode(stderr_output, stderr, max_bytes)
+
+    def stream(self,
+               cmd: str,
+               input: InputSource = None,
+               context: typing.Optional[dict] = None,
+               *,
+               valid_codes: typing.Tuple[int, ...] = (0,),
+               lines: bool = False,
+               chunk_size: int = 64 * 1024,
+               priority: int = NORMAL,
+               key: typing.Optional[str] = None,
+               mode: typing.Optional[str] = None,
+               limits: typing.Optional[Limits] = None
+               ) -> Stream:
+        """
+        Execute and iterate over Output chunks, or lines when LINES is True, as they arrive
+
+        For example:
+        - async for output in shell.stream("find / -name '*.py'", lines=True):
+              print(output.source, output.value)
+
+        The process holds a SELF.SCHEDULER slot, see get(), until the stream is exhausted or closed.
+        MODE, LIMITS and INPUT are used as in get().  Streams are recorded,
+        replayed or skipped, see set_execution_mode(), a recording holds the
+        whole output.
+        """
+        cmd = self._render(cmd, context)
+        input = self._render_input(input, context)
+        log_command(logging.INFO, "Stream [{cmd}]", cmd, input)
+        replayed = self._replay("stream", cmd, input)
+        record = functools.partial(self._record, "stream", cmd, input) if self.execution_mode == RECORD else None
+
+        def start(stdin):
+            return self._create_process(cmd, mode=mode, limits=limits, stdin=stdin, limit=chunk_size)
+
+        return Stream(start, self.scheduler.slot(priority, key), cmd, input, valid_codes, lines, chunk_size, self.kill_grace, replayed, record)
+
+    async def parse(self,
+                    cmd: str,
+                    parser: Parser,
+                    input: InputSource = None,
+                    context: typing.Optional[dict] = None,
+                    **kwargs
+                    ) -> typing.AsyncIterator:
+        """
+        Execute and yield the records PARSER finds in stdout while the process runs
+
+        For example:
+        - async for record in shell.parse("find / -print0", SplitParser(b"\\0")):
+              print(record)
+
+        The output is parsed chunk by chunk as it arrives, and never held as a
+        whole.  Stderr is ignored.  KWARGS are used as in stream().
+        """
+        async for records in self._parse_chunks(cmd, parser, input, context, kwargs):
+            for record in records:
+                yield record
+
+    async def get_columns(self,
+                          cmd: str,
+                          parser: Parser,
+                          input: InputSource = None,
+                          context: typing.Optional[dict] = None,
+                          *,
+                          typed: bool = True,
+                          **kwargs
+                          ) -> typing.Dict[typing.Union[str, int], typing.Union[list, array.array]]:
+        """
+        Execute and return the records PARSER finds in stdout as a list, or an array.array, per field
+
+        For example:
+        - columns = await shell.get_columns("cat sizes.csv", CsvParser())
+          total = sum(map(int, columns["size"]))
+
+        See parse() and Columns.
+        """
+        columns = Columns(typed)
+        async for records in self._parse_chunks(cmd, parser, input, context, kwargs):
+            columns.extend(records)
+        return columns.getvalue()
+
+    async def _parse_chunks(self, cmd: str, parser: Parser, input: InputSource, context: typing.Optional[dict], kwargs: dict):
+        # yields the records completed by every chunk of stdout, see parse()
+        stream = self.stream(cmd, input, context, **kwargs)
+        try:
+            async for output in stream:
+                if output.source == "stdout":
+                    records = parser.feed(output.value)
+                    if records:
+                        yield records
+        finally:
+            await stream.aclose()
+        yield parser.close()
+
+    async def pipeline(self,
+                       stages: typing.List[str],
+                       input: InputSource = None,
+                       context: typing.Optional[dict] = None,
+                       *,
+                       valid_codes: typing.Union[typing.Tuple[int, ...], typing.List[typing.Tuple[int, ...]]] = (0,),
+                       priority: int = NORMAL,
+                       key: typing.Optional[str] = None,
+                       mode: typing.Optional[str] = None,
+                       max_bytes: typing.Optional[int] = None,
+                       spill_bytes: typing.Optional[int] = None,
+                       stdout: typing.Union[str, int, typing.BinaryIO] = TEXT,
+                       stderr: str = TEXT,
+                       timeout: typing.Optional[float] = None,
+                       limits: typing.Optional[Limits] = None
+                       ) -> (str, str, typing.List[int]):
+        """
+        Execute STAGES, connecting the stdout of every command to the stdin of the next, and return (stdout, stderr, return_codes)
+
+        The stages are connected by OS pipes, the data between them never passes
+        through Python.  INPUT is written to the first stage.  STDOUT is the output
+        of the last stage and STDERR that of every stage, one after the other.
+        STDOUT may also be a file descriptor or a file object that the last stage
+        writes to directly, i.e. to stream gigabytes to disk, None is returned in
+        its place.
+
+        VALID_CODES applies to every stage, or is a list with the valid codes of
+        each stage.  A stage other than the last that is killed by SIGPIPE, because
+        a later stage stopped reading, is valid, also when /bin/sh reports it
+        as exit code 141.  An invalid return code raises a PipelineError.
+
+        For example:
+        - await shell.pipeline(["zcat {{ path|quote }}", "grep -v DEBUG", "wc -l"], context=dict(path=path))
+        - with open("sorted.txt", "wb") as file:
+              await shell.pipeline(["cat huge.txt", "sort"], stdout=file)
+
+        The pipeline holds a single SELF.SCHEDULER slot.  Other arguments are used as in get().
+        """
+        assert stages, stages
+        assert stderr in (TEXT, BYTES, DISCARD), stderr
+        if isinstance(stdout, str):
+            assert stdout in (TEXT, BYTES, DISCARD), stdout
+            stdout_target = self._get_pipe(stdout)
+        else:
+            stdout_target = stdout if isinstance(stdout, int) else stdout.fileno()
+        stage_codes = [valid_codes] * len(stages) if all(isinstance(code, int) for code in valid_codes) else list(valid_codes)
+        assert len(stage_codes) == len(stages), (stage_codes, stages)
+
+        start = time.perf_counter()
+        stages = [self._render(stage, context) for stage in stages]
+        input = self._render_input(input, context)
+        render_time = time.perf_counter() - start
+        cmd = " | ".join(stages)
+        log_command(logging.INFO, "Pipeline [{cmd}]", cmd, input)
+
+        replayed = self._replay("pipeline", cmd, input)
+        if replayed is not None:
+            return_codes, stdout_output, stderr_output = replayed
+            return_codes = [return_codes] * len(stages) if isinstance(return_codes, int) else return_codes
+            invalid = [index for index, return_code in enumerate(return_codes) if not is_valid(return_code, stage_codes[index], index == len(stages) - 1, self._uses_shell(stages[index], mode))]
+            if invalid:
+                raise PipelineError(return_codes, invalid[0], self._get_error_output(stdout_output), self._get_error_output(stderr_output))
+            return convert_output(stdout_output, stdout if isinstance(stdout, str) else DISCARD), convert_output(stderr_output, stderr), return_codes
+
+        timeout = self.default_timeout if timeout is None else timeout
+        async with self.scheduler.slot(priority, key):
+            with self.metrics.measure(cmd, "pipeline", render_time) as metrics:
+                with open_input(input) as (stdin, feed):
+                    processes = await start_pipeline(functools.partial(self._create_process, mode=mode, limits=limits), stages,
+                                                     stdin, stdout_target, self._get_pipe(stderr))
+                metrics.spawned()
+                stdout_capture = Capture(max_bytes, spill_bytes, "utf-8" if stdout == TEXT else None)
+                stderr_captures = [Capture(max_bytes, None, "utf-8" if stderr == TEXT else None) for _ in processes]
+                tasks = [read_into(processes[-1].stdout, stdout_capture)]
+                tasks.extend(read_into(process.stderr, capture) for process, capture in zip(processes, stderr_captures))
+                if feed is not None:
+                    tasks.append(feed(processes[0].stdin))
+                try:
+                    metrics.bytes_in = await asyncio.wait_for(self._wait_pipeline(processes, tasks), timeout)
+                except asyncio.TimeoutError:
+                    log_command(logging.WARNING, "Pipeline [{cmd}] did not finish within {timeout}s", cmd, timeout=timeout)
+                    await terminate_pipeline(processes, self.kill_grace)
+                    raise ProcessTimeoutError(cmd, timeout,
+                                              self._get_error_output(stdout_capture.getvalue() if processes[-1].stdout else None),
+                                              self._get_error_output(self._join([capture.getvalue() for capture in stderr_captures]))) from None
+                except asyncio.CancelledError:
+                    await asyncio.shield(terminate_pipeline(processes, self.kill_grace))
+                    raise
+                finally:
+                    metrics.bytes_out = stdout_capture.size + sum(capture.size for capture in stderr_captures)
+                return_codes = [process.returncode for process in processes]
+                metrics.return_code = return_codes[-1]
+
+        stdout_output = stdout_capture.getvalue() if processes[-1].stdout else None
+        stderr_output = None if stderr == DISCARD else self._join([capture.getvalue() for capture in stderr_captures])
+        invalid = [index for index, return_code in enumerate(return_codes) if not is_valid(return_code, stage_codes[index], index == len(stages) - 1, self._uses_shell(stages[index], mode))]
+        log_command(logging.WARNING if invalid else logging.DEBUG, "Pipeline [{cmd}] ended with exit codes {return_codes}", cmd,
+                    return_codes=return_codes, duration=metrics.wall_time, stdout_size=stdout_capture.size)
+        self._record("pipeline", cmd, input, return_codes, stdout_output, stderr_output, metrics.wall_time)
+        if invalid:
+            raise PipelineError(return_codes, invalid[0], self._get_error_output(stdout_output), self._get_error_output(stderr_output))
+
+        return self._decode(stdout_output, stdout, max_bytes), self._decode(stderr_output, stderr, max_bytes), return_codes
 
     async def run(self,
                   cmd: str,
-                  input: typing.Optional[str] = None,
+                  input: InputSource = None,
                   context: typing.Optional[dict] = None,
                   *,
-                  valid_codes: typing.Tuple[int, ...] = (0,)
+                  valid_codes: typing.Tuple[int, ...] = (0,),
+                  mode: typing.Optional[str] = None,
+                  timeout: typing.Optional[float] = None,
+                  limits: typing.Optional[Limits] = None
                   ):
         """
         Execute and interact in a separate window or screen
+
+        MODE, TIMEOUT, LIMITS and INPUT are used as in get(), and the process is recorded in SELF.METRICS.
         """
+        start = time.perf_counter()
+        rendered_cmd = self._render(cmd, context)
+        input = self._render_input(input, context)
+        render_time = time.perf_counter() - start
+
         process_exit = asyncio.Event()
-        reader, writer = await self._setup_external_screen("{} (yaz)".format(cmd))
+        log_command(logging.INFO, "Run [{cmd}]", rendered_cmd, input)
+        replayed = self._replay("run", rendered_cmd, input)
+        if replayed is not None:
+            if replayed[0] not in valid_codes:
+                raise InvalidReturnCodeError(replayed[0], None, None)
+            return
+
+        connection = await self._setup_external_screen("{} (yaz)".format(cmd))
+        cmd = rendered_cmd
+        writer = None
         try:
-            cmd = self.templating.render(cmd, context)
-            process = await asyncio.create_subprocess_shell(
-                cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                stdin=asyncio.subprocess.PIPE
-            )
-
-            if input is None:
-                stdin = self._screen_to_process(process_exit, reader, process.stdin)
-            else:
-                stdin = self._input_to_process(self.templating.render(input, context).encode(), process.stdin)
+            with self.metrics.measure(cmd, "run", render_time) as metrics:
+                if input is None and self.screen_passthrough:
+                    # the kernel moves the data between the screen and the process, we only wait for it to exit
+                    logger.debug("Pass the external screen connection to process [%s]", cmd)
+                    fd = self._get_screen_fd(connection)
+                    try:
+                        process = await self._create_process(cmd, mode=mode, limits=limits, stdin=fd, stdout=fd, stderr=fd)
+                    finally:
+                        os.close(fd)
+                    pump = None
+                    tasks = []
+                else:
+                    reader, writer = await asyncio.open_connection(sock=connection)
+                    with open_input(input) as (stdin, feed):
+                        process = await self._create_process(cmd, mode=mode, limits=limits, stdin=asyncio.subprocess.PIPE if input is None else stdin)
+                    pump = Pump(writer, self.screen_flush_bytes, self.screen_flush_interval)
+                    tasks = [self._process_to_screen(process_exit, process.stdout, pump), self._process_to_screen(process_exit, process.stderr, pump)]
+                    if input is None:
+                        tasks.append(self._screen_to_process(process_exit, reader, process.stdin))
+                    elif feed is not None:
+                        tasks.append(self._count_input(metrics, feed(process.stdin)))
+                metrics.spawned()
 
-            stdout = self._process_to_screen(process_exit, process.stdout, writer)
-            stderr = self._process_to_screen(process_exit, process.stderr, writer)
-            _, _, _, return_code = await asyncio.gather(stdin, stdout, stderr, process.wait())
+                timeout = self.default_timeout if timeout is None else timeout
+                try:
+                    *_, return_code = await asyncio.wait_for(asyncio.gather(*tasks, process.wait()), timeout)
+                except asyncio.TimeoutError:
+                    log_command(logging.WARNING, "Process [{cmd}] did not finish within {timeout}s", cmd, timeout=timeout)
+                    await terminate(process, self.kill_grace)
+                    raise ProcessTimeoutError(cmd, timeout) from None
+                except asyncio.CancelledError:
+                    await asyncio.shield(terminate(process, self.kill_grace))
+                    raise
+                finally:
+                    if pump is not None:
+                        pump.close()
+                        # bytes that passed straight from the process to the screen are not counted
+                        metrics.bytes_out = pump.bytes
+                metrics.return_code = return_code
 
+            log_command(logging.DEBUG if return_code in valid_codes else logging.WARNING, "Process [{cmd}] ended with exit code {return_code}", cmd,
+                        return_code=return_code, duration=metrics.wall_time, output_size=metrics.bytes_out)
+            self._record("run", cmd, input, return_code, None, None, metrics.wall_time)
             if return_code not in valid_codes:
-                logger.warning("Process [%s] ended with invalid exit code %d", cmd, return_code)
                 raise InvalidReturnCodeError(return_code, None, None)
 
         finally:
-            writer.close()
+            if writer is not None:
+                writer.close()
+            else:
+                connection.close()
+
+    def _render(self, template: str, context: typing.Optional[dict]) -> str:
+        return self.template_cache.render(template, context)
+
+    def _render_input(self, input: InputSource, context: typing.Optional[dict]) -> InputSource:
+        # only str input is a template, a TemplateInput becomes a generator of rendered chunks
+        if isinstance(input, str):
+            return self._render(input, context)
+        if isinstance(input, TemplateInput):
+            return self.template_cache.get_template(input.source).generate({} if context is None else context)
+        return input
+
+    def _replay(self, kind: str, cmd: str, input) -> typing.Optional[tuple]:
+        # returns (return_code, stdout, stderr) when the call must not execute, see set_execution_mode()
+        if self.execution_mode == DRY_RUN:
+            log_command(logging.INFO, "Skip [{cmd}] in dry run", cmd)
+            return self.dry_run_result
+        if self.execution_mode != REPLAY:
+            return None
+
+        entry = self.cassette.find(kind, cmd, input)
+        if entry is None:
+            if not self.cassette_fall_through:
+                raise CassetteMissError(kind, cmd, self.cassette.path)
+            log_command(logging.WARNING, "Execute [{cmd}], it was not recorded", cmd)
+            return None
+        log_command(logging.DEBUG, "Replay [{cmd}] with exit code {return_code}", cmd, return_code=entry.return_code, duration=entry.duration)
+        return entry.return_code, entry.stdout, entry.stderr
+
+    def _record(self, kind: str, cmd: str, input, return_code, stdout, stderr, duration: typing.Optional[float]):
+        if self.execution_mode == RECORD:
+            self.cassette.record(kind, cmd, input, return_code, stdout, stderr, duration)
 
     @staticmethod
-    async def _process_to_screen(event: asyncio.Event, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        while not reader.at_eof():
-            writer.write(await reader.read(1024))
-            await writer.drain()
+    async def _count_input(metrics, feed: typing.Awaitable[int]):
+        metrics.bytes_in = await feed
 
-        event.set()
+    @staticmethod
+    async def _capture(process: asyncio.subprocess.Process, feed, stdout: Capture, stderr: Capture) -> int:
+        # returns the number of bytes written by FEED, see open_input()
+        tasks = [read_into(process.stdout, stdout), read_into(process.stderr, stderr)]
+        if feed is not None:
+            tasks.append(feed(process.stdin))
+        results = await asyncio.gather(*tasks)
+        await process.wait()
+        return results[2] if feed is not None else 0
 
     @staticmethod
-    async def _screen_to_process(event: asyncio.Event, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        while not event.is_set():
-            wait_task = event.wait()
-            read_task = reader.read(1024)
+    async def _wait_pipeline(processes: typing.List[asyncio.subprocess.Process], tasks: list) -> int:
+        # returns the number of bytes written by the feed, which is the last of TASKS when there is input
+        results = await asyncio.gather(*tasks)
+        for process in processes:
+            await process.wait()
+        return results[-1] if isinstance(results[-1], int) else 0
+
+    @staticmethod
+    def _join(outputs: list) -> typing.Union[str, bytes]:
+        if all(isinstance(output, str) for output in outputs):
+            return "".join(outputs)
+        return b"".join(output.encode() if isinstance(output, str) else output for output in outputs)
 
-            # wait till *either* the event is set *or* there in something to copy from screen to process
-            done, pending = await asyncio.wait([wait_task, read_task], return_when=asyncio.FIRST_COMPLETED)
+    @staticmethod
+    def _get_pipe(capture: str):
+        if capture == DISCARD:
+            return asyncio.subprocess.DEVNULL
+        if capture == MERGE:
+            return asyncio.subprocess.STDOUT
+        return asyncio.subprocess.PIPE
 
-            for task in pending:
-                task.cancel()
+    @staticmethod
+    def _get_error_output(output) -> typing.Optional[bytes]:
+        if output is None:
+            return None
+        limit = InvalidReturnCodeError.output_limit
+        if isinstance(output, str):
+            output = (output if limit is None else output[-limit:]).encode()
+        return bytes(output if limit is None else output[-limit:])
 
-            for task in done:
-                result = task.result()
+    @staticmethod
+    def _decode(output, capture: str, max_bytes: typing.Optional[int]):
+        if capture != TEXT or not isinstance(output, bytes):
+            # already decoded, not captured, or a SpilledOutput
+            return output
+        # truncated output may have been cut halfway through a character
+        return output.decode(errors="strict" if max_bytes is None else "replace")
 
-                if isinstance(result, bytes):
-                    writer.write(result)
-                    await writer.drain()
+    def _uses_shell(self, cmd: str, mode: typing.Optional[str]) -> bool:
+        # whether _create_process() starts CMD through /bin/sh
+        mode = self.default_mode if mode is None else mode
+        return mode == "shell" or (mode == "auto" and not split_command(cmd))
 
-        writer.close()
+    async def _create_process(self, cmd: str, *, mode: typing.Optional[str] = None, limits: typing.Optional[Limits] = None, stdin=None, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs) -> asyncio.subprocess.Process:
+        mode = self.default_mode if mode is None else mode
+        assert mode in MODES, mode
+
+        if mode == "shell":
+            argv = None
+        elif mode == "exec":
+            argv = shlex.split(cmd)
+        else:
+            argv = split_command(cmd)
+
+        # a process group of its own allows terminate() to reach every process started by cmd
+        kwargs.setdefault("start_new_session", True)
+
+        if limits is not None or self.default_limits is not None:
+            preexec = (self.default_limits or Limits()).merge(limits).get_preexec()
+            if preexec is not None:
+                kwargs["preexec_fn"] = preexec
+
+        async def create():
+            if argv:
+                try:
+                    return await asyncio.create_subprocess_exec(*argv, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+                except (FileNotFoundError, PermissionError) as error:
+                    if mode == "exec":
+                        # never hand an "exec" command to /bin/sh, report the error with the return code and message /bin/sh would use
+                        logger.debug("Unable to execute %s: %s", argv[0], error)
+                        raise InvalidReturnCodeError(127 if isinstance(error, FileNotFoundError) else 126, b"",
+                                                     "{}: {}\n".format(argv[0], error.strerror).encode(errors="surrogateescape")) from None
+                    # let /bin/sh report the error, with its usual return code and message
+                    logger.debug("Unable to execute %s directly, falling back to /bin/sh", argv[0])
+
+            return await asyncio.create_subprocess_shell(cmd, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
+
+        return await spawn(create(), self.kill_grace)
 
     @staticmethod
-    async def _input_to_process(data: bytes, writer: asyncio.StreamWriter):
-        writer.write(data)
-        await writer.drain()
-        writer.close()
-
-    async def _setup_external_screen(self, title: str) -> (asyncio.StreamReader, asyncio.StreamWriter):
-        class Container:
-            def __init__(self):
-                self.event = asyncio.Event()
-                self.reader = None
-                self.writer = None
-
-            async def incoming_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-                self.reader = reader
-                self.writer = writer
-                self.event.set()
-
-        container = Container()
-
-        port = 8888 + (self._screen_count % 100)
-        while True:
-            try:
-                server = await asyncio.start_server(container.incoming_connection, "localhost", port)
-                logger.debug("Wait for external screen on port %d", port)
-                break
-            except OSError:
-                port += 1
-
-        logger.debug("Start external screen on port %d", port)
-        cmd = "screen -t {} /bin/sh -c \"stty -icanon && netcat localhost {}\"".format(shlex.quote(title), port)
-        process = await asyncio.create_subprocess_shell(cmd)
-        return_code = await process.wait()
-        assert return_code == 0, return_code
-        await container.event.wait()
-
-        logger.debug("Cleanup external screen server")
-        server.close()
-        await server.wait_closed()
-
-        return container.reader, container.writer
+    async def _process_to_screen(event: asyncio.Event, reader: asyncio.StreamReader, pump: Pump):
+        await pump.copy(reader)
+        await pump.flush()
+        event.set()
+
+    @staticmethod
+    async def _screen_to_process(event: asyncio.Event, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        process_exit = asyncio.ensure_future(event.wait())
+        try:
+            while True:
+                # wait till *either* the event is set *or* there in something to copy from screen to process
+                read = asyncio.ensure_future(reader.read(64 * 1024))
+                await asyncio.wait([process_exit, read], return_when=asyncio.FIRST_COMPLETED)
+                if not read.done():
+                    read.cancel()
+                    break
+
+                data = read.result()
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+
+        finally:
+            process_exit.cancel()
+            writer.close()
+
+    @staticmethod
+    def _get_screen_fd(connection: socket.socket) -> int:
+        """Returns a blocking file descriptor of the screen connection for a process, CONNECTION no longer owns it"""
+        # the screen server never read beyond the token, nothing the screen sent is lost to the process
+        connection.setblocking(True)
+        return connection.detach()
+
+    async def _setup_external_screen(self, title: str) -> socket.socket:
+        self._screen_count += 1
+        logger.debug("Setup external screen #%d", self._screen_count)
+        return await self.screen_server.connect(title)
 
 #
 # class Scripting(yaz.BasePlugin):
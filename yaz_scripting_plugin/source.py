@@ -0,0 +1,145 @@
+"""Process input that is written while it is produced, instead of held in memory as a whole."""
+
+import asyncio
+import contextlib
+import functools
+import os
+import typing
+
+__all__ = ["TemplateInput", "InputSource", "open_input", "write_input", "write_chunks"]
+
+chunk_size = 64 * 1024
+
+
+class TemplateInput:
+    """A template that is rendered incrementally, with jinja's generate(), while it is written to the process"""
+    __slots__ = ("source",)
+
+    def __init__(self, source: str):
+        assert isinstance(source, str), type(source)
+        self.source = source
+
+    def __repr__(self):
+        return "<TemplateInput {} characters>".format(len(self.source))
+
+
+InputSource = typing.Union[None, str, bytes, bytearray, memoryview, os.PathLike, typing.BinaryIO, TemplateInput,
+                           typing.Iterable[typing.Union[str, bytes]], typing.AsyncIterable[typing.Union[str, bytes]]]
+
+
+async def write_input(data: typing.Union[bytes, bytearray, memoryview], writer: asyncio.StreamWriter) -> int:
+    """Write DATA to the stdin of a process, in chunks that each wait for the pipe to drain, close it, and return the bytes written
+
+    When the process closes its stdin early, only the bytes the pipe accepted before are counted.
+    """
+    view = memoryview(data)
+    written = 0
+    try:
+        for offset in range(0, len(view), chunk_size):
+            writer.write(view[offset:offset + chunk_size])
+            written = _get_written(writer, min(offset + chunk_size, len(view)), written)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # the process does not read all of its input
+        writer.close()
+        return written
+    writer.close()
+    return len(view)
+
+
+async def write_chunks(chunks: typing.Union[typing.Iterable, typing.AsyncIterable], writer: asyncio.StreamWriter) -> int:
+    """Write the str or bytes CHUNKS to the stdin of a process, coalesced into writes of about CHUNK_SIZE, and close it
+
+    The next chunk is not taken from CHUNKS before the pipe drained.
+    """
+    size = 0
+    written = 0
+    buffer = bytearray()
+    try:
+        async for chunk in _iterate(chunks):
+            buffer += chunk.encode() if isinstance(chunk, str) else chunk
+            if len(buffer) >= chunk_size:
+                size += len(buffer)
+                writer.write(buffer)
+                buffer = bytearray()
+                written = _get_written(writer, size, written)
+                await writer.drain()
+        if buffer:
+            size += len(buffer)
+            writer.write(buffer)
+            written = _get_written(writer, size, written)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        writer.close()
+        return written
+    writer.close()
+    return size
+
+
+def _get_written(writer: asyncio.StreamWriter, size: int, written: int) -> int:
+    # of the SIZE bytes given to WRITER, those its transport no longer buffers were accepted by the pipe;
+    # once the pipe broke the transport dropped its buffer, so WRITTEN, the count known before, stands
+    transport = getattr(writer, "transport", None)
+    if transport is None or transport.is_closing():
+        return written
+    return size - transport.get_write_buffer_size()
+
+
+async def _iterate(chunks):
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+
+def _read_chunks(file) -> typing.Iterator[typing.Union[str, bytes]]:
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _get_fileno(file) -> typing.Optional[int]:
+    try:
+        return file.fileno()
+    except (AttributeError, OSError, ValueError):
+        # i.e. io.BytesIO, which raises io.UnsupportedOperation
+        return None
+
+
+@contextlib.contextmanager
+def open_input(input: InputSource):
+    """Yields (stdin, feed) to start a process with stdin=STDIN and write INPUT to it with FEED(process.stdin)
+
+    A str, already rendered, is encoded and bytes are written as they are.
+    An os.PathLike is opened and, like a file object with a file descriptor,
+    given to the process as its stdin, FEED is then None.  The process reads
+    a file object from its current position in the file, data buffered by
+    the file object is not seen.  Other file objects, iterables and
+    asynchronous iterables of str or bytes are written chunk by chunk.
+    FEED returns the number of bytes it wrote.
+    """
+    if input is None:
+        yield None, None
+
+    elif isinstance(input, (str, bytes, bytearray, memoryview)):
+        yield asyncio.subprocess.PIPE, functools.partial(write_input, input.encode() if isinstance(input, str) else input)
+
+    elif isinstance(input, os.PathLike):
+        with open(input, "rb") as file:
+            yield file, None
+
+    elif _get_fileno(input) is not None:
+        yield input, None
+
+    elif hasattr(input, "read"):
+        yield asyncio.subprocess.PIPE, functools.partial(write_chunks, _read_chunks(input))
+
+    elif hasattr(input, "__aiter__") or hasattr(input, "__iter__"):
+        yield asyncio.subprocess.PIPE, functools.partial(write_chunks, input)
+
+    else:
+        raise TypeError("Unsupported input {!r}".format(input))
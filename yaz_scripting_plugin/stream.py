@@ -0,0 +1,165 @@
+"""Incremental access to the output of a running process."""
+
+import asyncio
+import logging
+import time
+import typing
+
+from .log import logger, log_command
+from .error import InvalidReturnCodeError
+from .process import terminate
+from .source import InputSource, open_input
+
+__all__ = ["Output", "Stream"]
+
+
+class Output:
+    """A chunk or line of output, SOURCE is either "stdout" or "stderr" """
+    __slots__ = ("source", "value")
+
+    def __init__(self, source: str, value: bytes):
+        self.source = source
+        self.value = value
+
+    def __repr__(self):
+        return "<Output {} {!r}>".format(self.source, self.value)
+
+
+class Stream:
+    """Asynchronous iterator over the Output of a process
+
+    The process is started with START(stdin) when iteration begins and SLOT, an asynchronous
+    context manager, is entered.  INPUT is written to its stdin, see open_input().  At most QUEUE_SIZE chunks are
+    kept between the process and the consumer, a slow consumer stops the pipes
+    from being read, which in turn blocks the process once the pipe buffers are
+    full.  Memory use is therefore independent of the amount of output.
+
+    When the process ends with a return code that is not in VALID_CODES, an
+    InvalidReturnCodeError is raised after the last Output is yielded.  The
+    return code is available as RETURN_CODE once iteration is finished.
+
+    When iteration stops early, the process and its process group are
+    terminated, see terminate().
+
+    When REPLAYED, a (return_code, stdout, stderr) tuple, is given, no process
+    is started and the recorded output is yielded instead.  RECORD, when
+    given, is called with (return_code, stdout, stderr, duration) once the
+    process ended, see Shell.set_execution_mode().
+    """
+
+    queue_size = 4
+
+    def __init__(self,
+                 start: typing.Callable[[typing.Any], typing.Awaitable[asyncio.subprocess.Process]],
+                 slot,
+                 cmd: str,
+                 input: InputSource,
+                 valid_codes: typing.Tuple[int, ...],
+                 lines: bool,
+                 chunk_size: int,
+                 kill_grace: float = 2.0,
+                 replayed: typing.Optional[tuple] = None,
+                 record: typing.Optional[typing.Callable] = None):
+        self.cmd = cmd
+        self.return_code = None
+        self._start = start
+        self._slot = slot
+        self._input = input
+        self._valid_codes = valid_codes
+        self._lines = lines
+        self._chunk_size = chunk_size
+        self._kill_grace = kill_grace
+        self._replayed = replayed
+        self._record = record
+        self._iterator = None
+
+    def __aiter__(self):
+        if self._iterator is None:
+            self._iterator = self._iterate()
+        return self._iterator
+
+    async def aclose(self):
+        """Stop iterating and kill the process when it is still running"""
+        if self._iterator is not None:
+            await self._iterator.aclose()
+
+    async def _iterate(self):
+        if self._replayed is not None:
+            self.return_code, stdout, stderr = self._replayed
+            for source, output in (("stdout", stdout), ("stderr", stderr)):
+                for value in self._split(output):
+                    yield Output(source, value)
+            if self.return_code not in self._valid_codes:
+                raise InvalidReturnCodeError(self.return_code, None, None)
+            return
+
+        recorded = None if self._record is None else dict(stdout=bytearray(), stderr=bytearray())
+        start = time.monotonic()
+        async with self._slot:
+            with open_input(self._input) as (stdin, feed):
+                process = await self._start(stdin)
+            queue = asyncio.Queue(self.queue_size)
+            tasks = [asyncio.ensure_future(self._read("stdout", process.stdout, queue)),
+                     asyncio.ensure_future(self._read("stderr", process.stderr, queue))]
+            if feed is not None:
+                tasks.append(asyncio.ensure_future(feed(process.stdin)))
+
+            try:
+                open_streams = 2
+                while open_streams:
+                    output = await queue.get()
+                    if output is None:
+                        open_streams -= 1
+                    else:
+                        if recorded is not None:
+                            recorded[output.source] += output.value
+                        yield output
+
+                await asyncio.gather(*tasks)
+                self.return_code = await process.wait()
+
+            finally:
+                for task in tasks:
+                    task.cancel()
+                if process.returncode is None:
+                    logger.debug("Terminate process [%s] after its stream was closed", self.cmd)
+                    await terminate(process, self._kill_grace)
+
+        log_command(logging.DEBUG if self.return_code in self._valid_codes else logging.WARNING,
+                    "Process [{cmd}] ended with exit code {return_code}", self.cmd, return_code=self.return_code)
+        if recorded is not None:
+            self._record(self.return_code, bytes(recorded["stdout"]), bytes(recorded["stderr"]), time.monotonic() - start)
+        if self.return_code not in self._valid_codes:
+            raise InvalidReturnCodeError(self.return_code, None, None)
+
+    def _split(self, output) -> typing.Iterator[bytes]:
+        # recorded output in the chunks or lines it would have arrived in
+        if not output:
+            return
+        output = output.encode() if isinstance(output, str) else bytes(output)
+        if self._lines:
+            yield from output.splitlines(keepends=True)
+        else:
+            for offset in range(0, len(output), self._chunk_size):
+                yield output[offset:offset + self._chunk_size]
+
+    async def _read(self, source: str, reader: asyncio.StreamReader, queue: asyncio.Queue):
+        while True:
+            if self._lines:
+                value = await self._read_line(reader)
+            else:
+                value = await reader.read(self._chunk_size)
+            if not value:
+                break
+            await queue.put(Output(source, value))
+        await queue.put(None)
+
+    async def _read_line(self, reader: asyncio.StreamReader) -> bytes:
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as error:
+            # the last line has no line ending
+            return error.partial
+        except asyncio.LimitOverrunError as error:
+            # a line longer than the buffer limit is yielded in pieces
+            return await reader.read(error.consumed)
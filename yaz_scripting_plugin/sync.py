@@ -0,0 +1,155 @@
+"""Synchronous access to Shell from threads without an event loop."""
+
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import threading
+import typing
+import yaz
+
+from .log import logger
+from .shell import Shell
+
+__all__ = ["LoopThread", "get_loop_thread", "SyncShell"]
+
+
+class LoopThread:
+    """An event loop that runs forever in a daemon thread and executes coroutines submitted from other threads
+
+    The loop and its thread are started on first use, and started again in a
+    child process after fork(), where the thread of the parent does not exist.
+    """
+
+    def __init__(self, name: str = "yaz-shell-loop"):
+        self.name = name
+        self.loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<LoopThread {} {}>".format(self.name, "running" if self.is_running() else "stopped")
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def in_loop_thread(self) -> bool:
+        return self._thread is threading.current_thread()
+
+    def submit(self, coroutine: typing.Awaitable) -> concurrent.futures.Future:
+        """Schedule COROUTINE on the loop and return a concurrent.futures.Future for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop())
+
+    def call(self, coroutine: typing.Awaitable, timeout: typing.Optional[float] = None):
+        """Run COROUTINE on the loop and return its result, blocking the calling thread
+
+        When TIMEOUT seconds pass, or the calling thread is interrupted, the
+        coroutine is cancelled, which terminates the processes it started.
+        """
+        if self.in_loop_thread():
+            coroutine.close()
+            raise RuntimeError("{!r} can not wait for itself, await the coroutine instead".format(self))
+        future = self.submit(coroutine)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self, timeout: typing.Optional[float] = 10.0):
+        """Cancel what is still running, stop the loop and wait for its thread"""
+        with self._lock:
+            if not self.is_running():
+                return
+            loop, thread = self.loop, self._thread
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), loop).result(timeout)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout)
+            self.loop = self._thread = self._pid = None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        if self.is_running():
+            return self.loop
+        with self._lock:
+            if not self.is_running():
+                loop = asyncio.new_event_loop()
+                started = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(loop, started), name=self.name, daemon=True)
+                self._thread.start()
+                started.wait()
+                self.loop, self._pid = loop, os.getpid()
+                logger.debug("Started %r", self)
+            return self.loop
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop, started: threading.Event):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(started.set)
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+
+    @staticmethod
+    async def _cancel_tasks():
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_loop_thread = LoopThread()
+
+
+def get_loop_thread() -> LoopThread:
+    """Returns the LoopThread shared by everything in this process"""
+    return _loop_thread
+
+
+class SyncShell(yaz.BasePlugin):
+    """Blocking versions of the Shell methods, for callers without an event loop, i.e. WSGI workers or thread pools
+
+    Every call is executed by SELF.SHELL on the event loop of get_loop_thread(),
+    so any number of threads can use it at the same time without creating an
+    event loop of their own.  The scheduler, pool and result cache of that
+    shell are shared by all of them.  SELF.SHELL is a Shell of its own, created
+    from the same plugin class as the shared Shell: the state of a Shell is
+    bound to the event loop that uses it, and the shared Shell may be used by
+    an event loop in another thread at the same time.
+
+    For example:
+    - stdout, stderr = yaz.get_plugin_instance(SyncShell).get("git rev-parse HEAD")
+    """
+
+    @yaz.dependency
+    def set_shell(self, shell: Shell):
+        self.shell = type(shell)()
+        if shell.templating is not None:
+            self.shell.set_templating(shell.templating)
+        self.loop_thread = get_loop_thread()
+
+    def get(self, *args, **kwargs) -> (str, str):
+        """Execute and return (stdout, stderr), see Shell.get()"""
+        return self.loop_thread.call(self.shell.get(*args, **kwargs))
+
+    def get_many(self, *args, **kwargs) -> list:
+        """Execute a batch of commands and return their results in order, see Shell.get_many()"""
+        return self.loop_thread.call(self.shell.get_many(*args, **kwargs))
+
+    def pipeline(self, *args, **kwargs) -> (str, str, typing.List[int]):
+        """Execute connected commands and return (stdout, stderr, return_codes), see Shell.pipeline()"""
+        return self.loop_thread.call(self.shell.pipeline(*args, **kwargs))
+
+    def run(self, *args, **kwargs):
+        """Execute and interact in a separate window or screen, see Shell.run()"""
+        return self.loop_thread.call(self.shell.run(*args, **kwargs))
+
+    def close(self):
+        """Stop the pool workers that were started on the loop thread"""
+        if self.loop_thread.is_running():
+            self.loop_thread.call(self.shell.pool.close())
+
+
+atexit.register(_loop_thread.stop)
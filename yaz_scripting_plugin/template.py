@@ -0,0 +1,119 @@
+"""Bounded cache of compiled templates."""
+
+import collections
+import os
+import typing
+
+from .log import logger
+
+__all__ = ["TemplateCache", "CacheInfo"]
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "evictions", "skips", "maxsize", "currsize"])
+
+# a string without any of these markers renders to itself
+TEMPLATE_MARKERS = ("{{", "{%", "{#")
+
+# the settings of an environment that change the code a template compiles to
+COMPILE_SETTINGS = ("block_start_string", "block_end_string", "variable_start_string", "variable_end_string",
+                    "comment_start_string", "comment_end_string", "line_statement_prefix", "line_comment_prefix",
+                    "trim_blocks", "lstrip_blocks", "newline_sequence", "keep_trailing_newline", "optimized", "autoescape")
+
+
+def is_plain(source: str) -> bool:
+    """Returns True when SOURCE contains no template syntax"""
+    return "\r" not in source and not any(marker in source for marker in TEMPLATE_MARKERS)
+
+
+class TemplateCache:
+    """Least recently used cache of compiled templates, keyed by their source string
+
+    Strings without template syntax are never compiled.  Jinja removes a single
+    trailing newline from its output, this is mimicked for those strings.
+
+    ENVIRONMENT is the jinja Environment, or a function that returns it, which
+    is only called once the first template is compiled.  When
+    BYTECODE_CACHE_PATH is given, compiled templates are also stored in that
+    directory, so that later processes load them instead of compiling again.
+    """
+
+    def __init__(self, environment, maxsize: int = 256, bytecode_cache_path: typing.Optional[str] = None):
+        assert isinstance(maxsize, int) and maxsize >= 0, maxsize
+        self._environment = environment
+        self.maxsize = maxsize
+        self.bytecode_cache_path = None if bytecode_cache_path is None else os.path.expanduser(bytecode_cache_path)
+        self._bytecode_cache = None
+        self._settings = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skips = 0
+        self._templates = collections.OrderedDict()
+
+    def render(self, source: str, context: typing.Optional[dict] = None) -> str:
+        assert isinstance(source, str), type(source)
+        assert context is None or isinstance(context, dict), type(context)
+
+        if is_plain(source):
+            self.skips += 1
+            return source[:-1] if source.endswith("\n") else source
+
+        return self.get_template(source).render({} if context is None else context)
+
+    def get_template(self, source: str):
+        """Returns the compiled template for SOURCE, compiling it when it is not cached"""
+        template = self._templates.get(source)
+        if template is not None:
+            self.hits += 1
+            self._templates.move_to_end(source)
+            return template
+
+        self.misses += 1
+        template = self._compile(source)
+        if self.maxsize:
+            self._templates[source] = template
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+                self.evictions += 1
+        return template
+
+    @property
+    def environment(self):
+        if callable(self._environment):
+            self._environment = self._environment()
+        return self._environment
+
+    def _compile(self, source: str):
+        environment = self.environment
+        if self.bytecode_cache_path is None:
+            return environment.from_string(source)
+
+        if self._bytecode_cache is None:
+            import jinja2
+            try:
+                os.makedirs(self.bytecode_cache_path, exist_ok=True)
+            except OSError as error:
+                return self._disable_bytecode_cache(error, source)
+            self._bytecode_cache = jinja2.FileSystemBytecodeCache(self.bytecode_cache_path)
+            self._settings = repr([getattr(environment, name) for name in COMPILE_SETTINGS] + sorted(environment.extensions))
+
+        # the bucket is keyed by the settings and the source, the template itself remains nameless like from_string()
+        bucket = self._bytecode_cache.get_bucket(environment, self._settings + source, None, source)
+        if bucket.code is None:
+            bucket.code = environment.compile(source)
+            try:
+                self._bytecode_cache.set_bucket(bucket)
+            except OSError as error:
+                return self._disable_bytecode_cache(error, source)
+        return environment.template_class.from_code(environment, bucket.code, environment.make_globals(None))
+
+    def _disable_bytecode_cache(self, error: OSError, source: str):
+        logger.warning("Template bytecode cache %s disabled: %s", self.bytecode_cache_path, error)
+        self.bytecode_cache_path = None
+        return self.environment.from_string(source)
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.evictions, self.skips, self.maxsize, len(self._templates))
+
+    def clear(self):
+        self._templates.clear()
+        self.hits = self.misses = self.evictions = self.skips = 0
@@ -0,0 +1,9 @@
+import atexit
+import shutil
+import tempfile
+
+from yaz_scripting_plugin import Shell
+
+# the tests never keep compiled templates in the home directory
+Shell.template_bytecode_cache_path = tempfile.mkdtemp(prefix="yaz-template-cache-")
+atexit.register(shutil.rmtree, Shell.template_bytecode_cache_path, True)
@@ -0,0 +1,64 @@
+import unittest
+import unittest.mock
+
+from yaz_scripting_plugin.capture import Capture, SpilledOutput
+from yaz_scripting_plugin.error import InvalidReturnCodeError, PipelineError, ProcessTimeoutError
+
+
+class TestCapture(unittest.TestCase):
+    def test_010_unbounded(self):
+        """Should keep all output by default"""
+        capture = Capture()
+        for chunk in [b"Hello", b" ", b"World!"]:
+            capture.write(chunk)
+        self.assertEqual(b"Hello World!", capture.getvalue())
+
+    def test_020_max_bytes(self):
+        """Should keep the head and the tail"""
+        capture = Capture(max_bytes=10)
+        for index in range(1000):
+            capture.write(str(index % 10).encode() * 7)
+        self.assertTrue(capture.truncated)
+        self.assertLessEqual(len(capture._head) + len(capture._tail), 20)
+        self.assertEqual(b"00000" + Capture.marker % (7000 - 10) + b"99999", capture.getvalue())
+
+        capture = Capture(max_bytes=10)
+        capture.write(b"0123456789")
+        self.assertFalse(capture.truncated)
+        self.assertEqual(b"0123456789", capture.getvalue())
+
+    def test_030_spill(self):
+        """Should spill to a temporary file above the threshold"""
+        capture = Capture(spill_bytes=4)
+        capture.write(b"Hello")
+        capture.write(b" World!")
+        with capture.getvalue() as output:
+            self.assertIsInstance(output, SpilledOutput)
+            self.assertEqual(12, len(output))
+            self.assertEqual(b"Hello World!", bytes(output))
+            self.assertEqual(b"World!", output[-6:])
+
+    def test_040_error_tail(self):
+        """Should keep a bounded tail of the output of a failed process"""
+        error = InvalidReturnCodeError(1, b"x" * (InvalidReturnCodeError.output_limit + 10), b"")
+        self.assertEqual(InvalidReturnCodeError.output_limit, len(error.get_stdout()))
+        self.assertEqual(InvalidReturnCodeError.output_limit + 10, error.stdout_size)
+
+        with unittest.mock.patch.object(InvalidReturnCodeError, "output_limit", 4):
+            self.assertEqual(b"3456", InvalidReturnCodeError(1, b"123456").get_stdout())
+            self.assertEqual(b"3456", PipelineError([0, 1], 1, b"123456").get_stdout())
+            self.assertEqual(b"3456", ProcessTimeoutError("sleep 1", 0.1, b"123456").get_stdout())
+        with unittest.mock.patch.object(InvalidReturnCodeError, "output_limit", None):
+            self.assertEqual(b"123456", ProcessTimeoutError("sleep 1", 0.1, b"123456").get_stdout())
+
+    def test_050_incremental_decode(self):
+        """Should decode while collecting, and fall back to bytes for invalid output"""
+        capture = Capture(encoding="utf-8")
+        for chunk in ["Hello Wörld!".encode()[:7], "Hello Wörld!".encode()[7:]]:
+            capture.write(chunk)
+        self.assertEqual("Hello Wörld!", capture.getvalue())
+
+        capture = Capture(encoding="utf-8")
+        for chunk in [b"Hello \xc3", b"\xb6 \xff World!"]:
+            capture.write(chunk)
+        self.assertEqual(b"Hello \xc3\xb6 \xff World!", capture.getvalue())
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+import yaz
+
+from yaz_scripting_plugin import Shell
+from yaz_scripting_plugin.capture import BYTES, SpilledOutput
+from yaz_scripting_plugin.cassette import CassetteMissError
+from yaz_scripting_plugin.error import InvalidReturnCodeError, PipelineError
+from yaz_scripting_plugin.parse import JsonLinesParser
+
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        self.shell = yaz.get_plugin_instance(Shell)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.cassette")
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.shell.set_execution_mode(None)
+        self.directory.cleanup()
+        asyncio.set_event_loop(None)
+
+    def test_010_record_replay(self):
+        """Should replay recorded calls, in order, without starting processes"""
+        async def test():
+            self.shell.set_execution_mode("record", self.path)
+            self.assertEqual(("slow\n", ""), await self.shell.get("sleep 0.2 && echo {{ word }}", context=dict(word="slow")))
+            self.assertEqual((b"\xff", ""), await self.shell.get("cat", b"\xff", stdout=BYTES))
+            counter = os.path.join(self.directory.name, "counter")
+            await self.shell.get("echo 1 > {{ path }}", context=dict(path=counter))
+            self.assertEqual(("1\n", ""), await self.shell.get("cat {{ path }}", context=dict(path=counter)))
+            await self.shell.get("echo 2 > {{ path }}", context=dict(path=counter))
+            self.assertEqual(("2\n", ""), await self.shell.get("cat {{ path }}", context=dict(path=counter)))
+            with self.assertRaises(InvalidReturnCodeError):
+                await self.shell.get("sh -c 'echo oops >&2; exit 3'")
+            self.assertEqual(("3\n", "", [0, 0]), await self.shell.pipeline(["seq 3", "wc -l"]))
+
+            self.shell.set_execution_mode("replay", self.path)
+            start = time.perf_counter()
+            self.assertEqual(("slow\n", ""), await self.shell.get("sleep 0.2 && echo {{ word }}", context=dict(word="slow")))
+            self.assertLess(time.perf_counter() - start, 0.1)
+            self.assertEqual(("\ufffd", None), await self.shell.get("cat", b"\xff", stderr="discard"))
+            with self.assertRaises(CassetteMissError):
+                await self.shell.get("cat", b"other input")
+            with self.assertRaises(InvalidReturnCodeError) as context:
+                await self.shell.get("sh -c 'echo oops >&2; exit 3'")
+            self.assertEqual((3, b"oops\n"), (context.exception.return_code, context.exception.stderr))
+            self.assertEqual(("", "oops\n"), await self.shell.get("sh -c 'echo oops >&2; exit 3'", valid_codes=(3,)))
+            self.assertEqual(("3\n", "", [0, 0]), await self.shell.pipeline(["seq 3", "wc -l"]))
+            # recordings of the same call are replayed in order, the last one is repeated
+            self.assertEqual(("1\n", ""), await self.shell.get("cat {{ path }}", context=dict(path=counter)))
+            self.assertEqual(("2\n", ""), await self.shell.get("cat {{ path }}", context=dict(path=counter)))
+            self.assertEqual(("2\n", ""), await self.shell.get("cat {{ path }}", context=dict(path=counter)))
+            with self.assertRaises(PipelineError):
+                await self.shell.pipeline(["seq 3", "wc -l"], valid_codes=[(0,), (1,)])
+
+        self.loop.run_until_complete(test())
+
+    def test_020_fall_through(self):
+        """Should execute calls that were not recorded when asked to"""
+        async def test():
+            self.shell.set_execution_mode("record", self.path)
+            await self.shell.get("echo recorded")
+            self.shell.set_execution_mode("replay", self.path, fall_through=True)
+            self.assertEqual(("executed\n", ""), await self.shell.get("echo executed"))
+
+        self.loop.run_until_complete(test())
+
+    def test_030_dry_run(self):
+        """Should log calls and answer them without executing"""
+        async def test():
+            self.shell.set_execution_mode("dry-run")
+            path = os.path.join(self.directory.name, "created")
+            with self.assertLogs("yaz_scripting_plugin", "INFO") as logs:
+                self.assertEqual(("", ""), await self.shell.get("touch {{ path }}", context=dict(path=path)))
+            self.assertFalse(os.path.exists(path))
+            self.assertIn("Skip [touch {}] in dry run".format(path), [record.getMessage() for record in logs.records])
+            self.assertEqual(("", "", [0, 0]), await self.shell.pipeline(["touch {{ path }}", "cat"], context=dict(path=path)))
+            self.assertFalse(os.path.exists(path))
+
+        self.loop.run_until_complete(test())
+
+    def test_040_record_spilled(self):
+        """Should record output that was spilled to a temporary file"""
+        async def test():
+            self.shell.set_execution_mode("record", self.path)
+            stdout, _ = await self.shell.get("head -c 5000 /dev/zero", stdout=BYTES, spill_bytes=1000)
+            with stdout:
+                self.assertIsInstance(stdout, SpilledOutput)
+                self.assertEqual(b"\0" * 5000, bytes(stdout))
+
+            self.shell.set_execution_mode("replay", self.path)
+            self.assertEqual((b"\0" * 5000, ""), await self.shell.get("head -c 5000 /dev/zero", stdout=BYTES, spill_bytes=1000))
+
+        self.loop.run_until_complete(test())
+
+    def test_050_stream(self):
+        """Should record, replay and skip streams, and the parsers built on them"""
+        async def test():
+            path = os.path.join(self.directory.name, "created")
+            cmd = "sh -c 'touch {{ path }}; seq 3; echo oops >&2'"
+
+            self.shell.set_execution_mode("record", self.path)
+            self.assertEqual([1, 2, 3], [record async for record in self.shell.parse(cmd, JsonLinesParser(), context=dict(path=path))])
+            os.remove(path)
+
+            self.shell.set_execution_mode("replay", self.path)
+            outputs = [(output.source, output.value) async for output in self.shell.stream(cmd, context=dict(path=path), lines=True)]
+            self.assertEqual([("stdout", b"1\n"), ("stdout", b"2\n"), ("stdout", b"3\n"), ("stderr", b"oops\n")], outputs)
+            with self.assertRaises(CassetteMissError):
+                self.shell.stream("seq 4")
+            self.assertFalse(os.path.exists(path))
+
+            self.shell.set_execution_mode("dry-run")
+            self.assertEqual({}, await self.shell.get_columns(cmd, JsonLinesParser(), context=dict(path=path)))
+            self.assertFalse(os.path.exists(path))
+
+        self.loop.run_until_complete(test())
@@ -0,0 +1,15 @@
+import unittest
+
+from yaz_scripting_plugin.command import split_command
+
+
+class TestSplitCommand(unittest.TestCase):
+    def test_010_plain(self):
+        """Should split commands without shell syntax"""
+        self.assertEqual(["git", "status"], split_command("git status"))
+        self.assertEqual(["git", "log", "--format=%H", "hello world"], split_command("git log --format=%H 'hello world'"))
+
+    def test_020_shell(self):
+        """Should refuse commands that need /bin/sh"""
+        for cmd in ["", "ls | wc -l", "echo $HOME", "ls *.py", "cd /tmp", "FOO=bar env", "exit 3", "echo 'unbalanced", "ls ~", "a && b", "cat < file"]:
+            self.assertIsNone(split_command(cmd), cmd)
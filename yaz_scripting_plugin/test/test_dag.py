@@ -0,0 +1,139 @@
+import asyncio
+import time
+import unittest
+import yaz
+
+from yaz_scripting_plugin import Dag, Shell
+from yaz_scripting_plugin.dag import execute_dag, DONE, FAILED, SKIPPED, CANCELLED
+from yaz_scripting_plugin.error import DagError, InvalidReturnCodeError
+
+
+class TestDag(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def test_010_order(self):
+        """Should start a node once its dependencies are done, and independent nodes together"""
+        async def test():
+            events = []
+
+            async def run(node, context):
+                events.append(("start", node.name))
+                await asyncio.sleep(node.input)
+                events.append(("end", node.name))
+                return node.cmd, ""
+
+            dag = Dag()
+            dag.add("a", "A", 0.05)
+            dag.add("b", "B", 0.01)
+            dag.add("c", "C", 0.0, depends=["a", "b"])
+            result = await execute_dag(dag, run)
+            self.assertEqual([("start", "a"), ("start", "b"), ("end", "b"), ("end", "a"), ("start", "c"), ("end", "c")], events)
+            self.assertEqual([DONE] * 3, [node.status for node in result.results.values()])
+            self.assertEqual(["a", "c"], result.get_critical_path())
+            self.assertEqual(["a", "b", "c"], sorted(name for name, _, _, _ in result.get_timings()))
+            self.assertIn("critical path: a -> c", result.report())
+
+        self.loop.run_until_complete(test())
+
+    def test_020_concurrency(self):
+        """Should run at most CONCURRENCY nodes at the same time"""
+        async def test():
+            running = []
+            peak = []
+
+            async def run(node, context):
+                running.append(node.name)
+                peak.append(len(running))
+                await asyncio.sleep(0.01)
+                running.remove(node.name)
+                return "", ""
+
+            dag = Dag()
+            for index in range(6):
+                dag.add(str(index), "")
+            await execute_dag(dag, run, concurrency=2)
+            self.assertEqual(2, max(peak))
+
+        self.loop.run_until_complete(test())
+
+    def test_030_failure(self):
+        """Should skip the dependents of a failed node, and cancel everything without KEEP_GOING"""
+        async def test():
+            async def run(node, context):
+                await asyncio.sleep(node.input)
+                if node.cmd == "fail":
+                    raise InvalidReturnCodeError(1)
+                return "", ""
+
+            dag = Dag()
+            dag.add("fail", "fail", 0.0)
+            dag.add("child", "", 0.0, depends=["fail"])
+            dag.add("grandchild", "", 0.0, depends=["child"])
+            dag.add("slow", "", 0.1)
+
+            result = await execute_dag(dag, run)
+            self.assertEqual([FAILED, SKIPPED, SKIPPED, DONE], [node.status for node in result.results.values()])
+            self.assertEqual(["fail"], result.get_failed())
+
+            result = await execute_dag(dag, run, keep_going=False)
+            self.assertEqual([FAILED, SKIPPED, SKIPPED, CANCELLED], [node.status for node in result.results.values()])
+
+        self.loop.run_until_complete(test())
+
+    def test_040_invalid(self):
+        """Should only accept dependencies on nodes that were added before"""
+        dag = Dag()
+        dag.add("a", "true")
+        with self.assertRaises(AssertionError):
+            dag.add("b", "true", depends=["c"])
+        with self.assertRaises(AssertionError):
+            dag.add("a", "true")
+
+
+class TestShellDag(unittest.TestCase):
+    def setUp(self):
+        self.shell = yaz.get_plugin_instance(Shell)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def test_010_execute(self):
+        """Should render a node with the outputs of its ancestors and run independent nodes in parallel"""
+        async def test():
+            dag = Dag()
+            dag.add("name", "echo {{ name }}", output="name")
+            dag.add("sleep1", "sleep 0.5")
+            dag.add("sleep2", "sleep 0.5")
+            dag.add("upper", "tr a-z A-Z", "{{ name }}!", depends=["name"], output="upper")
+            dag.add("greet", "echo hello {{ upper }} from {{ name }}", depends=["upper", "sleep1"])
+            start = time.perf_counter()
+            result = await self.shell.execute_dag(dag, dict(name="world"))
+            self.assertLess(time.perf_counter() - start, 0.95)
+            self.assertEqual("hello WORLD! from world\n", result.results["greet"].stdout)
+            self.assertEqual("greet", result.get_critical_path()[-1])
+
+        self.loop.run_until_complete(test())
+
+    def test_020_error(self):
+        """Should raise a DagError with the result of every node"""
+        async def test():
+            dag = Dag()
+            dag.add("fail", "exit 3")
+            dag.add("child", "echo child", depends=["fail"])
+            dag.add("other", "echo other")
+            with self.assertRaises(DagError) as context:
+                await self.shell.execute_dag(dag)
+            self.assertEqual(["fail"], list(context.exception.get_errors()))
+            self.assertEqual(3, context.exception.get_errors()["fail"].get_return_code())
+            result = context.exception.get_result()
+            self.assertEqual(SKIPPED, result.results["child"].status)
+            self.assertEqual(("other\n", ""), (result.results["other"].stdout, result.results["other"].stderr))
+
+        self.loop.run_until_complete(test())
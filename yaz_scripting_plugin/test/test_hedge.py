@@ -0,0 +1,137 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+import yaz
+
+from yaz_scripting_plugin import Shell
+from yaz_scripting_plugin.error import InvalidReturnCodeError
+from yaz_scripting_plugin.hedge import Hedger, HedgePolicy, RetryPolicy
+
+
+def is_running(argument: str) -> bool:
+    """Returns True when a process with ARGUMENT on its command line is running"""
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open("/proc/{}/cmdline".format(pid), "rb") as file:
+                if argument.encode() in file.read().split(b"\0"):
+                    return True
+        except OSError:
+            pass
+    return False
+
+
+class TestHedger(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def test_010_learn_delay(self):
+        """Should hedge after the percentile of the known latencies"""
+        hedger = Hedger(history_size=10)
+        policy = HedgePolicy(percentile=50, min_samples=5)
+        self.assertIsNone(hedger.get_delay("key", policy))
+        for latency in range(20):
+            hedger.record("key", latency)
+        self.assertEqual(15, hedger.get_delay("key", policy))
+        self.assertEqual(0.5, hedger.get_delay("key", HedgePolicy(0.5)))
+
+    def test_020_hedge(self):
+        """Should use the first call that succeeds and cancel the other one"""
+        async def test():
+            hedger = Hedger()
+            delays = [10.0, 0.0]
+            cancelled = []
+
+            async def call():
+                delay = delays.pop(0)
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    cancelled.append(delay)
+                    raise
+                return delay
+
+            self.assertEqual(0.0, await hedger.run("key", call, HedgePolicy(0.01)))
+            self.assertEqual([10.0], cancelled)
+            self.assertEqual((1, 1, 1, 0, 0), hedger.info())
+
+        self.loop.run_until_complete(test())
+
+    def test_030_retry(self):
+        """Should retry transient return codes only"""
+        async def test():
+            hedger = Hedger()
+            codes = [75, 75, 0]
+
+            async def call():
+                code = codes.pop(0)
+                if code:
+                    raise InvalidReturnCodeError(code)
+                return "done"
+
+            self.assertEqual("done", await hedger.run("key", call, retry=RetryPolicy((75,), backoff=0.001)))
+            self.assertEqual((1, 0, 0, 2, 1), hedger.info())
+
+            codes = [1, 0]
+            with self.assertRaises(InvalidReturnCodeError):
+                await hedger.run("key", call, retry=RetryPolicy((75,), backoff=0.001))
+
+            codes = [75, 75, 0]
+            with self.assertRaises(InvalidReturnCodeError):
+                await hedger.run("key", call, retry=RetryPolicy((75,), attempts=2, backoff=0.001))
+
+        self.loop.run_until_complete(test())
+
+
+class TestShellHedge(unittest.TestCase):
+    def setUp(self):
+        self.shell = yaz.get_plugin_instance(Shell)
+        self.directory = tempfile.TemporaryDirectory()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        asyncio.set_event_loop(None)
+
+    def test_010_hedge(self):
+        """Should answer a slow command with its duplicate and terminate the slow process group"""
+        async def test():
+            # only the first attempt creates the directory, and is slow
+            cmd = "sh -c 'if mkdir {{ path }} 2>/dev/null; then sleep 7.25; fi; echo {{ path }}'"
+            path = os.path.join(self.directory.name, "first")
+            start = time.perf_counter()
+            self.assertEqual((path + "\n", ""), await self.shell.get(cmd, context=dict(path=path), hedge=HedgePolicy(0.05)))
+            self.assertLess(time.perf_counter() - start, 5.0)
+            self.assertFalse(is_running("7.25"))
+
+        self.loop.run_until_complete(test())
+
+    def test_020_retry(self):
+        """Should execute a command again after a transient return code"""
+        async def test():
+            cmd = "sh -c 'if mkdir {{ path }} 2>/dev/null; then exit 75; fi; echo retried'"
+            path = os.path.join(self.directory.name, "first")
+            self.assertEqual(("retried\n", ""), await self.shell.get(cmd, context=dict(path=path), retry=RetryPolicy((75,), backoff=0.01)))
+
+        self.loop.run_until_complete(test())
+
+    def test_030_get_many(self):
+        """Should retry the commands of a batch, and reject unknown options before any command runs"""
+        async def test():
+            cmd = "sh -c 'if mkdir {{{{ path }}}}/{} 2>/dev/null; then exit 75; fi; echo {}'"
+            commands = [cmd.format(index, index) for index in range(3)]
+            results = await self.shell.get_many(commands, dict(path=self.directory.name), retry=RetryPolicy((75,), backoff=0.01))
+            self.assertEqual([("{}\n".format(index), "") for index in range(3)], results)
+
+            path = os.path.join(self.directory.name, "created")
+            with self.assertRaises(TypeError):
+                await self.shell.get_many(["touch {{ path }}"], dict(path=path), retries=3)
+            self.assertFalse(os.path.exists(path))
+
+        self.loop.run_until_complete(test())
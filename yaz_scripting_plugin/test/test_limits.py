@@ -0,0 +1,91 @@
+import asyncio
+import os
+import resource
+import shutil
+import unittest
+import yaz
+
+from yaz_scripting_plugin import Shell
+from yaz_scripting_plugin.limits import AdmissionController, Limits, IONICE_IDLE
+from yaz_scripting_plugin.scheduler import Scheduler, HIGH, LOW
+
+
+class PressureController(AdmissionController):
+    """Reports the load that the test sets, instead of that of the host"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.load = 0.0
+
+    def _sample(self):
+        return self.load, None
+
+
+class TestLimits(unittest.TestCase):
+    def setUp(self):
+        self.shell = yaz.get_plugin_instance(Shell)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def test_010_merge(self):
+        """Should override only the settings that are given"""
+        self.assertEqual(Limits(nice=10, rlimit_cpu=5), Limits(nice=5, rlimit_cpu=5).merge(Limits(nice=10)))
+        self.assertEqual(Limits(nice=5), Limits(nice=5).merge(None))
+        self.assertIsNone(Limits().get_preexec())
+
+    def test_020_apply(self):
+        """Should apply the limits in the child and leave this process alone"""
+        async def test():
+            cpu = min(os.sched_getaffinity(0))
+            limits = Limits(nice=3, cpu_affinity={cpu}, rlimit_nofile=64, rlimit_cpu=60)
+            stdout, _ = await self.shell.get("python3 -c {% quote %}import os, resource\nprint(os.nice(0), sorted(os.sched_getaffinity(0)), resource.getrlimit(resource.RLIMIT_NOFILE), resource.getrlimit(resource.RLIMIT_CPU)){% end_quote %}",
+                                             limits=limits)
+            self.assertEqual("{} [{}] (64, 64) (60, 60)\n".format(os.nice(0) + 3, cpu), stdout)
+            self.assertNotEqual((64, 64), resource.getrlimit(resource.RLIMIT_NOFILE))
+
+            stdout, _, _ = await self.shell.pipeline(["sh -c 'ulimit -n'", "cat"], limits=Limits(rlimit_nofile=32))
+            self.assertEqual("32\n", stdout)
+
+        self.loop.run_until_complete(test())
+
+    @unittest.skipIf(shutil.which("ionice") is None, "ionice is not installed")
+    def test_030_ionice(self):
+        """Should set the io scheduling class"""
+        async def test():
+            stdout, _ = await self.shell.get("ionice", limits=Limits(ionice=IONICE_IDLE))
+            self.assertEqual("idle\n", stdout)
+
+        self.loop.run_until_complete(test())
+
+    def test_040_admission(self):
+        """Should delay launches below the admission priority while the host is under pressure"""
+        async def test():
+            admission = PressureController(max_load=1.0, interval=0.01, max_interval=0.01)
+            scheduler = Scheduler(admission=admission)
+            admission.load = 2.0
+            order = []
+
+            async def launch(name, priority):
+                async with scheduler.slot(priority):
+                    order.append(name)
+
+            tasks = [asyncio.ensure_future(launch("low", LOW)), asyncio.ensure_future(launch("high", HIGH))]
+            await asyncio.sleep(0.05)
+            self.assertEqual(["high"], order)
+
+            admission.load = 0.5
+            await asyncio.gather(*tasks)
+            self.assertEqual(["high", "low"], order)
+            self.assertEqual(1, admission.info().delayed)
+
+            admission.load = 2.0
+            admission.max_delay = 0.05
+            # the host is sampled at most once every interval
+            await asyncio.sleep(0.02)
+            await launch("stalled", LOW)
+            self.assertEqual(2, admission.info().delayed)
+
+        self.loop.run_until_complete(test())
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import logging
+import threading
+import unittest
+
+from yaz_scripting_plugin.log import logger, log_command, StructuredFormatter, start_queue_logging, stop_queue_logging
+
+
+class Handler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+        self.threads.add(threading.current_thread())
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.handler = Handler()
+        logger.addHandler(self.handler)
+        logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        stop_queue_logging()
+        logger.removeHandler(self.handler)
+        logger.setLevel(logging.NOTSET)
+
+    def test_010_fields(self):
+        """Should attach the command fields and summarize long input"""
+        log_command(logging.INFO, "Process [{cmd}] ended with exit code {return_code}", "cat", "x" * 1000, return_code=0, duration=0.5)
+        record, = self.handler.records
+        self.assertEqual("Process [cat] ended with exit code 0 with 1000 bytes of input", record.getMessage())
+        self.assertEqual(dict(cmd="cat", input_size=1000, input_sha256=hashlib.sha256(b"x" * 1000).hexdigest(), input_preview="x" * 64, return_code=0, duration=0.5),
+                         record.command)
+
+        document = json.loads(StructuredFormatter().format(record))
+        self.assertEqual(("INFO", "cat", 0), (document["level"], document["cmd"], document["return_code"]))
+
+    def test_020_lazy(self):
+        """Should not build anything when the level is disabled"""
+        class Unformattable:
+            def __format__(self, spec):
+                raise AssertionError("formatted")
+
+        logger.setLevel(logging.INFO)
+        log_command(logging.DEBUG, "Process [{cmd}] {value}", "ls", value=Unformattable())
+        self.assertEqual([], self.handler.records)
+
+    def test_030_queue(self):
+        """Should hand records to the handlers on a background thread"""
+        start_queue_logging()
+        log_command(logging.INFO, "Execute [{cmd}]", "ls")
+        stop_queue_logging()
+        record, = self.handler.records
+        self.assertEqual("ls", record.command["cmd"])
+        self.assertNotIn(threading.current_thread(), self.handler.threads)
+        self.assertEqual([self.handler], logger.handlers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import pickle
+import tempfile
+import unittest
+
+from yaz_scripting_plugin.memo import DiskBackend, ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def test_010_single_flight(self):
+        """Should share one execution between concurrent identical calls"""
+        cache = ResultCache()
+        calls = []
+
+        async def run():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return ("stdout", "stderr")
+
+        results = self.loop.run_until_complete(asyncio.gather(*[cache.get_or_run("scope", "key", run) for _ in range(5)]))
+        self.assertEqual([("stdout", "stderr")] * 5, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual((0, 1, 4), cache.info()[:3])
+
+        self.assertEqual(("stdout", "stderr"), self.loop.run_until_complete(cache.get_or_run("scope", "key", run)))
+        self.assertEqual(1, cache.info().hits)
+
+    def test_020_limits(self):
+        """Should evict the least recently used results, and expire results"""
+        cache = ResultCache(max_entries=2, max_bytes=10)
+        cache.put("scope", "a", ("aaa", None))
+        cache.put("scope", "b", ("bbb", None))
+        cache.get("scope", "a")
+        cache.put("scope", "c", ("ccc", None))
+        self.assertIsNone(cache.get("scope", "b"))
+        self.assertEqual(("aaa", None), cache.get("scope", "a"))
+
+        cache.put("scope", "d", ("d" * 9, None))
+        self.assertEqual(1, cache.info().entries)
+
+        cache.put("scope", "e", ("e", None), ttl=-1)
+        self.assertIsNone(cache.get("scope", "e"))
+
+    def test_030_invalidate(self):
+        """Should forget results per scope"""
+        cache = ResultCache()
+        cache.put("git", "key", ("a", None))
+        cache.put("docker", "key", ("b", None))
+        cache.invalidate("git")
+        self.assertIsNone(cache.get("git", "key"))
+        self.assertEqual(("b", None), cache.get("docker", "key"))
+
+    def test_040_disk_backend(self):
+        """Should persist results between cache instances"""
+        with tempfile.TemporaryDirectory() as path:
+            ResultCache(backend=DiskBackend(path)).put("scope", "key", ("stdout", b"stderr"))
+            cache = ResultCache(backend=DiskBackend(path))
+            self.assertEqual(("stdout", b"stderr"), cache.get("scope", "key"))
+            cache.invalidate("scope")
+            self.assertIsNone(ResultCache(backend=DiskBackend(path)).get("scope", "key"))
+
+    def test_050_disk_backend_unreadable(self):
+        """Should remove entries that can not be unpickled, and treat them as misses"""
+        with tempfile.TemporaryDirectory() as path:
+            backend = DiskBackend(path)
+            backend.put("scope", "key", None, ("stdout", b"stderr"))
+            with open(backend._get_path("scope", "key"), "rb") as file:
+                data = file.read()
+            # a class that was removed, or a module that no longer exists
+            stale = [b"cbuiltins\nYazGone\n.", b"cyaz_gone\nYazGone\n."]
+            for content in [data[:len(data) // 2], pickle.dumps("not an entry"), b"garbage"] + stale:
+                with open(backend._get_path("scope", "key"), "wb") as file:
+                    file.write(content)
+                self.assertIsNone(ResultCache(backend=backend).get("scope", "key"), content)
+                self.assertFalse(os.path.exists(backend._get_path("scope", "key")))
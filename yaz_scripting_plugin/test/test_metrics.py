@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import unittest
+
+from yaz_scripting_plugin.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def test_010_aggregate(self):
+        """Should aggregate metrics per program and pass each of them to the hooks"""
+        registry = MetricsRegistry()
+        seen = []
+        registry.subscribe(seen.append)
+        for cmd in ("git status", "/usr/bin/git log", "ls -l"):
+            with registry.measure(cmd, "get", 0.5) as metrics:
+                metrics.spawned()
+                metrics.bytes_out = 10
+                metrics.return_code = 0
+        with self.assertRaises(KeyError):
+            with registry.measure("ls /missing", "get"):
+                raise KeyError()
+
+        self.assertEqual(["git status", "/usr/bin/git log", "ls -l", "ls /missing"], [metrics.cmd for metrics in seen])
+        self.assertEqual("KeyError", seen[-1].error)
+        snapshot = registry.snapshot()
+        self.assertEqual(["git", "ls"], sorted(snapshot))
+        self.assertEqual((2, 0, 1.0, 20), (snapshot["git"]["count"], snapshot["git"]["errors"], snapshot["git"]["render_time"], snapshot["git"]["bytes_out"]))
+        self.assertEqual((2, 1), (snapshot["ls"]["count"], snapshot["ls"]["errors"]))
+        self.assertEqual(snapshot, json.loads(registry.to_json()))
+
+    def test_020_overlap(self):
+        """Should measure commands that overlap independently"""
+        registry = MetricsRegistry()
+        with registry.measure("first", "get") as first:
+            with registry.measure("second", "get") as second:
+                pass
+        self.assertGreaterEqual(first.wall_time, second.wall_time)
+        self.assertEqual({"cmd", "kind", "program", "render_time", "spawn_time", "wall_time", "bytes_in", "bytes_out", "return_code", "error"},
+                         set(first.as_dict()))
+
+    def test_030_prometheus(self):
+        """Should export in the Prometheus text format"""
+        registry = MetricsRegistry()
+        with registry.measure("say \"hi\"", "get"):
+            pass
+        text = registry.to_prometheus()
+        self.assertIn("# TYPE yaz_shell_commands_total counter\n", text)
+        self.assertIn("yaz_shell_commands_total{program=\"say\"} 1.0\n", text)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "yaz.prom")
+            registry.write_prometheus(path)
+            with open(path) as file:
+                self.assertEqual(text, file.read())
+            self.assertEqual(["yaz.prom"], os.listdir(directory))
+
+    def test_040_disabled(self):
+        """Should record nothing when disabled"""
+        registry = MetricsRegistry(enabled=False)
+        seen = []
+        registry.subscribe(seen.append)
+        with registry.measure("ls", "get") as metrics:
+            metrics.spawned()
+        self.assertEqual(([], {}), (seen, registry.snapshot()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import array
+import json
+import time
+import unittest
+
+from yaz_scripting_plugin.parse import Columns, CsvParser, JsonLinesParser, RegexParser, SplitParser
+
+
+def feed(parser, data: bytes, size: int) -> list:
+    """Returns the records of DATA fed to PARSER in chunks of SIZE bytes"""
+    records = []
+    for offset in range(0, len(data), size):
+        records.extend(parser.feed(data[offset:offset + size]))
+    records.extend(parser.close())
+    return records
+
+
+class TestParse(unittest.TestCase):
+    def test_010_json_lines(self):
+        """Should parse JSON documents split across chunks"""
+        documents = [dict(index=index, name="ü{}".format(index)) for index in range(100)]
+        data = b"".join(json.dumps(document, ensure_ascii=False).encode() + b"\n" for document in documents) + b"\n"
+        for size in (1, 7, 4096):
+            self.assertEqual(documents, feed(JsonLinesParser(), data, size))
+        self.assertEqual([1, 2], feed(JsonLinesParser(), b"1\n2", 1))
+
+    def test_020_split(self):
+        """Should split on NUL and keep undecodable file names"""
+        data = b"a\0b c\0\xff\0"
+        self.assertEqual(["a", "b c", "\udcff"], feed(SplitParser(), data, 2))
+        self.assertEqual([b"a", b"b c", b"\xff"], feed(SplitParser(encoding=None), data, 2))
+        self.assertEqual(["a", "b"], feed(SplitParser(b"\r\n"), b"a\r\nb", 1))
+
+    def test_030_csv(self):
+        """Should parse CSV and TSV with quoted line breaks across chunks"""
+        data = 'name,note\nalice,"multi\nline, with ""quotes"""\nbob,ü\n'.encode()
+        for size in (1, 5, 4096):
+            parser = CsvParser()
+            self.assertEqual([dict(name="alice", note='multi\nline, with "quotes"'), dict(name="bob", note="ü")], feed(parser, data, size))
+            self.assertEqual(["name", "note"], parser.fieldnames)
+        self.assertEqual([["a", "b"], ["c", "d"]], feed(CsvParser(header=False, delimiter="\t"), b"a\tb\nc\td", 3))
+
+    def test_040_regex(self):
+        """Should match every line and count the lines that do not match"""
+        parser = RegexParser(r"(?P<key>\w+)=(?P<value>\d+)")
+        self.assertEqual([dict(key="a", value="1"), dict(key="b", value="2")], feed(parser, b"a=1\n# comment\nb=2\n", 3))
+        self.assertEqual(1, parser.skipped)
+        self.assertEqual([("a", "1")], feed(RegexParser(r"(\w)=(\d)"), b"a=1", 1))
+
+    def test_050_columns(self):
+        """Should collect records per field, compacting numeric columns"""
+        columns = Columns()
+        columns.extend([dict(a=1, b="x"), dict(a=2, c=0.5), dict(a=3, b="z")])
+        value = columns.getvalue()
+        self.assertEqual(array.array("q", [1, 2, 3]), value["a"])
+        self.assertEqual(["x", None, "z"], value["b"])
+        self.assertEqual([None, 0.5, None], value["c"])
+
+        columns = Columns(typed=False)
+        columns.extend([(1.5, "x"), (2.5, "y")])
+        self.assertEqual({0: [1.5, 2.5], 1: ["x", "y"]}, columns.getvalue())
+        self.assertEqual(array.array("d", [1.5, 2.5]), Columns._compact([1.5, 2.5]))
+
+    def test_060_long_record(self):
+        """Should not copy a record that spans many chunks on every chunk"""
+        line = b"x" * (1024 * 1024)
+        field = "\n".join(["y" * 100] * 1000)
+        start = time.perf_counter()
+        self.assertEqual([line.decode(), "z"], feed(SplitParser(b"\n"), line + b"\nz", 16))
+        self.assertEqual([["a", field], ["b", "c"]], feed(CsvParser(header=False), 'a,"{}"\nb,c\n'.format(field).encode(), 16))
+        self.assertLess(time.perf_counter() - start, 2.0)
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from yaz_scripting_plugin.pool import WorkerPool
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(size=2, max_commands=3)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.pool.close())
+        asyncio.set_event_loop(None)
+
+    def test_010_execute(self):
+        """Should return the return code, stdout and stderr of a command"""
+        result = self.loop.run_until_complete(self.pool.execute("printf 'to stdout' && printf 'to stderr' >&2 && exit 3"))
+        self.assertEqual((3, b"to stdout", b"to stderr"), result)
+
+    def test_020_isolation(self):
+        """Should not leak state between commands"""
+        async def test():
+            for _ in range(4):
+                self.assertEqual((0, b"/\n", b""), await self.pool.execute("cd / && pwd && FOO=bar && export FOO"))
+                self.assertEqual((0, b"\n", b""), await self.pool.execute("echo $FOO"))
+
+        self.loop.run_until_complete(test())
+
+    def test_030_syntax_error(self):
+        """Should survive a command with a syntax error"""
+        async def test():
+            return_code, _, stderr = await self.pool.execute("echo (")
+            self.assertEqual(2, return_code)
+            self.assertNotEqual(b"", stderr)
+            self.assertEqual((0, b"ok\n", b""), await self.pool.execute("echo ok"))
+
+        self.loop.run_until_complete(test())
+
+    def test_040_recycle(self):
+        """Should replace workers after max_commands and after leaked output"""
+        async def test():
+            await asyncio.gather(*[self.pool.execute("true") for _ in range(12)])
+            await asyncio.sleep(0)
+            self.assertGreater(self.pool.info().recycled, 0)
+            self.assertLessEqual(len(self.pool._workers), 2)
+
+            recycled = self.pool.info().recycled
+            await self.pool.execute("(sleep 0.1; echo leaked) &")
+            await asyncio.sleep(0.2)
+            await self.pool.execute("true")
+            self.assertEqual((0, b"clean\n", b""), await self.pool.execute("echo clean"))
+            self.assertGreater(self.pool.info().recycled, recycled)
+
+        self.loop.run_until_complete(test())
+
+    def test_050_directory_and_environment(self):
+        """Should execute in the current directory and environment, like a new process"""
+        async def test():
+            self.assertEqual((0, b"unset\n", b""), await self.pool.execute("echo ${YAZ_POOL_TEST-unset}"))
+            cwd = os.getcwd()
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+                try:
+                    self.assertEqual((0, os.getcwd().encode() + b"\n", b""), await self.pool.execute("pwd"))
+                finally:
+                    os.chdir(cwd)
+            self.assertEqual((0, cwd.encode() + b"\n", b""), await self.pool.execute("pwd"))
+
+            with unittest.mock.patch.dict(os.environ, YAZ_POOL_TEST="set"):
+                self.assertEqual((0, b"set\n", b""), await self.pool.execute("echo ${YAZ_POOL_TEST-unset}"))
+            self.assertEqual((0, b"unset\n", b""), await self.pool.execute("echo ${YAZ_POOL_TEST-unset}"))
+
+        self.loop.run_until_complete(test())
@@ -0,0 +1,146 @@
+import asyncio
+import unittest
+
+from yaz_scripting_plugin.pump import Pump
+
+
+class Writer:
+    """Collects what is written, drain() takes a loop iteration like a real transport would"""
+
+    def __init__(self):
+        self.chunks = []
+        self.drains = 0
+
+    def write(self, data: bytes):
+        self.chunks.append(data)
+
+    async def drain(self):
+        self.drains += 1
+        await asyncio.sleep(0)
+
+    def is_closing(self) -> bool:
+        return False
+
+
+class SlowTransport:
+    """Buffers what is written until the writer drains, like the transport of a screen that reads slowly"""
+
+    def __init__(self, high: int):
+        self.high = high
+        self.size = 0
+        self.peak = 0
+
+    def get_write_buffer_size(self) -> int:
+        return self.size
+
+    def get_write_buffer_limits(self) -> tuple:
+        return self.high // 4, self.high
+
+
+class SlowWriter(Writer):
+    def __init__(self, high: int):
+        super().__init__()
+        self.transport = SlowTransport(high)
+
+    def write(self, data: bytes):
+        super().write(data)
+        self.transport.size += len(data)
+        self.transport.peak = max(self.transport.peak, self.transport.size)
+
+    async def drain(self):
+        self.drains += 1
+        if self.transport.size > self.transport.high:
+            await asyncio.sleep(0.001)
+            self.transport.size = 0
+
+
+class TestPump(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def test_010_copy(self):
+        """Should copy several readers into one writer and coalesce their chunks"""
+        async def test():
+            writer = Writer()
+            pump = Pump(writer, flush_bytes=16 * 1024)
+            readers = [asyncio.StreamReader(), asyncio.StreamReader()]
+
+            async def produce(reader, data):
+                for _ in range(1000):
+                    reader.feed_data(data)
+                    await asyncio.sleep(0)
+                reader.feed_eof()
+
+            await asyncio.gather(pump.copy(readers[0]), pump.copy(readers[1]), produce(readers[0], b"o" * 100), produce(readers[1], b"e" * 100))
+            await pump.flush()
+            data = b"".join(writer.chunks)
+            self.assertEqual(100000, data.count(b"o"))
+            self.assertEqual(100000, data.count(b"e"))
+            self.assertEqual(200000, pump.info().bytes)
+            self.assertLess(pump.info().writes, 20)
+
+        self.loop.run_until_complete(test())
+
+    def test_020_flush_interval(self):
+        """Should write output right away, and output that follows shortly after once the flush interval expires"""
+        async def test():
+            writer = Writer()
+            pump = Pump(writer, flush_interval=0.01)
+            reader = asyncio.StreamReader()
+            task = asyncio.ensure_future(pump.copy(reader))
+            reader.feed_data(b"$ ")
+            await asyncio.sleep(0)
+            self.assertEqual([b"$ "], writer.chunks)
+            reader.feed_data(b"prompt> ")
+            await asyncio.sleep(0)
+            self.assertEqual([b"$ "], writer.chunks)
+            await asyncio.sleep(0.05)
+            self.assertEqual([b"$ ", b"prompt> "], writer.chunks)
+            reader.feed_eof()
+            await task
+            pump.close()
+
+        self.loop.run_until_complete(test())
+
+    def test_030_adaptive_read(self):
+        """Should grow the read size while a reader keeps filling it"""
+        async def test():
+            pump = Pump(Writer(), min_read=1024, max_read=64 * 1024)
+            reader = asyncio.StreamReader(limit=1024 * 1024)
+            reader.feed_data(b"x" * 1024 * 1024)
+            reader.feed_eof()
+            await pump.copy(reader)
+            await pump.flush()
+            # 1 + 2 + ... + 32 KiB, followed by 64 KiB reads
+            self.assertEqual(6 + (1024 - 63) // 64 + 1, pump.info().reads)
+
+        self.loop.run_until_complete(test())
+
+    def test_040_slow_writer(self):
+        """Should wait for a slow writer while small writes keep arriving"""
+        async def test():
+            writer = SlowWriter(high=4096)
+            pump = Pump(writer, flush_interval=0)
+            reader = asyncio.StreamReader()
+
+            async def produce():
+                for _ in range(2000):
+                    reader.feed_data(b"x" * 100)
+                    await asyncio.sleep(0)
+                reader.feed_eof()
+
+            await asyncio.gather(pump.copy(reader), produce())
+            await pump.flush()
+            self.assertEqual(200000, sum(map(len, writer.chunks)))
+            self.assertGreater(writer.drains, 1)
+            self.assertLessEqual(writer.transport.peak, 4096 + pump.max_read)
+
+        self.loop.run_until_complete(test())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+
+from yaz_scripting_plugin.scheduler import Scheduler, HIGH, LOW
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def test_010_max_in_flight(self):
+        """Should never exceed the maximum number of slots"""
+        scheduler = Scheduler(max_in_flight=3)
+        peak = 0
+
+        async def job():
+            nonlocal peak
+            async with scheduler.slot():
+                peak = max(peak, scheduler.info().in_flight)
+                await asyncio.sleep(0.001)
+
+        self.loop.run_until_complete(asyncio.gather(*[job() for _ in range(20)]))
+        self.assertEqual(3, peak)
+
+        info = scheduler.info()
+        self.assertEqual(0, info.in_flight)
+        self.assertEqual(20, info.count)
+        self.assertGreater(info.wait_total, 0.0)
+
+    def test_020_priority(self):
+        """Should hand out waiting slots by priority, then by arrival"""
+        scheduler = Scheduler(max_in_flight=1)
+        order = []
+
+        async def job(name, priority):
+            async with scheduler.slot(priority):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        async def test():
+            async with scheduler.slot():
+                tasks = [asyncio.ensure_future(job(name, priority)) for name, priority in [("low", LOW), ("high-1", HIGH), ("high-2", HIGH)]]
+                await asyncio.sleep(0)
+            await asyncio.gather(*tasks)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(["high-1", "high-2", "low"], order)
+
+    def test_030_key_limit(self):
+        """Should limit slots per key without blocking other keys"""
+        scheduler = Scheduler(max_in_flight=10, key_limit=1)
+        peak = {}
+
+        async def job(key):
+            async with scheduler.slot(key=key):
+                peak[key] = max(peak.get(key, 0), scheduler._in_flight_per_key[key])
+                await asyncio.sleep(0.001)
+
+        self.loop.run_until_complete(asyncio.gather(*[job(key) for key in ["a", "a", "a", "b"]]))
+        self.assertEqual({"a": 1, "b": 1}, peak)
+
+    def test_040_cancel(self):
+        """Should forget a waiter that is cancelled"""
+        scheduler = Scheduler(max_in_flight=1)
+
+        async def test():
+            async with scheduler.slot():
+                task = asyncio.ensure_future(scheduler.slot().__aenter__())
+                await asyncio.sleep(0)
+                self.assertEqual(1, scheduler.info().queued)
+                task.cancel()
+                await asyncio.sleep(0)
+                self.assertEqual(0, scheduler.info().queued)
+            self.assertEqual(0, scheduler.info().in_flight)
+
+        self.loop.run_until_complete(test())
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import shlex
+import socket
+import tempfile
+import unittest
+import unittest.mock
+
+from yaz_scripting_plugin import screen
+from yaz_scripting_plugin.screen import ScreenServer, ScreenError, supports_unix
+
+# connects like netcat, sends the token, and echoes everything it receives in upper case
+CLIENT = "python3 -c {} {{token}} {{address}}".format(shlex.quote("""
+import socket, sys
+token, option, address = sys.argv[1], sys.argv[2], sys.argv[3]
+if option == "-U":
+    connection = socket.socket(socket.AF_UNIX)
+    connection.connect(address)
+else:
+    connection = socket.create_connection((option, int(address)))
+connection.sendall(token.encode() + b"\\n")
+while True:
+    data = connection.recv(1024)
+    if not data:
+        break
+    connection.sendall(data.upper())
+"""))
+
+
+class TestScreenServer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+
+    def echo(self, server: ScreenServer, sessions: int):
+        async def session(index):
+            reader, writer = await asyncio.open_connection(sock=await server.connect("session {}".format(index)))
+            writer.write("hello {}\n".format(index).encode())
+            self.assertEqual("HELLO {}\n".format(index).encode(), await reader.readline())
+            writer.close()
+
+        async def test():
+            try:
+                await asyncio.gather(*[session(index) for index in range(sessions)])
+            finally:
+                await server.close()
+
+        self.loop.run_until_complete(test())
+
+    def test_010_unix(self):
+        """Should connect concurrent sessions to their own screen over a Unix domain socket"""
+        server = ScreenServer("/bin/sh -c {client} &", CLIENT, timeout=10.0)
+        self.echo(server, 8)
+        self.assertIsNone(server.path)
+
+    def test_020_tcp(self):
+        """Should connect concurrent sessions to their own screen over an ephemeral port"""
+        self.echo(ScreenServer("/bin/sh -c {client} &", CLIENT, timeout=10.0, unix=False), 8)
+
+    def test_030_unknown_token(self):
+        """Should reject a screen with an unknown token, and time out the session"""
+        server = ScreenServer("/bin/sh -c {client} &", CLIENT.replace("{token}", "guess"), timeout=0.5)
+
+        async def test():
+            try:
+                with self.assertRaises(ScreenError):
+                    await server.connect("title")
+                self.assertEqual({}, server._pending)
+            finally:
+                await server.close()
+
+        self.loop.run_until_complete(test())
+
+    def test_040_command_fails(self):
+        """Should raise when the screen command fails"""
+        server = ScreenServer("exit 3", CLIENT)
+
+        async def test():
+            try:
+                with self.assertRaises(ScreenError):
+                    await server.connect("title")
+                directory = os.path.dirname(server.path)
+            finally:
+                await server.close()
+            self.assertFalse(os.path.exists(directory))
+
+        self.loop.run_until_complete(test())
+
+    def test_050_netcat_without_unix_sockets(self):
+        """Should listen on a port when the netcat of the client does not support -U"""
+        async def test():
+            with tempfile.TemporaryDirectory() as directory:
+                for name, usage, expected in (("netcat", "usage: nc [-46CDdFhklNnrStUuvZz]\n\t-U\t\tUse UNIX domain socket", True), ("nc", "usage: nc [-lnrtuvz] hostname port\n\t-u\t\t\tUDP mode", False)):
+                    path = os.path.join(directory, name)
+                    with open(path, "w") as file:
+                        file.write("#!/bin/sh\necho {}\nexit 1\n".format(shlex.quote(usage)))
+                    os.chmod(path, 0o755)
+                    with unittest.mock.patch.dict(os.environ, PATH=directory), unittest.mock.patch.dict(screen._netcat_unix, clear=True):
+                        self.assertEqual(expected, await supports_unix("(cat) | {} {{address}}".format(name)))
+                        server = ScreenServer("true", "(cat) | {} {{address}}".format(name))
+                        await server._start()
+                        self.assertEqual(expected, server.path is not None)
+                        self.assertEqual(expected, server.port is None)
+                        await server.close()
+                self.assertTrue(await supports_unix(CLIENT))
+
+        self.loop.run_until_complete(test())
+
+    def test_060_oversized_token(self):
+        """Should close a connection that sends a token line longer than MAX_TOKEN_LINE"""
+        async def test():
+            server = ScreenServer("true", CLIENT)
+            connection, client = socket.socketpair()
+            connection.setblocking(False)
+            client.sendall(b"x" * 4096)
+            with self.assertLogs("yaz_scripting_plugin", "WARNING"):
+                await server._incoming_connection(connection)
+            self.assertEqual(-1, connection.fileno())
+            client.close()
+
+        self.loop.run_until_complete(test())
+
+    def test_070_token_only(self):
+        """Should leave what the screen sends after the token in the socket"""
+        async def test():
+            server = ScreenServer("true", CLIENT)
+            future = server._pending["token"] = self.loop.create_future()
+            connection, client = socket.socketpair()
+            connection.setblocking(False)
+            client.sendall(b"token\ntyped ahead")
+            await server._incoming_connection(connection)
+            self.assertIs(connection, future.result())
+            self.assertEqual(b"typed ahead", await self.loop.sock_recv(connection, 1024))
+            connection.close()
+            client.close()
+
+        self.loop.run_until_complete(test())
+
+
+if __name__ == "__main__":
+    unittest.main()
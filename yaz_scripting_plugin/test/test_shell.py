@@ -1,8 +1,40 @@
 import asyncio
+import gc
+import io
+import os
+import pathlib
+import shlex
+import tempfile
 import unittest
 import yaz
 import yaz_scripting_plugin
 
+from yaz_scripting_plugin.capture import BYTES
+from yaz_scripting_plugin.error import BatchError, InvalidReturnCodeError, PipelineError, ProcessTimeoutError
+from yaz_scripting_plugin.parse import CsvParser, JsonLinesParser
+from yaz_scripting_plugin.screen import ScreenServer
+from yaz_scripting_plugin.source import TemplateInput, write_chunks, write_input
+
+# stands in for screen and netcat: connects, types "hello" and writes everything it receives to a file
+SCREEN_CLIENT = "python3 -c {} {{token}} {{path}}".format(shlex.quote("""
+import socket, sys, time
+connection = socket.socket(socket.AF_UNIX)
+connection.connect(sys.argv[2])
+connection.sendall(sys.argv[1].encode() + b"\\n")
+time.sleep(0.2)
+connection.sendall(b"hello\\n")
+connection.shutdown(socket.SHUT_WR)
+with open(sys.argv[3] + ".tmp", "wb") as file:
+    while True:
+        data = connection.recv(1024)
+        if not data:
+            break
+        file.write(data)
+import os
+os.rename(sys.argv[3] + ".tmp", sys.argv[3])
+"""))
+
+
 class TestShell(unittest.TestCase):
     def setUp(self):
         self.shell = yaz.get_plugin_instance(yaz_scripting_plugin.Shell)
@@ -10,6 +42,7 @@ class TestShell(unittest.TestCase):
         asyncio.set_event_loop(self.loop)
 
     def tearDown(self):
+        self.loop.run_until_complete(self.shell.pool.close())
         asyncio.set_event_loop(None)
 
     def test_010_get(self):
@@ -19,3 +52,335 @@ class TestShell(unittest.TestCase):
             self.assertEqual("to stderr\n", stderr)
 
         self.loop.run_until_complete(test())
+
+    def test_020_stream(self):
+        async def test():
+            stream = self.shell.stream("python -c {% quote %}import sys\nfor i in range(42): print(i)\nprint({% quote %}to stderr{% end_quote %}, file=sys.stderr){% end_quote %}", lines=True)
+            outputs = [(output.source, output.value) async for output in stream]
+            self.assertEqual([("stdout", "{}\n".format(i).encode()) for i in range(42)], [output for output in outputs if output[0] == "stdout"])
+            self.assertEqual([("stderr", b"to stderr\n")], [output for output in outputs if output[0] == "stderr"])
+            self.assertEqual(0, stream.return_code)
+
+        self.loop.run_until_complete(test())
+
+    def test_030_stream_valid_codes(self):
+        async def test():
+            with self.assertRaises(InvalidReturnCodeError) as context:
+                async for _ in self.shell.stream("sh", "echo Hello World! && exit 3"):
+                    pass
+            self.assertEqual(3, context.exception.get_return_code())
+
+        self.loop.run_until_complete(test())
+
+    def test_040_stream_close(self):
+        async def test():
+            stream = self.shell.stream("yes", chunk_size=1024)
+            async for output in stream:
+                self.assertEqual("stdout", output.source)
+                break
+            await stream.aclose()
+
+        self.loop.run_until_complete(test())
+
+    def test_050_get_pooled(self):
+        async def test():
+            results = await asyncio.gather(*[self.shell.get("echo {{ index }} && echo to stderr >&2", context=dict(index=index), pooled=True) for index in range(10)])
+            self.assertEqual([("{}\n".format(index), "to stderr\n") for index in range(10)], results)
+
+            with self.assertRaises(InvalidReturnCodeError) as context:
+                await self.shell.get("exit 4", pooled=True)
+            self.assertEqual(4, context.exception.get_return_code())
+
+        self.loop.run_until_complete(test())
+
+    def test_060_get_mode(self):
+        async def test():
+            for mode in ["auto", "shell", "exec"]:
+                stdout, stderr = await self.shell.get("echo {{ message|quote }}", context=dict(message="Hello World!"), mode=mode)
+                self.assertEqual(("Hello World!\n", ""), (stdout, stderr), mode)
+
+                with self.assertRaises(InvalidReturnCodeError) as context:
+                    await self.shell.get("yaz-command-does-not-exist", mode=mode)
+                self.assertEqual(127, context.exception.get_return_code())
+
+        self.loop.run_until_complete(test())
+
+    def test_070_get_capture_policy(self):
+        async def test():
+            stdout, stderr = await self.shell.get("head -c 100000 /dev/zero", max_bytes=1000)
+            self.assertTrue(stdout.startswith("\0" * 500))
+            self.assertTrue(stdout.endswith("\0" * 500))
+            self.assertIn("[... 99000 bytes omitted ...]", stdout)
+
+            stdout, stderr = await self.shell.get("head -c 100000 /dev/zero", spill_bytes=1000)
+            with stdout:
+                self.assertEqual(100000, len(stdout))
+            self.assertEqual("", stderr)
+
+        self.loop.run_until_complete(test())
+
+    def test_080_get_capture_modes(self):
+        script = "echo to stdout && echo to stderr >&2"
+
+        async def test():
+            self.assertEqual((b"to stdout\n", b"to stderr\n"), await self.shell.get(script, stdout="bytes", stderr="bytes"))
+            self.assertEqual(("to stdout\nto stderr\n", None), await self.shell.get(script, stderr="merge"))
+            self.assertEqual((None, "to stderr\n"), await self.shell.get(script, stdout="discard"))
+            self.assertEqual((None, None), await self.shell.get(script, stdout="discard", stderr="discard"))
+            self.assertEqual((None, b"to stderr\n"), await self.shell.get(script, stdout="discard", stderr="bytes", pooled=True))
+
+        self.loop.run_until_complete(test())
+
+    def test_090_get_many(self):
+        async def test():
+            commands = ["echo {{ message }} 0", ("sh", "echo {{ message }} 1"), "echo {{ message }} 2 && exit 1", "echo {{ message }} 3"]
+            with self.assertRaises(BatchError) as context:
+                await self.shell.get_many(commands, dict(message="Hello"), concurrency=2)
+
+            error = context.exception
+            self.assertEqual([0, 1, None, 3], [None if result is None else int(result[0].split()[1]) for result in error.get_results()])
+            self.assertEqual([2], list(error.get_errors()))
+            self.assertEqual(1, error.get_errors()[2].get_return_code())
+
+            results = await self.shell.get_many(["echo {}".format(index) for index in range(20)], concurrency=4)
+            self.assertEqual([("{}\n".format(index), "") for index in range(20)], results)
+
+        self.loop.run_until_complete(test())
+
+    def test_100_iter_many(self):
+        async def test():
+            seen = []
+            async for index, (stdout, stderr) in self.shell.iter_many(["sleep 0.{}; echo {}".format(3 - index, index) for index in range(3)]):
+                seen.append((index, stdout))
+            self.assertEqual([(2, "2\n"), (1, "1\n"), (0, "0\n")], seen)
+
+        self.loop.run_until_complete(test())
+
+    def test_110_get_cache(self):
+        async def test():
+            self.shell.result_cache.invalidate()
+            cmd = "python -c {% quote %}import random; print(random.random()){% end_quote %}"
+            first = await self.shell.get(cmd, cache="test")
+            self.assertEqual(first, await self.shell.get(cmd, cache="test"))
+            self.assertNotEqual(first, await self.shell.get(cmd))
+
+            await self.shell.get("true", invalidates=("test",))
+            self.assertNotEqual(first, await self.shell.get(cmd, cache="test"))
+
+        self.loop.run_until_complete(test())
+
+    def test_120_get_timeout(self):
+        async def test():
+            with self.assertRaises(ProcessTimeoutError) as context:
+                await self.shell.get("echo partial && sleep 10", timeout=0.5)
+            self.assertEqual(b"partial\n", context.exception.get_stdout())
+
+        self.loop.run_until_complete(test())
+
+    def test_130_get_cancel(self):
+        """Should not leak processes, zombies or file descriptors when thousands of running and queued calls are cancelled"""
+        marker = "31.4159"
+
+        def count_processes():
+            leaked = zombies = 0
+            for pid in filter(str.isdigit, os.listdir("/proc")):
+                try:
+                    with open("/proc/{}/cmdline".format(pid), "rb") as file:
+                        leaked += file.read() == "sleep\0{}\0".format(marker).encode()
+                    with open("/proc/{}/stat".format(pid)) as file:
+                        fields = file.read().rsplit(")", 1)[1].split()
+                        zombies += fields[0] == "Z" and int(fields[1]) == os.getpid()
+                except OSError:
+                    pass
+            return leaked, zombies
+
+        async def test():
+            gc.collect()
+            fds = len(os.listdir("/proc/self/fd"))
+            # more calls than SELF.SHELL.MAX_IN_FLIGHT, so that calls waiting for a slot are cancelled as well
+            batch = 4 * self.shell.max_in_flight
+            for index in range(0, 2000, batch):
+                # every command starts sleep from a subshell, the grandchild is not reached by killing /bin/sh alone
+                tasks = [asyncio.ensure_future(self.shell.get("(sleep {}; true) && true".format(marker), timeout=0.05 if (index // batch) % 2 else None))
+                         for _ in range(min(batch, 2000 - index))]
+                await asyncio.sleep(0.05)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.assertEqual((0, 0), self.shell.scheduler.info()[:2])
+            gc.collect()
+            self.assertEqual((0, 0), count_processes())
+            self.assertLessEqual(len(os.listdir("/proc/self/fd")), fds)
+
+        self.loop.run_until_complete(test())
+
+    def run_in_screen(self, cmd: str) -> bytes:
+        screen_server, self.shell.screen_server = self.shell.screen_server, None
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "screen")
+            self.shell.screen_server = ScreenServer("/bin/sh -c {client} &", "{} {}".format(SCREEN_CLIENT, shlex.quote(path)), timeout=10.0)
+
+            async def test():
+                try:
+                    await self.shell.run(cmd)
+                    for _ in range(100):
+                        if os.path.exists(path):
+                            break
+                        await asyncio.sleep(0.05)
+                finally:
+                    await self.shell.screen_server.close()
+                    self.shell.screen_server = screen_server
+
+            self.loop.run_until_complete(test())
+            with open(path, "rb") as file:
+                return file.read()
+
+    def test_140_run_passthrough(self):
+        """Should connect the process to the screen directly"""
+        self.assertEqual(b"hello\nsocket\nto stderr\n", self.run_in_screen("cat && readlink /proc/$$/fd/0 | cut -d: -f1 && echo to stderr >&2"))
+
+    def test_150_run_copy(self):
+        """Should copy between the screen and the process when passthrough is disabled"""
+        self.shell.screen_passthrough = False
+        try:
+            self.assertEqual(b"hello\npipe\n", self.run_in_screen("cat && readlink /proc/$$/fd/0 | cut -d: -f1"))
+        finally:
+            del self.shell.screen_passthrough
+
+    def test_160_metrics(self):
+        """Should record what every process cost"""
+        seen = []
+        self.shell.metrics.subscribe(seen.append)
+        try:
+            self.loop.run_until_complete(self.shell.get("python3 -c {% quote %}print(sum(range(10 ** 6))){% end_quote %}", "ignored"))
+        finally:
+            self.shell.metrics.unsubscribe(seen.append)
+
+        metrics, = seen
+        self.assertEqual(("get", "python3", 0, 7, 13), (metrics.kind, metrics.program, metrics.return_code, metrics.bytes_in, metrics.bytes_out))
+        self.assertGreater(metrics.render_time, 0)
+        self.assertLessEqual(metrics.spawn_time, metrics.wall_time)
+        self.assertIn("python3", self.shell.metrics.snapshot())
+
+    def test_170_log(self):
+        """Should log structured records, without the full input"""
+        with self.assertLogs("yaz_scripting_plugin", "DEBUG") as logs:
+            self.loop.run_until_complete(self.shell.get("wc -c", "x" * 100000))
+
+        execute, ended = [record.command for record in logs.records if hasattr(record, "command")]
+        self.assertEqual(("wc -c", 100000, "x" * 64), (execute["cmd"], execute["input_size"], execute["input_preview"]))
+        self.assertEqual(("wc -c", 0, 7, 0), (ended["cmd"], ended["return_code"], ended["stdout_size"], ended["stderr_size"]))
+        self.assertLess(max(len(record.getMessage()) for record in logs.records), 1000)
+
+    def test_180_pipeline(self):
+        """Should connect the stages of a pipeline and check the return code of each stage"""
+        async def test():
+            self.assertEqual(("A\nB\n", "", [0, 0, 0]), await self.shell.pipeline(["sort", "head -n {{ count }}", "tr a-z A-Z"], "c\nb\na\n", dict(count=2)))
+            # yes is killed by SIGPIPE once head stops reading
+            stdout, _, return_codes = await self.shell.pipeline(["yes", "head -n 3"])
+            self.assertEqual(("y\ny\ny\n", 0), (stdout, return_codes[1]))
+            # /bin/sh reports a command that was killed by SIGPIPE with exit code 141
+            self.assertEqual(("y\n", "", [141, 0]), await self.shell.pipeline(["yes && true", "head -n 1"]))
+            with self.assertRaises(PipelineError):
+                await self.shell.pipeline(["sh -c 'exit 141'", "cat"], mode="exec")
+
+            with self.assertRaises(PipelineError) as context:
+                await self.shell.pipeline(["sh -c {% quote %}echo oops >&2; exit 3{% end_quote %}", "cat", "false"])
+            self.assertEqual(([3, 0, 1], 0, 3, b"oops\n"), (context.exception.return_codes, context.exception.stage, context.exception.return_code, context.exception.stderr))
+            self.assertEqual(("", "", [0, 1]), await self.shell.pipeline(["true", "false"], valid_codes=[(0,), (1,)]))
+
+            with tempfile.TemporaryFile() as file:
+                self.assertEqual((None, "", [0, 0]), await self.shell.pipeline(["head -c 1000000 /dev/zero", "cat"], stdout=file))
+                self.assertEqual(1000000, file.seek(0, os.SEEK_END))
+
+            with self.assertRaises(ProcessTimeoutError):
+                await self.shell.pipeline(["sleep 10", "cat"], timeout=0.1)
+
+        self.loop.run_until_complete(test())
+
+    def test_190_input_sources(self):
+        """Should accept bytes, paths, file objects, iterables, asynchronous iterables and streamed templates as input"""
+        async def test():
+            self.assertEqual((b"\x00\xff", ""), await self.shell.get("cat", b"\x00\xff", stdout=BYTES))
+
+            with tempfile.NamedTemporaryFile() as file:
+                file.write(b"from a file\n")
+                file.flush()
+                self.assertEqual(("from a file\n", ""), await self.shell.get("cat", pathlib.Path(file.name)))
+                file.seek(0)
+                self.assertEqual(("from a file\n", ""), await self.shell.get("cat", file))
+            self.assertEqual(("from memory", ""), await self.shell.get("cat", io.BytesIO(b"from memory")))
+            self.assertEqual(("abc", ""), await self.shell.get("cat", ["a", b"b", "c"]))
+
+            produced = []
+
+            async def chunks():
+                while True:
+                    produced.append(None)
+                    yield b"x" * 64 * 1024
+
+            # an endless source is only read while the process reads from the pipe
+            stream = self.shell.stream("head -c 1048576 | wc -c", chunks())
+            self.assertEqual([b"1048576\n"], [output.value async for output in stream])
+            self.assertLess(len(produced), 64)
+
+            self.assertEqual(("3\n", "", [0, 0]), await self.shell.pipeline(["cat", "wc -l"], TemplateInput("{% for i in range(3) %}{{ i }}\n{% endfor %}")))
+            self.shell.metrics.clear()
+            stdout, _ = await self.shell.get("wc -c", TemplateInput("{% for i in range(count) %}{{ line }}\n{% endfor %}"), dict(count=100000, line="y" * 99))
+            self.assertEqual("10000000\n", stdout)
+            self.assertEqual(10000000, self.shell.metrics.snapshot()["wc"]["bytes_in"])
+
+            with self.assertRaises(AssertionError):
+                await self.shell.get("cat", ["a"], cache="test")
+
+        self.loop.run_until_complete(test())
+
+    def test_200_parse(self):
+        """Should parse records while the process runs"""
+        async def test():
+            records = []
+            async for record in self.shell.parse("seq 100000", JsonLinesParser(), chunk_size=4096):
+                records.append(record)
+            self.assertEqual(list(range(1, 100001)), records)
+
+            columns = await self.shell.get_columns("printf 'name,size\\na,1\\nb,2\\n'", CsvParser())
+            self.assertEqual(dict(name=["a", "b"], size=["1", "2"]), columns)
+
+            with self.assertRaises(InvalidReturnCodeError):
+                async for _ in self.shell.parse("sh -c 'echo 1; exit 1'", JsonLinesParser()):
+                    pass
+
+        self.loop.run_until_complete(test())
+
+    def test_210_exec_never_uses_shell(self):
+        """Should not let /bin/sh interpret an "exec" command that can not be executed"""
+        async def test():
+            for pooled in (False, True):
+                with self.assertRaises(InvalidReturnCodeError) as context:
+                    await self.shell.get("yaz-missing-prog; echo SHELL-RAN $HOME", mode="exec", pooled=pooled)
+                self.assertEqual(127, context.exception.get_return_code())
+                self.assertNotIn(b"SHELL-RAN", context.exception.get_stdout())
+                self.assertIn(b"yaz-missing-prog;", context.exception.get_stderr())
+
+            with self.assertRaises(InvalidReturnCodeError) as context:
+                await self.shell.pipeline(["yes", "yaz-missing-prog"], mode="exec")
+            self.assertEqual((127, b"", b"yaz-missing-prog: No such file or directory\n"),
+                             (context.exception.get_return_code(), context.exception.get_stdout(), context.exception.get_stderr()))
+
+            stdout, _ = await self.shell.get("yaz-missing-prog; echo SHELL-RAN", mode="auto", valid_codes=(0, 127))
+            self.assertEqual("SHELL-RAN\n", stdout)
+
+        self.loop.run_until_complete(test())
+
+    def test_220_input_written(self):
+        """Should only count the input a process accepted before it closed its stdin"""
+        async def test():
+            data = b"x" * (16 * 1024 * 1024)
+            for input in (data, [data[offset:offset + 1024 * 1024] for offset in range(0, len(data), 1024 * 1024)]):
+                process = await asyncio.create_subprocess_exec("head", "-c", "10", stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL)
+                written = await (write_input(input, process.stdin) if isinstance(input, bytes) else write_chunks(input, process.stdin))
+                await process.wait()
+                self.assertGreaterEqual(written, 10)
+                self.assertLess(written, len(data))
+
+        self.loop.run_until_complete(test())
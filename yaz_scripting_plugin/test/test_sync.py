@@ -0,0 +1,100 @@
+import asyncio
+import concurrent.futures
+import threading
+import unittest
+import yaz
+
+from yaz_scripting_plugin import Shell
+from yaz_scripting_plugin.error import InvalidReturnCodeError
+from yaz_scripting_plugin.sync import LoopThread, SyncShell
+
+
+class TestLoopThread(unittest.TestCase):
+    def setUp(self):
+        self.loop_thread = LoopThread("test-loop")
+
+    def tearDown(self):
+        self.loop_thread.stop()
+
+    def test_010_call(self):
+        """Should run coroutines from many threads on a single loop"""
+        async def get_thread():
+            await asyncio.sleep(0)
+            return threading.current_thread()
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            threads = set(executor.map(lambda _: self.loop_thread.call(get_thread()), range(100)))
+        self.assertEqual({self.loop_thread._thread}, threads)
+
+    def test_020_timeout(self):
+        """Should cancel the coroutine when the caller stops waiting"""
+        cancelled = threading.Event()
+
+        async def sleep():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            self.loop_thread.call(sleep(), timeout=0.1)
+        self.assertTrue(cancelled.wait(1.0))
+
+    def test_030_reentrant(self):
+        """Should refuse to block the loop thread on itself"""
+        async def nested():
+            self.loop_thread.call(asyncio.sleep(0))
+
+        with self.assertRaises(RuntimeError):
+            self.loop_thread.call(nested())
+
+    def test_040_stop(self):
+        """Should cancel running coroutines when stopped, and start again when used"""
+        future = self.loop_thread.submit(asyncio.sleep(10))
+        self.loop_thread.stop()
+        self.assertTrue(future.cancelled())
+        self.assertFalse(self.loop_thread.is_running())
+        self.assertEqual(42, self.loop_thread.call(asyncio.sleep(0, 42)))
+
+
+class TestSyncShell(unittest.TestCase):
+    def setUp(self):
+        self.shell = yaz.get_plugin_instance(SyncShell)
+
+    def tearDown(self):
+        self.shell.close()
+
+    def test_010_get(self):
+        """Should execute commands without an event loop in the calling thread"""
+        self.assertEqual(("hello\n", ""), self.shell.get("echo {{ word }}", context=dict(word="hello")))
+        self.assertEqual(("abc", "", [0, 0]), self.shell.pipeline(["cat", "cat"], "abc"))
+        self.assertEqual([("1\n", ""), ("2\n", "")], self.shell.get_many(["echo 1", "echo 2"]))
+        with self.assertRaises(InvalidReturnCodeError):
+            self.shell.get("false")
+
+    def test_020_threads(self):
+        """Should serve many threads at the same time"""
+        with concurrent.futures.ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(lambda index: self.shell.get("echo {}".format(index))[0], range(200)))
+        self.assertEqual(["{}\n".format(index) for index in range(200)], results)
+
+    def test_030_shared_shell(self):
+        """Should not share the state of the Shell that is used by another event loop"""
+        shell = yaz.get_plugin_instance(Shell)
+        self.assertIsNot(shell, self.shell.shell)
+        self.assertIs(type(shell), type(self.shell.shell))
+
+        async def test():
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                futures = [asyncio.wrap_future(executor.submit(self.shell.get, "echo sync {}".format(index), pooled=True)) for index in range(20)]
+                results = await asyncio.gather(*[shell.get("echo async {}".format(index), pooled=True) for index in range(20)], *futures)
+            self.assertEqual(["async {}\n".format(index) for index in range(20)] + ["sync {}\n".format(index) for index in range(20)],
+                             [stdout for stdout, _ in results])
+            await shell.pool.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(test())
+        finally:
+            loop.close()
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+import yaz
+import yaz_templating_plugin
+
+from yaz_scripting_plugin.template import TemplateCache
+
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.templating = yaz.get_plugin_instance(yaz_templating_plugin.Templating)
+
+    def test_010_render(self):
+        """Should render identical to the templating plugin"""
+        cache = TemplateCache(self.templating.environment)
+        for source in ["echo {{ message|quote }}", "echo -n {% quote %}{{ message }}{% end_quote %}", "ls -la\n", "awk '{print $1}'", "a\r\nb", ""]:
+            context = dict(message="Hello World!")
+            self.assertEqual(self.templating.render(source, context), cache.render(source, context))
+
+    def test_020_counters(self):
+        """Should count hits, misses, evictions and skips"""
+        cache = TemplateCache(self.templating.environment, maxsize=2)
+        cache.render("echo {{ a }}", dict(a=1))
+        cache.render("echo {{ a }}", dict(a=2))
+        cache.render("echo {{ b }}", dict(b=1))
+        cache.render("echo {{ c }}", dict(c=1))
+        cache.render("echo plain")
+
+        info = cache.info()
+        self.assertEqual(1, info.hits)
+        self.assertEqual(3, info.misses)
+        self.assertEqual(1, info.evictions)
+        self.assertEqual(1, info.skips)
+        self.assertEqual(2, info.currsize)
+
+    def test_030_bytecode_cache(self):
+        """Should store compiled templates on disk and render them identical to the templating plugin"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache")
+            sources = ["echo {{ message|quote }}", "{% for index in range(2) %}{{ index }}{% endfor %}", "echo plain"]
+            context = dict(message="Hello World!")
+            expected = [self.templating.render(source, context) for source in sources]
+            cache = TemplateCache(self.templating.environment, bytecode_cache_path=path)
+            self.assertEqual(expected, [cache.render(source, context) for source in sources])
+            self.assertEqual(2, len(os.listdir(path)))
+
+            # a fresh cache loads the stored templates instead of compiling them
+            cache = TemplateCache(lambda: self.templating.environment, bytecode_cache_path=path)
+            with unittest.mock.patch.object(self.templating.environment, "compile", side_effect=AssertionError):
+                self.assertEqual(expected, [cache.render(source, context) for source in sources])
+
+    def test_040_lazy(self):
+        """Should only import jinja once a template is compiled"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "template-cache")
+            script = "import sys, yaz, yaz_scripting_plugin\n" \
+                     "yaz_scripting_plugin.Shell.template_bytecode_cache_path = {!r}\n" \
+                     "shell = yaz.get_plugin_instance(yaz_scripting_plugin.Shell)\n" \
+                     "print(shell._render('echo plain', None), 'jinja2' in sys.modules)\n" \
+                     "print(shell._render('echo {{{{ a }}}}', dict(a=1)), 'jinja2' in sys.modules)\n".format(path)
+            output = subprocess.check_output([sys.executable, "-c", script])
+            self.assertEqual(b"echo plain False\necho 1 True\n", output)
+            self.assertEqual(1, len(os.listdir(path)))